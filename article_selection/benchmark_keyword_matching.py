@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmark of the keyword matching of the article selection.
+
+Compares is_topic_relevant and select_relevant with the original
+implementation (lowercased title + text, one substring scan per keyword,
+and a second scan to find out which keywords occur): both have to give
+identical results for every article, then the time per article is measured.
+
+Articles are read from a .json/.jsonl file (e.g. the output of the article
+selection) or generated if no file is given. Most generated articles do not
+contain any keyword, as in the scraped corpus:
+
+    $ python3 -m article_selection.benchmark_keyword_matching data/relevant_articles.json
+"""
+
+import random
+import sys
+import timeit
+from typing import Callable, Dict, List
+
+from article_selection.article_selection import is_topic_relevant, select_relevant
+
+KEYWORDS = ['migra', 'flücht', 'asyl']
+
+# Articles with the cases that are treated specially by the selection
+EDGE_CASES = [
+    {'date': '01.01.2020', 'title': "Flüchtlinge", 'text': "Asylrecht", 'url': "a"},
+    {'date': '01.01.2020', 'title': "FLÜCHTLINGE", 'text': "", 'url': "a"},
+    # a keyword spanning the end of the title and the beginning of the text
+    {'date': '01.01.2020', 'title': "Die Mig", 'text': "ration", 'url': "a"},
+    {'date': '01.01.2020', 'title': "Asyl", 'text': "text", 'url': "a", 'news_keywords': "sport"},
+    {'date': '01.01.2020', 'title': "title", 'text': "text", 'url': "a", 'news_keywords': "Migration, Asyl"},
+    {'date': '01.01.2020', 'title': "Asyl", 'text': "text", 'url': "a", 'news_keywords': None},
+    {'title': "Asyl", 'text': "text", 'url': "a"},
+]
+
+_WORDS = ["Die", "Bundesregierung", "hat", "am", "Montag", "neue", "Regeln", "für", "Kommunen", "und",
+          "Schulen", "beschlossen", "Über", "Straße", "größer", "Jahr", "Prozent", "Sport", "Wetter"]
+
+
+def reference_is_topic_relevant(article: dict, keywords: list) -> bool:
+    """Original is_topic_relevant"""
+    if not all(key in article for key in ['date', 'title', 'text', 'url']):
+        return False
+    try:
+        search_corpus = article['news_keywords'].lower()
+    except KeyError:
+        search_corpus = article['title'].lower() + article['text'].lower()
+    except AttributeError:
+        return False
+    return any(keyword in search_corpus for keyword in keywords)
+
+
+def reference_select_relevant(articles: Dict[str, dict], keywords: list) -> Dict[str, List[str]]:
+    """Relevant articles and their keywords with the original selection and a second scan"""
+    relevant = {}
+    for key, article in articles.items():
+        if reference_is_topic_relevant(article, keywords):
+            search_corpus = article.get('news_keywords') or article['title'] + article['text']
+            relevant[key] = sorted(kw for kw in keywords if kw in search_corpus.lower())
+    return relevant
+
+
+def generated_articles(num_articles: int = 300, relevant_share: float = 0.1, seed: int = 0) -> Dict[str, dict]:
+    """Random articles of 200 to 1500 words, relevant_share of them contain a keyword"""
+    rng = random.Random(seed)
+    articles = {}
+    for i in range(num_articles):
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(200, 1500))]
+        if rng.random() < relevant_share:
+            words.insert(rng.randrange(len(words)), rng.choice(["Flüchtlinge", "Asylbewerber", "Migration"]))
+        articles[str(i)] = {'date': '01.01.2020', 'title': " ".join(words[:8]), 'text': " ".join(words[8:]),
+                            'url': f"https://www.example.de/{i}"}
+    return articles
+
+
+def check_equivalence(articles: Dict[str, dict], keywords: list = KEYWORDS) -> None:
+    edge_cases = {f"edge{i}": article for i, article in enumerate(EDGE_CASES)}
+    for article in list(articles.values()) + EDGE_CASES:
+        assert is_topic_relevant(article, keywords) == reference_is_topic_relevant(article, keywords), article
+    assert select_relevant(edge_cases, keywords) == reference_select_relevant(edge_cases, keywords)
+    assert select_relevant(articles, keywords) == reference_select_relevant(articles, keywords)
+
+
+def time_per_article(fn: Callable[[Dict[str, dict]], object], articles: Dict[str, dict], repeat: int = 10) -> float:
+    return min(timeit.repeat(lambda: fn(articles), number=1, repeat=repeat)) / len(articles)
+
+
+def main(articles: Dict[str, dict], keywords: list = KEYWORDS) -> None:
+    check_equivalence(articles, keywords)
+    relevant = len(reference_select_relevant(articles, keywords))
+    print(f"Results for {len(articles)} articles ({relevant} relevant) are identical")
+    benchmarks = [
+        ("is_topic_relevant",
+         lambda arts: [reference_is_topic_relevant(a, keywords) for a in arts.values()],
+         lambda arts: [is_topic_relevant(a, keywords) for a in arts.values()]),
+        ("relevant articles with keywords",
+         lambda arts: reference_select_relevant(arts, keywords),
+         lambda arts: select_relevant(arts, keywords)),
+    ]
+    for name, reference, fast in benchmarks:
+        reference_time = time_per_article(reference, articles)
+        fast_time = time_per_article(fast, articles)
+        print(f"{name}: {reference_time * 1e6:.1f} µs -> {fast_time * 1e6:.1f} µs per article "
+              f"(speedup {reference_time / fast_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        from article_selection.jsonl import read_articles
+        frame = read_articles(sys.argv[1], columns=["date", "title", "text", "url"])
+        main({str(i): record for i, record in enumerate(frame.to_dict("records"))})
+    else:
+        main(generated_articles())
@@ -0,0 +1,161 @@
+"""
+Append-only JSON Lines storage for article collections.
+
+Each line of a .jsonl file holds one article dict, its key (the input file
+path or URL that is used as key in the .json collections) is stored in the
+field KEY_FIELD. Next to the data file a small index file (<path>.keys) lists
+the keys already stored, one per line. Adding articles to a collection therefore
+only appends to both files instead of loading and rewriting the whole collection.
+"""
+
+import json
+import os
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+KEY_FIELD = '_key'
+
+
+def is_jsonl(path: str) -> bool:
+    """Return True if path points to a JSON Lines file"""
+    return path.endswith('.jsonl')
+
+
+def _truncate_incomplete_line(path: str) -> None:
+    """Cut off a trailing incomplete line, e.g. left behind by an interrupted run"""
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        # search backwards for the end of the last complete line
+        pos = size
+        while pos > 0:
+            step = min(pos, 1 << 16)
+            pos -= step
+            f.seek(pos)
+            newline = f.read(step).rfind(b'\n')
+            if newline != -1:
+                f.truncate(pos + newline + 1)
+                return
+        f.truncate(0)
+
+
+def iter_jsonl(path: str) -> Iterator[Tuple[str, dict]]:
+    """Stream (key, article) pairs from a JSON Lines article collection"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            article = json.loads(line)
+            key = article.pop(KEY_FIELD, None)
+            yield key, article
+
+
+class JsonlArticleWriter:
+    """Appends articles to a JSON Lines collection, skipping keys that are already stored.
+
+    Use as a context manager:
+
+        with JsonlArticleWriter('data/relevant_articles_evaluation.jsonl') as writer:
+            writer.update(articles)
+    """
+
+    def __init__(self, path: str, new: bool = False):
+        self.path = path
+        self.index_path = path + '.keys'
+        if new:
+            for p in [self.path, self.index_path]:
+                if os.path.exists(p):
+                    os.remove(p)
+        self.keys = self._load_keys()
+        self._data_file = open(self.path, 'a', encoding='utf-8')
+        self._index_file = open(self.index_path, 'a', encoding='utf-8')
+        # keys whose records are not flushed yet, see flush
+        self._pending_keys = []
+
+    def _load_keys(self) -> set:
+        if not os.path.exists(self.path):
+            return set()
+        _truncate_incomplete_line(self.path)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return {line.rstrip('\n') for line in f if line.strip()}
+        # the index is missing (e.g. deleted by hand): rebuild it from the data file
+        keys = {key for key, _ in iter_jsonl(self.path)}
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            f.writelines(f'{key}\n' for key in keys)
+        return keys
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def write(self, key: str, article: dict) -> bool:
+        """Append one article. Returns False if the key was already stored."""
+        if key in self.keys:
+            return False
+        record = dict(article)
+        record[KEY_FIELD] = key
+        self._data_file.write(json.dumps(record, default=str, ensure_ascii=False) + '\n')
+        self._pending_keys.append(key)
+        self.keys.add(key)
+        if len(self._pending_keys) >= 1000:
+            self.flush()
+        return True
+
+    def update(self, articles: Dict[str, dict]) -> int:
+        """Append all articles with new keys and return how many were added"""
+        added = sum(self.write(key, article) for key, article in articles.items())
+        self.flush()
+        return added
+
+    def flush(self) -> None:
+        # The keys are only written to the index after their records were flushed, so that
+        # every key in the index is backed by a complete record even if the process is killed.
+        # (Writing both files in write() would let each buffer flush on its own.)
+        self._data_file.flush()
+        self._index_file.writelines(f'{key}\n' for key in self._pending_keys)
+        self._index_file.flush()
+        self._pending_keys = []
+
+    def close(self) -> None:
+        self.flush()
+        self._data_file.close()
+        self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_articles(path: str, columns: Optional[Sequence[str]] = None, chunksize: int = 10000):
+    """Read an article collection (.json or .jsonl) into a pandas DataFrame indexed by article key.
+
+    JSON Lines files are parsed in chunks of chunksize articles and reduced to the
+    requested columns chunk by chunk, so the other fields are never held for the
+    whole collection. The result still is one DataFrame with all articles, use
+    iter_jsonl to process a collection article by article."""
+    # pandas is only needed by the analysis stages that read the collections
+    import pandas as pd
+
+    if not is_jsonl(path):
+        content = pd.read_json(path, orient="index")
+        return content if columns is None else content[list(columns)]
+
+    chunks = []
+    with pd.read_json(path, lines=True, chunksize=chunksize) as reader:
+        for chunk in reader:
+            chunk = chunk.set_index(KEY_FIELD)
+            chunks.append(chunk if columns is None else chunk[list(columns)])
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    content = pd.concat(chunks)
+    # an interrupted run may have stored a record without registering its key
+    return content[~content.index.duplicated(keep='last')]
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Persistent trigram index over the article corpus.
+
+For every article the set of character trigrams of the lowercased search fields
+(news_keywords or title and text, like in is_topic_relevant) is stored in an
+inverted index. An article can only contain a keyword if it contains all
+trigrams of the keyword, so intersecting the posting lists of these trigrams gives
+a small candidate list without reading the articles themselves.
+The candidates are then verified by write_relevant_content_to_file.
+
+Files of an index directory:
+
+    meta.json       trigram -> [offset, count] of its posting list, indexed input files
+    postings.bin    posting lists: sorted uint32 article ids
+    docs.tsv        one line per article id: <key>\t<reference to load the article>
+
+Build or update an index for the configured input files:
+
+    $ python3 -m article_selection.ngram_index config.ini
+"""
+
+import configparser
+import json
+import os
+import sys
+from array import array
+from collections import defaultdict
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from tqdm import tqdm
+
+from article_selection.article_selection import _search_corpus, list_input_files
+from scraping.article_store import is_segment, iter_segment_records, record_ref
+
+N = 3
+
+
+def ngrams(text: str, n: int = N) -> Set[str]:
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def article_ngrams(article: dict, n: int = N) -> Optional[Set[str]]:
+    """ngrams of the lowercased search fields of an article or None if it is not usable"""
+    corpus = _search_corpus(article)
+    if corpus is None:
+        return None
+    return ngrams(corpus, n)
+
+
+def _iter_documents(input_file: str) -> Iterator[Tuple[str, str, dict]]:
+    """yields (key, reference, article) for all articles of an input file.
+    The reference can be passed to write_relevant_content_to_file to load the article again."""
+    if is_segment(input_file):
+        for offset, url, article in iter_segment_records(input_file):
+            yield url, record_ref(input_file, offset), article
+    else:
+        with open(input_file, "r") as jf:
+            yield input_file, input_file, json.load(jf)
+
+
+def _file_stats(file_list: Iterable[str]) -> dict:
+    stats = {}
+    for input_file in file_list:
+        stat = os.stat(input_file)
+        stats[input_file] = [stat.st_mtime_ns, stat.st_size]
+    return stats
+
+
+class NgramIndex:
+    """Read access to a trigram index directory created by NgramIndex.build"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as mf:
+            meta = json.load(mf)
+        self.n = meta["n"]
+        self.num_docs = meta["num_docs"]
+        self.grams = meta["grams"]
+        self.input_files = meta["input_files"]
+        self._docs = None
+
+    @classmethod
+    def build(cls, path: str, file_list: List[str], n: int = N) -> "NgramIndex":
+        """indexes all articles of the input files (JSON files or archive segments)"""
+        os.makedirs(path, exist_ok=True)
+        postings = defaultdict(lambda: array("I"))
+        doc_id = 0
+        print(f"Building {n}-gram index of {len(file_list)} files in {path}")
+        with open(os.path.join(path, "docs.tsv"), "w", encoding="utf-8") as docs:
+            for input_file in tqdm(file_list):
+                try:
+                    for key, ref, article in _iter_documents(input_file):
+                        grams = article_ngrams(article, n) if isinstance(article, dict) else None
+                        if grams is None:
+                            continue
+                        for gram in grams:
+                            # doc ids are increasing, so every posting list stays sorted
+                            postings[gram].append(doc_id)
+                        docs.write(f"{key}\t{ref}\n")
+                        doc_id += 1
+                except (FileNotFoundError, ValueError):
+                    print(f"Warning: File {input_file} can not be indexed.")
+
+        grams = {}
+        offset = 0
+        with open(os.path.join(path, "postings.bin"), "wb") as pf:
+            for gram, posting in postings.items():
+                posting.tofile(pf)
+                grams[gram] = [offset, len(posting)]
+                offset += len(posting)
+        meta = {"n": n, "num_docs": doc_id, "grams": grams, "input_files": _file_stats(file_list)}
+        with open(os.path.join(path, "meta.json"), "w") as mf:
+            json.dump(meta, mf, ensure_ascii=False)
+        print(f"Indexed {doc_id} articles, {len(grams)} distinct {n}-grams")
+        return cls(path)
+
+    @classmethod
+    def open_or_build(cls, path: str, file_list: List[str], n: int = N) -> "NgramIndex":
+        """opens the index at path and rebuilds it if the input files changed"""
+        try:
+            index = cls(path)
+            if index.n == n and index.is_up_to_date(file_list):
+                return index
+            print(f"Input files changed since the index {path} was built.")
+        except FileNotFoundError:
+            pass
+        return cls.build(path, file_list, n)
+
+    def is_up_to_date(self, file_list: Iterable[str]) -> bool:
+        try:
+            return _file_stats(file_list) == self.input_files
+        except FileNotFoundError:
+            return False
+
+    @property
+    def docs(self) -> List[Tuple[str, str]]:
+        """(key, reference) of every article id"""
+        if self._docs is None:
+            with open(os.path.join(self.path, "docs.tsv"), "r", encoding="utf-8") as df:
+                self._docs = [tuple(line.rstrip("\n").split("\t")) for line in df]
+        return self._docs
+
+    def _posting(self, pf, gram: str) -> array:
+        posting = array("I")
+        if gram in self.grams:
+            offset, count = self.grams[gram]
+            pf.seek(offset * posting.itemsize)
+            posting.fromfile(pf, count)
+        return posting
+
+    def candidate_ids(self, keyword: str) -> Optional[Set[int]]:
+        """ids of all articles that contain every ngram of the keyword.
+        Returns None if the keyword is too short to use the index (every article is a candidate)."""
+        keyword_grams = ngrams(keyword.lower(), self.n)
+        if not keyword_grams:
+            return None
+        # start with the rarest ngram to keep the intermediate sets small
+        keyword_grams = sorted(keyword_grams, key=lambda gram: self.grams.get(gram, [0, 0])[1])
+        with open(os.path.join(self.path, "postings.bin"), "rb") as pf:
+            ids = set(self._posting(pf, keyword_grams[0]))
+            for gram in keyword_grams[1:]:
+                if not ids:
+                    break
+                ids.intersection_update(self._posting(pf, gram))
+        return ids
+
+    def candidates(self, keywords: List[str]) -> List[str]:
+        """references of all articles that may contain one of the keywords, in input order.
+        The list can be used as file_list of write_relevant_content_to_file."""
+        ids = set()
+        for keyword in keywords:
+            keyword_ids = self.candidate_ids(keyword)
+            if keyword_ids is None:
+                ids = set(range(self.num_docs))
+                break
+            ids |= keyword_ids
+        docs = self.docs
+        return [docs[doc_id][1] for doc_id in sorted(ids)]
+
+
+if __name__ == "__main__":
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+    base_path = config.get("ArticleSelection", "input_path_base")
+    start_year = config.getint("ArticleSelection", "start_year")
+    end_year = config.getint("ArticleSelection", "end_year")
+    input_format = config.get("ArticleSelection", "input_format", fallback="files")
+    data_path_list = [base_path + str(year) + "/" for year in range(start_year, end_year + 1)]
+    NgramIndex.open_or_build(config.get("ArticleSelection", "index_path"),
+                             list_input_files(data_path_list, input_format))
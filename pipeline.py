@@ -6,14 +6,58 @@ Calls functions for preprocessing and analysis.
 """
 
 import configparser
-import glob
 import sys
+import time
+from contextlib import contextmanager
+
+# The modules of every stage are imported when the stage is enabled in the config,
+# so e.g. an article selection run does not load torch, spacy, gensim or dash.
+# The time spent on these imports is reported per stage, for details of single modules use
+#   $ python3 -X importtime pipeline.py config.ini 2> importtime.log
+
+start_time = time.perf_counter()
+import_times = {}
+
+
+@contextmanager
+def timed_imports(stage: str):
+    """Measure the imports of a stage and print the time and the newly imported packages"""
+    modules_before = set(sys.modules)
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    import_times[stage] = import_times.get(stage, 0.0) + seconds
+    packages = sorted({name.split(".")[0] for name in set(sys.modules) - modules_before
+                       if not name.startswith("_")})
+    if packages:
+        print(f"Imported {stage} modules in {seconds:.2f}s ({', '.join(packages)})")
+
+
+def read_search_words(config: configparser.ConfigParser, section: str, option: str = "search_words") -> list:
+    """The comma separated search words of the config, lowercased and stripped
+    (with a leading space, a search word at the start of a sentence is not found)"""
+    return [word.strip() for word in config.get(section, option).lower().split(",")]
+
+
+def import_method_modules(methods, server_url=None):
+    """Import the modules of the configured sentiment methods (otherwise imported
+    on first use) so that their import time is part of the report.
+    With a sentiment server, the models are not loaded in this process."""
+    if server_url:
+        return
+    if "sentiws" in methods:
+        import sentiment_analysis.sentiment_dictionary
+    if any(method.endswith("sentibert") for method in methods):
+        import sentiment_analysis.bert
+
+
+def print_timing_report():
+    total = time.perf_counter() - start_time
+    print("\nImport times per stage:")
+    for stage, seconds in import_times.items():
+        print(f"  {stage:<20} {seconds:8.2f}s")
+    print(f"  {'total':<20} {sum(import_times.values()):8.2f}s of {total:.2f}s runtime")
 
-import article_selection.article_selection as article_selection
-from sentiment_analysis.inference import calulate_sentiment, eval_sentiment
-from sentiment_analysis.word2vec_sentiment import *
-from visualization.dash_plot import dash_plot
-from visualization.wordcloud import generate_word_clouds
 
 if __name__ == "__main__":
 
@@ -30,49 +74,84 @@ if __name__ == "__main__":
     # Selection of relevant Articles
     # ==============================
     if config.getboolean("ArticleSelection", "run_article_selection"):
+        with timed_imports("article selection"):
+            import article_selection.article_selection as article_selection
+            from article_selection.ngram_index import NgramIndex
+
         # create input filepath for article selection from:
         # the path to the folders and the start and end year
         base_path = config.get("ArticleSelection", "input_path_base")
         start_year = config.getint("ArticleSelection", "start_year")
         end_year = config.getint("ArticleSelection", "end_year")
         data_path_list = [base_path + str(year) + "/" for year in range(start_year, end_year + 1)]
-        # create list of all data paths
-        json_file_list = []
-        for path in data_path_list:
-            json_file_list += [file_path for file_path in glob.glob(path + "*.json")]
+        # create list of all data paths:
+        # json files of single articles or segment files of archives
+        input_format = config.get("ArticleSelection", "input_format", fallback="files")
+        json_file_list = article_selection.list_input_files(data_path_list, input_format)
+        # segment files contain many articles, so workers get them one by one
+        chunk_size = 1 if input_format == "archive" else 1000
 
         # get keywords, output_path
-        search_keywords = config.get("ArticleSelection", "search_words").lower().split(", ")
+        search_keywords = read_search_words(config, "ArticleSelection")
         output_base = config.get("ArticleSelection", "output_base")
 
+        # only verify the candidate articles found in the trigram index
+        if config.getboolean("ArticleSelection", "use_index", fallback=False):
+            index = NgramIndex.open_or_build(config.get("ArticleSelection", "index_path"), json_file_list)
+            json_file_list = index.candidates(search_keywords)
+            print(f"{len(json_file_list)} candidate articles found in the index")
+            # candidates are single articles, also for archives
+            chunk_size = 1000
+
         # create new file or append to existing file
         create_new_files = not config.getboolean("ArticleSelection", "append_to_existing_file")
+        # json or jsonl (append-only JSON Lines)
+        output_format = config.get("ArticleSelection", "output_format", fallback="json")
 
         # if annotation files are needed get training_size and seed 
         use_annotation = config.getboolean("ArticleSelection", "use_annotation")
         training_size = config.getint("ArticleSelection", "training_size")
         seed = config.getint("ArticleSelection", "seed")
 
+        # number of processes used to load and filter the files
+        num_workers = config.getint("ArticleSelection", "num_workers", fallback=1)
+
         # open all files containing an article 
         # check if the topic is relevannt
         # if use_anotation is True output is split in four files: 
         #   1. evaluation (size_all-training_size)
         #   2. 3 annotation files with the names of the annotators 1/3 training_size
-        article_selection.write_relevant_content_to_file(json_file_list,
-                                                         output_base,
-                                                         search_keywords=search_keywords,
-                                                         new=create_new_files,
-                                                         training_size=training_size,
-                                                         seed=seed,
-                                                         annotation=use_annotation)
+        selection_kwargs = dict(training_size=training_size,
+                                seed=seed,
+                                annotation=use_annotation,
+                                num_workers=num_workers,
+                                chunk_size=chunk_size,
+                                output_format=output_format)
+        if config.getboolean("ArticleSelection", "incremental", fallback=False):
+            # skip files that were already processed with the same search words
+            article_selection.update_relevant_content(json_file_list,
+                                                      output_base,
+                                                      search_keywords=search_keywords,
+                                                      manifest_path=output_base + "manifest.json",
+                                                      new=create_new_files,
+                                                      **selection_kwargs)
+        else:
+            article_selection.write_relevant_content_to_file(json_file_list,
+                                                             output_base,
+                                                             search_keywords=search_keywords,
+                                                             new=create_new_files,
+                                                             **selection_kwargs)
 
     # ===================
     # Word2Vec analysis
     # ===================
     if config.getboolean("Analysis", "run_w2v"):
         print("\nStart word2vec analysis")
+        with timed_imports("word2vec"):
+            from sentiment_analysis.word2vec_sentiment import (similarity_by_publisher, similarity_by_year,
+                                                               similarity_by_year_and_publisher)
         input_file = config.get("Analysis", "input_file")
-        search_words = config.get("Analysis", "search_words_w2v").lower().split(",")
+        search_words = read_search_words(config, "Analysis", "search_words_w2v")
         base_output_path = config.get("Analysis", "output_base_w2v")
         start_year = config.getint("Analysis", "start_year")
         end_year = config.getint("Analysis", "end_year")
@@ -100,11 +179,39 @@ if __name__ == "__main__":
     # ==================
     if config.getboolean("Analysis", "run_senti"):
         print("\nStart sentiment analysis")
+        with timed_imports("sentiment analysis"):
+            from sentiment_analysis.inference import calulate_sentiment
+            import_method_modules(config.get('Analysis', 'senti_methods').lower().split(", "),
+                                  config.get('Analysis', 'senti_server_url', fallback=''))
         input_file = config.get("Analysis", "input_file")
-        search_words = config.get("Analysis", "search_words").lower().split(",")
+        search_words = read_search_words(config, "Analysis")
         output_file = config.get("Analysis", "output_senti")
         methods = config.get('Analysis', 'senti_methods').lower().split(", ")
         finetuned_sentibert_path = config.get('Analysis', 'finetuned_sentibert_path')
+        # BERT batches: number of texts and token budget (0: no limit)
+        batch_size = config.getint('Analysis', 'bert_batch_size', fallback=32)
+        max_tokens = config.getint('Analysis', 'bert_max_tokens', fallback=0) or None
+        # truncate long articles or score all of their token windows
+        long_articles = config.get('Analysis', 'bert_long_articles', fallback='truncate')
+        chunk_aggregation = config.get('Analysis', 'bert_chunk_aggregation', fallback='mean')
+        # or only the sentences around the search words (keywords)
+        keyword_context = config.getint('Analysis', 'bert_keyword_context', fallback=1)
+        # SentiWS: articles parsed by spacy at once, number of spacy processes (-1: one per CPU)
+        sentiws_batch_size = config.getint('Analysis', 'sentiws_batch_size', fallback=64)
+        sentiws_processes = config.getint('Analysis', 'sentiws_processes', fallback=1)
+        sentiws_prefilter = config.getboolean('Analysis', 'sentiws_prefilter', fallback=False)
+        # torch, quantized or onnx (exported with sentiment_analysis/export_onnx.py)
+        backend = config.get('Analysis', 'bert_backend', fallback='torch')
+        onnx_dir = config.get('Analysis', 'bert_onnx_dir', fallback='data/onnx')
+        # worker processes with their own models, torch threads per process (0: cores / workers)
+        num_workers = config.getint('Analysis', 'senti_workers', fallback=1)
+        threads_per_worker = config.getint('Analysis', 'senti_threads_per_worker', fallback=0)
+        shard_size = config.getint('Analysis', 'senti_shard_size', fallback=256)
+        # on-disk cache of predictions (empty: no cache)
+        cache_path = config.get('Analysis', 'senti_cache_path', fallback='') or None
+        cache_max_entries = config.getint('Analysis', 'senti_cache_max_entries', fallback=1000000)
+        # models of a running sentiment server (empty: load the models in this process)
+        server_url = config.get('Analysis', 'senti_server_url', fallback='') or None
 
         # calculate the article sentiment
         # using one or multiple of the following methods:
@@ -118,7 +225,23 @@ if __name__ == "__main__":
             output_file,
             search_words,
             methods=methods,
-            finetuned_sentibert_path=finetuned_sentibert_path
+            finetuned_sentibert_path=finetuned_sentibert_path,
+            batch_size=batch_size,
+            max_tokens=max_tokens,
+            long_articles=long_articles,
+            chunk_aggregation=chunk_aggregation,
+            keyword_context=keyword_context,
+            sentiws_batch_size=sentiws_batch_size,
+            sentiws_processes=sentiws_processes,
+            sentiws_prefilter=sentiws_prefilter,
+            backend=backend,
+            onnx_dir=onnx_dir,
+            num_workers=num_workers,
+            threads_per_worker=threads_per_worker,
+            shard_size=shard_size,
+            cache_path=cache_path,
+            cache_max_entries=cache_max_entries,
+            server_url=server_url
         )
 
     # =============================
@@ -126,11 +249,25 @@ if __name__ == "__main__":
     # =============================
     if config.getboolean("Analysis", "run_senti_eval"):
         print("\nStart Evaluation")
+        with timed_imports("sentiment analysis"):
+            from sentiment_analysis.inference import eval_sentiment
+            import_method_modules(config.get('Analysis', 'senti_methods').lower().split(", "),
+                                  config.get('Analysis', 'senti_server_url', fallback=''))
         senti_eval_input = config.get("Analysis", "senti_eval_input")
-        search_words = config.get("Analysis", "search_words").lower().split(",")
+        search_words = read_search_words(config, "Analysis")
         senti_eval_output = config.get("Analysis", "senti_eval_output")
         methods = config.get('Analysis', 'senti_methods').lower().split(", ")
         finetuned_sentibert_path = config.get('Analysis', 'finetuned_sentibert_path')
+        batch_size = config.getint('Analysis', 'bert_batch_size', fallback=32)
+        max_tokens = config.getint('Analysis', 'bert_max_tokens', fallback=0) or None
+        sentiws_batch_size = config.getint('Analysis', 'sentiws_batch_size', fallback=64)
+        sentiws_processes = config.getint('Analysis', 'sentiws_processes', fallback=1)
+        sentiws_prefilter = config.getboolean('Analysis', 'sentiws_prefilter', fallback=False)
+        backend = config.get('Analysis', 'bert_backend', fallback='torch')
+        onnx_dir = config.get('Analysis', 'bert_onnx_dir', fallback='data/onnx')
+        cache_path = config.get('Analysis', 'senti_cache_path', fallback='') or None
+        cache_max_entries = config.getint('Analysis', 'senti_cache_max_entries', fallback=1000000)
+        server_url = config.get('Analysis', 'senti_server_url', fallback='') or None
 
         # Perform quantitative evaluation of sentiment analysis approaches
         # using one or multiple of the following methods:
@@ -144,7 +281,17 @@ if __name__ == "__main__":
             senti_eval_output,
             search_words,
             methods=methods,
-            finetuned_sentibert_path=finetuned_sentibert_path
+            finetuned_sentibert_path=finetuned_sentibert_path,
+            batch_size=batch_size,
+            max_tokens=max_tokens,
+            sentiws_batch_size=sentiws_batch_size,
+            sentiws_processes=sentiws_processes,
+            sentiws_prefilter=sentiws_prefilter,
+            backend=backend,
+            onnx_dir=onnx_dir,
+            cache_path=cache_path,
+            cache_max_entries=cache_max_entries,
+            server_url=server_url
         )
 
     # ==================
@@ -152,6 +299,10 @@ if __name__ == "__main__":
     # ==================
     if config.getboolean("Plotting", "sentiment_plot"):
         input_file = config.get("Plotting", "input_file")
+        with timed_imports("plotting"):
+            from visualization.dash_plot import dash_plot
+        # the dash server runs until it is stopped, so the report is printed before
+        print_timing_report()
         dash_plot(input_file)
 
     # ==================
@@ -164,4 +315,9 @@ if __name__ == "__main__":
         column_values = config.get("WordClouds", "column_values").lower().split(", ")
         number_of_words_in_wordcloud = config.getint("WordClouds", "number_of_words_in_wordcloud")
 
-        generate_word_clouds(input_file, words, column_values, output_path, number_of_words_in_wordcloud)
\ No newline at end of file
+        with timed_imports("word clouds"):
+            from visualization.wordcloud import generate_word_clouds
+        generate_word_clouds(input_file, words, column_values, output_path, number_of_words_in_wordcloud)
+
+    if not config.getboolean("Plotting", "sentiment_plot"):
+        print_timing_report()
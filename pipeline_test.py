@@ -1,8 +1,31 @@
 import unittest
 import sentiment_analysis.sentiment_dictionary as sd
 import article_selection.article_selection as arts
+import pipeline
 import sentiment_analysis.bert as bert
+import sentiment_analysis.inference as inference
+from sentiment_analysis.prediction_cache import PredictionCache, cache_key
+from sentiment_analysis.keyword_windows import keyword_windows, split_sentences
+from sentiment_analysis.server import DynamicBatcher, SentimentClient, SentimentServer
+from sentiment_analysis.text_normalization import normalize_text
+import sentiment_analysis.benchmark_text_normalization as benchmark
+import article_selection.benchmark_keyword_matching as keyword_benchmark
+from article_selection.jsonl import JsonlArticleWriter, iter_jsonl
+from article_selection.ngram_index import NgramIndex
+from scraping.article_store import SegmentArchive
+from scraping.html_cache import HtmlCache
+from scraping.metrics import ScrapeMetrics, serve_metrics
+import scraping.scraping as scraping
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import configparser
+import functools
+import json
 import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
 
 class TestSentimentDictionary(unittest.TestCase):
     def test_wrong_input(self):
@@ -16,11 +39,324 @@ class TestSentimentDictionary(unittest.TestCase):
     def test_running(self):
         sd.test()
 
+    def test_batch(self):
+        texts = ["Flüchtlinge nehmen uns die Arbeitsplätze weg.", "Wir schaffen das!",
+                 "Flüchtlinge sind schlecht!", "Flüchtlinge sind nicht schlecht!"]
+        # same polarities in input order, texts without search terms are 0
+        self.assertEqual(list(sd.analyse_sentiment_batch(texts, ["flüchtlinge"], batch_size=2)),
+                         [sd.analyse_sentiment(text, ["flüchtlinge"]) for text in texts])
+        self.assertRaises(TypeError, list, sd.analyse_sentiment_batch([3], ["c"]))
+
+    def test_prefilter(self):
+        text = ("Das Wetter war am Wochenende sonnig. Die Stadt ist gut vorbereitet. "
+                "Flüchtlinge sind nicht schlecht! Die Unterkünfte sind neu. Am Abend regnete es.")
+        passages = sd.SentimentDictionary.getInstance().keyword_passages(text, ["flüchtling"])
+        # only the keyword sentence and its neighbours are parsed
+        self.assertEqual(passages, ["Die Stadt ist gut vorbereitet. Flüchtlinge sind nicht schlecht! "
+                                    "Die Unterkünfte sind neu."])
+        for search_terms in [["flüchtling"], [" flüchtling"]]:
+            self.assertEqual(sd.analyse_sentiment(text, search_terms, prefilter=True),
+                             sd.analyse_sentiment(text, search_terms))
+
 
 class TestSentimentBert(unittest.TestCase):
     def test_running(self):
         bert.test()
 
+    def test_length_buckets(self):
+        lengths = [5, 300, 7, 12, 290, 6]
+        buckets = list(bert.length_buckets(lengths, batch_size=2, max_tokens=500))
+        # similar lengths are batched together, every index is used once
+        self.assertEqual(buckets, [[0, 5], [2, 3], [4], [1]])
+        self.assertEqual(list(bert.length_buckets(lengths, batch_size=4)), [[0, 5, 2, 3], [4, 1]])
+
+    def test_bucketed_prediction_order(self):
+        model = bert.GSBertPolarityModel()
+        texts = ["Ich mag dich sehr.", "Du hirnloser Vollidiot! " * 20, "Dieser Satz ist relativ neutral."]
+        single = [model.analyse_sentiment(text) for text in texts]
+        bucketed = model.predict_sentiment_bucketed(texts, batch_size=2)
+        for s, b in zip(single, bucketed):
+            self.assertAlmostEqual(s, b, places=4)
+
+    def test_chunked_prediction(self):
+        model = bert.GSBertPolarityModel()
+        long_text = "Die Stadt hat heute neue Unterkünfte für Flüchtlinge eröffnet. " * 200
+        windows = model.encode_windows(["Ich mag dich sehr.", long_text])
+        self.assertEqual(len(windows[0]), 1)
+        self.assertGreater(len(windows[1]), 1)
+        # short texts are scored like in the truncating mode
+        self.assertAlmostEqual(model.predict_sentiment_chunked(["Ich mag dich sehr."])[0],
+                               model.analyse_sentiment("Ich mag dich sehr."), places=4)
+        polarities = model.predict_sentiment_chunked(["Ich mag dich sehr.", long_text],
+                                                     aggregation="keywords", keywords=["flücht"])
+        self.assertEqual(len(polarities), 2)
+
+    def test_sharded_scoring(self):
+        articles = [(f"https://www.example.de/{i}", {"text": "Ich mag dich sehr. " * (i % 5 + 1)}) for i in range(10)]
+        methods = ["generic_sentibert"]
+        expected = inference.score_articles([(url, dict(article)) for url, article in articles], [], methods,
+                                            inference.init_bert_scorer(methods, ""))
+        sharded = list(inference.score_articles_sharded(articles, [], methods, "", num_workers=2, shard_size=3))
+        # the shards are merged in input order
+        self.assertEqual([url for url, _ in sharded], [url for url, _ in articles])
+        for (_, e), (_, s) in zip(expected, sharded):
+            self.assertAlmostEqual(e["sentiment_generic_sentibert"], s["sentiment_generic_sentibert"], places=4)
+        # by default the cores are divided among the workers
+        self.assertEqual(inference.worker_threads(2, 3), 3)
+        self.assertEqual(inference.worker_threads(os.cpu_count(), 0), 1)
+        self.assertEqual(inference.worker_threads(2 * os.cpu_count(), 0), 1)
+
+    def test_sentiment_server(self):
+        texts = ["Ich mag dich sehr.", "Du hirnloser Vollidiot!", "Dieser Satz ist relativ neutral."]
+        methods = ["generic_sentibert"]
+        sentiment_server = SentimentServer(methods, "")
+        server = sentiment_server.serve(0)
+        try:
+            client = SentimentClient(f"http://127.0.0.1:{server.server_address[1]}")
+            self.assertEqual(client.revisions, sentiment_server.bert_scorer.revisions)
+            self.assertRaises(ValueError, SentimentClient, client.url, ["finetuned_sentibert"])
+            # concurrent single text requests are scored in one batch
+            batcher = DynamicBatcher(sentiment_server.predict, start=False)
+            results = [None] * len(texts)
+
+            def request(i):
+                results[i] = batcher.submit([texts[i]], ("truncate", False))["generic_sentibert"][0]
+
+            threads = [threading.Thread(target=request, args=(i,)) for i in range(len(texts))]
+            for thread in threads:
+                thread.start()
+            while batcher.queue.qsize() < len(texts):
+                time.sleep(0.01)
+            batcher.start()
+            for thread in threads:
+                thread.join()
+            batcher.stop()
+            self.assertEqual(batcher.num_batches, 1)
+            expected = inference.init_bert_scorer(methods, "").predict_sentiment_bucketed(texts)
+            for e, r in zip(expected["generic_sentibert"], results):
+                self.assertAlmostEqual(e, r, places=4)
+            for e, r in zip(expected["generic_sentibert"], client.predict_sentiment_bucketed(texts)["generic_sentibert"]):
+                self.assertAlmostEqual(e, r, places=4)
+            # malformed requests are rejected before they are merged with other requests
+            for body in [{"texts": "abc", "options": ["truncate", False]},
+                         {"texts": [1, None], "options": ["truncate", False]},
+                         {"texts": ["abc"]}]:
+                request = urllib.request.Request(f"{client.url}/predict", data=json.dumps(body).encode("utf-8"))
+                with self.assertRaises(urllib.error.HTTPError) as context:
+                    urllib.request.urlopen(request)
+                self.assertEqual(context.exception.code, 400)
+            articles = [(str(i), {"text": text}) for i, text in enumerate(texts)]
+            scored = inference.score_articles(articles, [], methods, client, client=client)
+            self.assertEqual([article["sentiment_generic_sentibert"] for _, article in scored],
+                             client.predict_sentiment_bucketed(texts)["generic_sentibert"])
+        finally:
+            server.shutdown()
+            server.server_close()
+            sentiment_server.batcher.stop()
+
+    def test_keyword_windows(self):
+        model = bert.GSBertPolarityModel()
+        filler = "Das Wetter war am Wochenende sonnig und warm. " * 60
+        text = filler + "Die Stadt hat neue Unterkünfte für Flüchtlinge eröffnet. " + filler
+        windows = model.encode_keyword_windows([text, "Ich mag dich sehr."], ["flüchtling"], context=0)
+        # only the keyword sentence is tokenized, texts without keywords are scored completely
+        self.assertEqual(len(windows[0]), 1)
+        self.assertLess(len(windows[0][0]), len(model.encode([text])[0]) / 5)
+        self.assertEqual(windows[1], model.encode(["Ich mag dich sehr."]))
+        polarities = model.predict_sentiment_keywords([text], ["flüchtling"], context=0)
+        self.assertAlmostEqual(polarities[0],
+                               model.analyse_sentiment("Die Stadt hat neue Unterkünfte für Flüchtlinge eröffnet."),
+                               places=4)
+        # repeated boilerplate windows are scored once
+        boilerplate = "Alle Artikel zum Thema Flüchtlinge finden Sie hier."
+        texts = [f"Am {i}. Tag war das Wetter sonnig. {boilerplate}" for i in range(1, 6)]
+        scored = []
+        predict_padded = model.predict_padded
+
+        def counting_predict_padded(padded):
+            scored.append(len(padded["input_ids"]))
+            return predict_padded(padded)
+
+        model.predict_padded = counting_predict_padded
+        polarities = model.predict_sentiment_keywords(texts, ["flüchtling"], context=0)
+        self.assertEqual(sum(scored), 1)
+        for polarity in polarities:
+            self.assertAlmostEqual(polarity, model.analyse_sentiment(boilerplate), places=4)
+
+    def test_quantized_backend(self):
+        texts = ["Ich mag dich sehr.", "Du hirnloser Vollidiot!", "Dieser Satz ist relativ neutral."]
+        reference = bert.GSBertPolarityModel().predict_sentiment_bucketed(texts)
+        quantized = bert.GSBertPolarityModel(backend="quantized").predict_sentiment_bucketed(texts)
+        for r, q in zip(reference, quantized):
+            self.assertAlmostEqual(r, q, delta=0.2)
+
+    @unittest.skipIf(bert.onnxruntime is None, "onnxruntime is not installed")
+    def test_onnx_backend(self):
+        texts = ["Ich mag dich sehr.", "Du hirnloser Vollidiot!", "Dieser Satz ist relativ neutral."]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bert.export_onnx("oliverguhr/german-sentiment-bert", tmp_dir)
+            onnx_model = bert.GSBertPolarityModel(backend="onnx", onnx_dir=tmp_dir)
+            onnx_polarities = onnx_model.predict_sentiment_bucketed(texts, batch_size=2)
+        for r, o in zip(bert.GSBertPolarityModel().predict_sentiment_bucketed(texts), onnx_polarities):
+            self.assertAlmostEqual(r, o, places=3)
+
+    def test_multi_model_scorer(self):
+        model_names = {"generic": "oliverguhr/german-sentiment-bert",
+                       "finetuned": "mdraw/german-news-sentiment-bert"}
+        scorer = bert.MultiModelPolarityScorer(model_names)
+        texts = ["Ich mag dich sehr.", "Du hirnloser Vollidiot!", "Dieser Satz ist relativ neutral."]
+        polarities = scorer.predict_sentiment_bucketed(texts, batch_size=2)
+        for name, model_name in model_names.items():
+            single = bert.GSBertPolarityModel(model_name).predict_sentiment_bucketed(texts)
+            for s, m in zip(single, polarities[name]):
+                self.assertAlmostEqual(s, m, places=4)
+
+
+class TestKeywordWindows(unittest.TestCase):
+    def test_split_sentences(self):
+        text = ('Am 3. Oktober sagte Dr. Müller: "Wir schaffen das." Die Flüchtlinge kamen z.B. aus Syrien.\n'
+                'Eine Zeile ohne Punkt\nA. Merkel sprach über Migration... und Integration. Ende.')
+        self.assertEqual(split_sentences(text), [
+            'Am 3. Oktober sagte Dr. Müller: "Wir schaffen das."',
+            'Die Flüchtlinge kamen z.B. aus Syrien.',
+            'Eine Zeile ohne Punkt',
+            'A. Merkel sprach über Migration... und Integration.',
+            'Ende.',
+        ])
+
+    def test_keyword_windows(self):
+        text = "Eins. Flüchtlinge zwei. Drei. Vier. Fünf. Migration sechs. Sieben."
+        self.assertEqual(keyword_windows(text, ["flücht", "migra"], context=0),
+                         ["Flüchtlinge zwei.", "Migration sechs."])
+        # overlapping context windows are merged
+        self.assertEqual(keyword_windows(text, ["flücht", "migra"], context=1),
+                         ["Eins. Flüchtlinge zwei. Drei.", "Fünf. Migration sechs. Sieben."])
+        self.assertEqual(keyword_windows(text, ["flücht", "migra"], context=2),
+                         ["Eins. Flüchtlinge zwei. Drei. Vier. Fünf. Migration sechs. Sieben."])
+        self.assertEqual(keyword_windows(text, ["asyl"]), [])
+
+    def test_sentence_initial_keyword(self):
+        config = configparser.ConfigParser()
+        config.read_string("[Analysis]\nsearch_words = flüchtling, asyl\n")
+        # the spaces after the commas are not part of the search words
+        search_words = pipeline.read_search_words(config, "Analysis")
+        self.assertEqual(search_words, ["flüchtling", "asyl"])
+        text = "Asyl wurde gewährt. Das Wetter war schön. Flüchtlinge kamen an."
+        self.assertEqual(keyword_windows(text, search_words, context=0), ["Asyl wurde gewährt.", "Flüchtlinge kamen an."])
+
+
+class TestDynamicBatcher(unittest.TestCase):
+    def test_merges_concurrent_requests(self):
+        batches = []
+
+        def predict(texts, options):
+            batches.append(list(texts))
+            return {"length": [len(text) for text in texts]}
+
+        batcher = DynamicBatcher(predict, start=False)
+        results = {}
+        threads = [threading.Thread(target=lambda t=text: results.update({t: batcher.submit([t], ("truncate",))}))
+                   for text in ["a", "bb", "ccc"]]
+        for thread in threads:
+            thread.start()
+        while batcher.queue.qsize() < len(threads):
+            time.sleep(0.01)
+        batcher.start()
+        for thread in threads:
+            thread.join()
+        batcher.stop()
+        # requests that are waiting when a batch starts are scored together
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(results, {"a": {"length": [1]}, "bb": {"length": [2]}, "ccc": {"length": [3]}})
+
+    def test_error_isolation(self):
+        def predict(texts, options):
+            if not all(isinstance(text, str) for text in texts):
+                raise TypeError("texts must be strings")
+            return {"length": [len(text) for text in texts]}
+
+        batcher = DynamicBatcher(predict, start=False)
+        results = {}
+
+        def request(texts):
+            try:
+                results[texts[0]] = batcher.submit(texts, ("truncate",))
+            except TypeError as e:
+                results[texts[0]] = e
+
+        threads = [threading.Thread(target=request, args=(texts,)) for texts in [["ab"], [None], ["abcd"]]]
+        for thread in threads:
+            thread.start()
+        while batcher.queue.qsize() < len(threads):
+            time.sleep(0.01)
+        batcher.start()
+        for thread in threads:
+            thread.join()
+        batcher.stop()
+        # the failing request does not take down the requests it was merged with
+        self.assertEqual(results["ab"], {"length": [2]})
+        self.assertEqual(results["abcd"], {"length": [4]})
+        self.assertIsInstance(results[None], TypeError)
+
+
+class TestTextNormalization(unittest.TestCase):
+    def test_equivalence(self):
+        # raises an AssertionError if the output differs from the original cleaning
+        benchmark.check_equivalence(benchmark.generated_texts(num_texts=20))
+        self.assertEqual(normalize_text("Am 3.10. @welt: https://welt.de/x Flüchtlinge\nÜBER"),
+                         "am drei eins null flüchtlinge über")
+
+
+class TestPredictionCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with PredictionCache(os.path.join(tmp_dir, "cache.sqlite"), max_entries=2) as cache:
+                cache.put_many({"a": 0.5, "b": float("nan")})
+                self.assertEqual(cache.get_many(["a"]), {"a": 0.5})  # a is now used more recently than b
+                cache.put_many({"c": -0.5})
+                found = cache.get_many(["a", "b", "c"])
+                self.assertEqual(found, {"a": 0.5, "c": -0.5})
+                self.assertEqual(len(cache), 2)
+
+    def test_cached_polarities(self):
+        calls = []
+
+        def predict(texts):
+            calls.append(texts)
+            return {"length": [float(len(text)) for text in texts]}
+
+        texts = ["Wir schaffen das!", "Impressum", "Wir schaffen das!"]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with PredictionCache(os.path.join(tmp_dir, "cache.sqlite")) as cache:
+                keys = {"length": [cache_key("length", "v1", [], text) for text in texts]}
+                self.assertEqual(inference.cached_polarities(texts, keys, predict, cache), {"length": [17.0, 9.0, 17.0]})
+                # repeated texts are predicted once, the second call only uses the cache
+                self.assertEqual(inference.cached_polarities(texts, keys, predict, cache), {"length": [17.0, 9.0, 17.0]})
+                self.assertEqual(calls, [["Wir schaffen das!", "Impressum"]])
+
+    def test_keyword_cache_keys(self):
+        class Scorer:
+            revisions = {"length": "v1"}
+
+            def __init__(self):
+                self.calls = []
+
+            def predict_sentiment_keywords(self, texts, keywords, context, batch_size, max_tokens, show_progress):
+                self.calls.append((list(keywords), context))
+                return {"length": [float(len(text) + context) for text in texts]}
+
+        texts = ["Wir schaffen das! Asyl ist ein Grundrecht."]
+        scorer = Scorer()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with PredictionCache(os.path.join(tmp_dir, "cache.sqlite")) as cache:
+                for keywords, context in [(["asyl", "flücht"], 0), (["flücht", "asyl"], 0), (["asyl", "flücht"], 1),
+                                          (["asyl"], 1)]:
+                    polarities = inference.bert_polarities(scorer, texts, keywords, cache, long_articles="keywords",
+                                                           keyword_context=context)
+                    self.assertEqual(polarities, {"length": [float(len(texts[0]) + context)]})
+        # another context or other keywords are predicted again, the order of the keywords does not matter
+        self.assertEqual(scorer.calls, [(["asyl", "flücht"], 0), (["asyl", "flücht"], 1), (["asyl"], 1)])
+
 
 class TestArticleSelection(unittest.TestCase):
     def test_wrong_input_is_topic_relevant(self):
@@ -59,6 +395,28 @@ class TestArticleSelection(unittest.TestCase):
         self.assertEqual(arts.is_topic_relevant(article_missing_text,valid_list),False)
         self.assertEqual(arts.is_topic_relevant(article_missing_url,valid_list),False)
 
+    def test_select_relevant(self):
+        articles = {
+            'a': {'date':'01.01.2020','title':"Flüchtlinge",'text':"Asylrecht", 'url':"http//a.de"},
+            'b': {'date':'01.01.2020','title':"title",'text':"texttext", 'url':"http//b.de"},
+            'c': {'date':'01.01.2020','title':"Asyl",'text':"text", 'url':"http//c.de", 'news_keywords':"sport"},
+            'd': {'title':"Asyl",'text':"text", 'url':"http//d.de"},
+        }
+        keywords = ["flücht", "flüchtling", "asyl"]
+        # overlapping keywords are all reported, uppercase text is matched
+        self.assertEqual(arts.select_relevant(articles, keywords), {'a': ["asyl", "flücht", "flüchtling"]})
+        # batch and single article selection agree
+        for key, article in articles.items():
+            self.assertEqual(key in arts.select_relevant(articles, keywords),
+                             arts.is_topic_relevant(article, keywords))
+
+    def test_keyword_matching_equivalence(self):
+        # same results as the original selection, also for a keyword spanning the end of the title
+        # and the beginning of the text, which are searched as one string
+        keyword_benchmark.check_equivalence(keyword_benchmark.generated_articles(num_articles=30))
+        article = {'date':'01.01.2020','title':"Die Mig",'text':"ration", 'url':"http//a.de"}
+        self.assertTrue(arts.is_topic_relevant(article, ["migra"]))
+
     def test_wrong_input_write_relevant_content_to_file(self):
         # Test: should run without error 
         # file list with articles in wrong format
@@ -68,5 +426,347 @@ class TestArticleSelection(unittest.TestCase):
         arts.write_relevant_content_to_file(file_list, relevant_articles_base, search_keywords)
         os.system("rm base_evaluation.json")
 
+    def test_parallel_selection(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_list = []
+            for i in range(20):
+                file_list.append(os.path.join(tmp_dir, f"{i}.json"))
+                text = "Asylrecht" if i % 3 else "texttext"
+                with open(file_list[-1], "w") as f:
+                    json.dump({'date':'01.01.2020','title':"title",'text':text, 'url':f"http//a.de/{i}"}, f)
+            outputs = []
+            for num_workers in [1, 2]:
+                base = os.path.join(tmp_dir, f"relevant_{num_workers}")
+                arts.write_relevant_content_to_file(file_list, base, ["asyl"], new=True, annotation=True,
+                                                    training_size=6, num_workers=num_workers, chunk_size=4)
+                output = {}
+                for name in ["evaluation", "annotation_simon", "annotation_josephine", "annotation_martin"]:
+                    with open(f"{base}_{name}.json") as f:
+                        output[name] = list(json.load(f).items())
+                outputs.append(output)
+            # same articles in the same order and the same seeded annotation split
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertEqual(sum(len(articles) for articles in outputs[0].values()), 13)
+
+    def test_selection_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest_path = os.path.join(tmp_dir, "manifest.json")
+            input_file = os.path.join(tmp_dir, "article.json")
+            with open(input_file, "w") as f:
+                f.write("{}")
+            manifest = arts.SelectionManifest(manifest_path, ["asyl"])
+            self.assertEqual(manifest.pending([input_file]), [input_file])
+            manifest.mark_processed()
+            manifest.save()
+            # unchanged files are skipped
+            self.assertEqual(arts.SelectionManifest(manifest_path, ["asyl"]).pending([input_file]), [])
+            # other keywords invalidate the manifest
+            manifest = arts.SelectionManifest(manifest_path, ["migra"])
+            self.assertTrue(manifest.invalidated)
+            self.assertEqual(manifest.pending([input_file]), [input_file])
+
+    def test_ngram_index_candidates(self):
+        texts = ["Schutzsuchende an der Grenze", "Abschiebung abgelehnt", "Fußball am Sonntag"]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_list = []
+            for i, text in enumerate(texts):
+                file_list.append(os.path.join(tmp_dir, f"{i}.json"))
+                with open(file_list[-1], "w") as f:
+                    json.dump({'date':'01.01.2020','title':"title",'text':text, 'url':f"http//a.de/{i}"}, f)
+            index = NgramIndex.build(os.path.join(tmp_dir, "index"), file_list)
+            self.assertTrue(index.is_up_to_date(file_list))
+            for keywords in [["schutzsuch"], ["abschieb", "grenz"], ["handball"], ["am"]]:
+                candidates = index.candidates(keywords)
+                # every relevant article is a candidate
+                self.assertEqual(list(arts.load_relevant_articles(candidates, keywords)),
+                                 list(arts.load_relevant_articles(file_list, keywords)))
+            self.assertEqual(index.candidates(["abschieb"]), [file_list[1]])
+
+
+class TestJsonlArticleWriter(unittest.TestCase):
+    def test_append_and_dedup(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "articles.jsonl")
+            with JsonlArticleWriter(path, new=True) as writer:
+                self.assertEqual(writer.update({"a": {"text": "1"}, "b": {"text": "2"}}), 2)
+            # an interrupted write leaves an incomplete line behind
+            with open(path, "a", encoding="utf-8") as f:
+                f.write('{"text": "3", "_ke')
+            with JsonlArticleWriter(path) as writer:
+                # already stored keys are skipped
+                self.assertEqual(writer.update({"b": {"text": "2"}, "c": {"text": "3"}}), 1)
+            self.assertEqual(list(iter_jsonl(path)),
+                             [("a", {"text": "1"}), ("b", {"text": "2"}), ("c", {"text": "3"})])
+
+            # the key index is rebuilt if it is missing
+            os.remove(path + ".keys")
+            with JsonlArticleWriter(path) as writer:
+                self.assertEqual(len(writer), 3)
+
+    def test_index_backed_by_records(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "articles.jsonl")
+            with JsonlArticleWriter(path, new=True) as writer:
+                for i in range(300):
+                    writer.write(f"https://www.example.de/{i:04d}" * 4, {"text": "x" * (i % 50)})
+                    # a process killed at any point leaves no key in the index without a complete record
+                    with open(path + ".keys", encoding="utf-8") as f:
+                        indexed = [line.rstrip("\n") for line in f]
+                    with open(path, encoding="utf-8") as f:
+                        stored = {json.loads(line)["_key"] for line in f if line.endswith("\n")}
+                    self.assertLessEqual(set(indexed), stored)
+
+
+
+class TestSegmentArchive(unittest.TestCase):
+    def test_put_get_scan(self):
+        articles = {f"http//a.de/{i}": {'title': "title", 'text': "text" * i, 'url': f"http//a.de/{i}"}
+                    for i in range(50)}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # small segments to test the switch to new segment files
+            with SegmentArchive(tmp_dir, max_segment_size=500) as archive:
+                for url, article in articles.items():
+                    self.assertTrue(archive.put(url, article))
+                self.assertFalse(archive.put("http//a.de/3", {}))
+                self.assertGreater(len(archive.segment_paths()), 1)
+            with SegmentArchive(tmp_dir) as archive:
+                self.assertEqual(archive.get("http//a.de/42"), articles["http//a.de/42"])
+                self.assertIsNone(archive.get("http//b.de"))
+                self.assertEqual(dict(archive), articles)
+
+    def test_interrupted_index_write(self):
+        article = {'title': "title", 'text': "text", 'url': "http//a.de/1"}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with SegmentArchive(tmp_dir) as archive:
+                archive.put("http//a.de/0", article)
+                archive.put("http//a.de/1", article)
+            # the process was killed while writing the length field of the last index line
+            index_path = os.path.join(tmp_dir, "index.tsv")
+            with open(index_path, "rb+") as f:
+                f.truncate(os.path.getsize(index_path) - 3)
+            with SegmentArchive(tmp_dir) as archive:
+                self.assertNotIn("http//a.de/1", archive)
+                self.assertTrue(archive.put("http//a.de/1", article))
+                self.assertTrue(archive.put("http//a.de/2", article))
+            with SegmentArchive(tmp_dir) as archive:
+                self.assertEqual(len(archive), 3)
+                self.assertEqual(archive.get("http//a.de/1"), article)
+                # the record of the interrupted write was dropped, so no article is stored twice
+                self.assertEqual([url for url, _ in archive], ["http//a.de/0", "http//a.de/1", "http//a.de/2"])
+
+
+
+CANNED_ARTICLE = ("<html><head><title>Flüchtlinge in Heidelberg</title></head><body><article>"
+                  + "<p>Die Stadt hat heute neue Unterkünfte für Flüchtlinge eröffnet.</p>" * 5
+                  + "</article></body></html>").encode("utf-8")
+
+
+class CannedArticleHandler(BaseHTTPRequestHandler):
+    """Local stand-in for news sites: serves the same article for every URL except /missing"""
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def do_GET(self):
+        body = b"" if self.path.startswith("/missing") else CANNED_ARTICLE
+        self.send_response(404 if self.path.startswith("/missing") else 200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThrottlingHandler(CannedArticleHandler):
+    """Counts concurrent requests and answers the first request of /throttled with HTTP 429"""
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+    throttled = 0
+
+    def do_GET(self):
+        cls = ThrottlingHandler
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+            throttle = self.path.startswith("/throttled") and cls.throttled == 0
+            cls.throttled += throttle
+        try:
+            time.sleep(0.05)
+            if throttle:
+                self.send_response(429)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                super().do_GET()
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+
+class TestScraping(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), CannedArticleHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.sources = [scraping.ArticleSource(url=f"{base_url}/article{i}", date="2015-01-01")
+                        for i in range(10)]
+        self.sources.append(scraping.ArticleSource(url=f"{base_url}/missing", date="2015-01-01"))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_async_scraping(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            scraping.scrape_and_store_articles_async(self.sources, tmp_dir, max_in_flight=4, num_workers=2)
+            # 10 articles and the journal
+            self.assertEqual(len(os.listdir(tmp_dir)), 11)
+            with open(os.path.join(tmp_dir, scraping.filename_from_url(self.sources[0].url))) as f:
+                article = json.load(f)
+            self.assertEqual(article["title"], "Flüchtlinge in Heidelberg")
+            self.assertEqual(article["date"], "2015-01-01")
+
+    def test_pipelined_scraping(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            scraping.scrape_and_store_articles_pipelined(self.sources, tmp_dir, download_workers=4, parse_workers=2,
+                                                         queue_size=2)
+            self.assertEqual(sorted(os.listdir(tmp_dir)),
+                             sorted([scraping.filename_from_url(s.url) for s in self.sources[:-1]]
+                                    + ["scrape_journal.tsv"]))
+
+    def test_scrape_metrics(self):
+        metrics = ScrapeMetrics()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            scraping.scrape_and_store_articles_pipelined(self.sources, tmp_dir, download_workers=2, parse_workers=1,
+                                                         metrics=metrics)
+        server = serve_metrics(metrics, 0)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}") as response:
+                snapshot = json.load(response)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(snapshot["articles"], 10)
+        self.assertEqual(snapshot["error_classes"], {"HTTP404": 1})
+        self.assertEqual(snapshot["bytes_downloaded"], 10 * len(CANNED_ARTICLE.decode("utf-8")))
+        domain = snapshot["domains"][f"127.0.0.1:{self.server.server_address[1]}"]
+        self.assertEqual(sum(domain["latency"]["buckets"].values()), 11)
+
+    def test_iter_sources(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, "2015.txt"), os.path.join(tmp_dir, "2016.txt")]
+            with open(paths[0], "w") as f:
+                f.write("1\thttp://a.de/1\t2015-01-01\n2\tmalformed\n3\thttp://a.de/2\t2015-01-02\n")
+            with open(paths[1], "w") as f:
+                f.write("1\thttp://a.de/2\t2016-01-01\n2\thttp://a.de/3\t2016-01-02\n")
+            # malformed lines are skipped, duplicates are only read the first time
+            self.assertEqual(list(scraping.iter_sources(paths)),
+                             [scraping.ArticleSource("http://a.de/1", "2015-01-01"),
+                              scraping.ArticleSource("http://a.de/2", "2015-01-02"),
+                              scraping.ArticleSource("http://a.de/3", "2016-01-02")])
+
+    def test_scrape_journal(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            journal_path = os.path.join(tmp_dir, "journal.tsv")
+            with scraping.ScrapeJournal(journal_path, max_attempts=2) as journal:
+                journal.record("http://a.de/1", scraping.ScrapeJournal.STORED)
+                journal.record("http://a.de/2", scraping.ScrapeJournal.NOT_FOUND, "HTTP404")
+                journal.record("http://a.de/3", scraping.ScrapeJournal.TRANSIENT, "TimeoutError")
+                journal.record("http://a.de/4", scraping.ScrapeJournal.TRANSIENT, "HTTP503")
+                journal.record("http://a.de/4", scraping.ScrapeJournal.TRANSIENT, "HTTP503")
+            with scraping.ScrapeJournal(journal_path, max_attempts=2) as journal:
+                self.assertEqual([journal.should_skip(f"http://a.de/{i}") for i in range(1, 6)],
+                                 [True, True, False, True, False])
+            with scraping.ScrapeJournal(journal_path, max_attempts=2, retry_transient_only=True) as journal:
+                self.assertEqual([journal.should_skip(f"http://a.de/{i}") for i in range(1, 6)],
+                                 [True, True, False, True, True])
+
+    def test_resume_scraping(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # sources can be a generator
+            scraping.scrape_and_store_articles(iter(self.sources), tmp_dir, multiprocessing=False, num_workers=2)
+            with scraping.ScrapeJournal(os.path.join(tmp_dir, "scrape_journal.tsv")) as journal:
+                # the missing page is not requested again
+                self.assertTrue(all(journal.should_skip(source.url) for source in self.sources))
+                self.assertEqual(journal.summary(), {})
+            with open(os.path.join(tmp_dir, "scrape_journal.tsv")) as f:
+                self.assertIn("not_found\tHTTP404\t1", f.read())
+
+    def test_html_cache_reextract(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = os.path.join(tmp_dir, "cache")
+            scraping.scrape_and_store_articles(self.sources, os.path.join(tmp_dir, "v1"), multiprocessing=False,
+                                               num_workers=2, html_cache_path=cache_path)
+            with HtmlCache(cache_path) as cache:
+                self.assertEqual(len(cache), 10)
+                self.assertEqual(cache.get(self.sources[0].url), CANNED_ARTICLE.decode("utf-8"))
+                # all pages have the same content and are stored once
+                self.assertEqual(len(set(digest for _, digest in cache)), 1)
+                self.assertEqual(len(cache.pages), 1)
+            # the pages are records of a segment file, not one file each
+            self.assertEqual(sorted(os.listdir(cache_path)), ["index.tsv", "segment-000000.seg", "urls.tsv"])
+            scraping.reextract_articles(self.sources, cache_path, os.path.join(tmp_dir, "v2"), num_workers=2)
+            for name in os.listdir(os.path.join(tmp_dir, "v1")):
+                if name.endswith(".json"):
+                    with open(os.path.join(tmp_dir, "v1", name)) as f1, open(os.path.join(tmp_dir, "v2", name)) as f2:
+                        self.assertEqual(json.load(f1), json.load(f2))
+
+    def test_html_cache_interrupted_index_write(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with HtmlCache(tmp_dir) as cache:
+                cache.put("https://www.example.de/a", "<html>a</html>")
+                cache.put("https://www.example.de/b", "<html>b</html>")
+            # the write of the last URL was interrupted
+            index_path = os.path.join(tmp_dir, "urls.tsv")
+            with open(index_path, "rb+") as f:
+                f.truncate(os.path.getsize(index_path) - 10)
+            with HtmlCache(tmp_dir) as cache:
+                self.assertEqual(len(cache), 1)
+                cache.put("https://www.example.de/c", "<html>c</html>")
+            with HtmlCache(tmp_dir) as cache:
+                self.assertEqual(sorted(url for url, _ in cache), ["https://www.example.de/a", "https://www.example.de/c"])
+                self.assertEqual(cache.get("https://www.example.de/c"), "<html>c</html>")
+                self.assertEqual(scraping.read_html(cache.ref("https://www.example.de/a")), "<html>a</html>")
+
+    def test_pool_scraping_per_domain_limit(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        sources = [scraping.ArticleSource(url=f"{base_url}/article{i}", date="2015-01-01") for i in range(8)]
+        sources.append(scraping.ArticleSource(url=f"{base_url}/throttled", date="2015-01-01"))
+        try:
+            for scrape in [functools.partial(scraping.scrape_and_store_articles, multiprocessing=False, num_workers=8),
+                           functools.partial(scraping.scrape_and_store_articles_pipelined, download_workers=8,
+                                             parse_workers=1)]:
+                ThrottlingHandler.max_active = ThrottlingHandler.throttled = 0
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    scrape(sources, tmp_dir, max_per_domain=2)
+                    # all requests go to one host, the throttled article was downloaded again after a pause
+                    self.assertLessEqual(ThrottlingHandler.max_active, 2)
+                    self.assertEqual(ThrottlingHandler.throttled, 1)
+                    self.assertEqual(len(os.listdir(tmp_dir)), len(sources) + 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_domain_scheduler(self):
+        sources = [scraping.ArticleSource(url=f"http://{domain}/{i}", date="2015-01-01")
+                   for domain in ["a.de", "b.de"] for i in range(3)]
+        scheduler = scraping.DomainScheduler(max_per_domain=2, base_delay=60)
+        for source in sources:
+            scheduler.add(source)
+        # domains are interleaved and limited to two concurrent requests
+        first = [scheduler.pop_ready() for _ in range(4)]
+        self.assertEqual([scraping.domain_of(s.url) for s in first], ["a.de", "b.de", "a.de", "b.de"])
+        self.assertIsNone(scheduler.pop_ready())
+        # a throttled request is queued again and pauses the domain
+        self.assertTrue(scheduler.done(first[0], scraping.DownloadResult(status=429), 0.1))
+        self.assertFalse(scheduler.done(first[1], scraping.DownloadResult(status=200, html=""), 0.1))
+        self.assertEqual(scraping.domain_of(scheduler.pop_ready().url), "b.de")
+        self.assertIsNone(scheduler.pop_ready())
+        self.assertEqual(scheduler.stats["a.de"].throttled, 1)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
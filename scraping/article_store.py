@@ -0,0 +1,259 @@
+"""Segment archive for storing large numbers of scraped articles.
+
+Instead of writing one JSON file per article, articles are appended as
+zlib-compressed records to a few large segment files. An append-only index
+file maps each URL to the position of its record, so single articles can be
+looked up by URL and whole archives can be scanned sequentially segment by segment.
+
+Layout of an archive directory:
+
+    segment-000000.seg   records: <url length><data length><crc32> <url> <zlib(json(article))>
+    segment-000001.seg
+    ...
+    index.tsv            one line per record: <url>\t<segment number>\t<offset>\t<record length>
+"""
+
+import json
+import os
+import struct
+import threading
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+RECORD_HEADER = struct.Struct('<III')
+SEGMENT_PATTERN = 'segment-{:06d}.seg'
+INDEX_NAME = 'index.tsv'
+DEFAULT_MAX_SEGMENT_SIZE = 256 * 1024 ** 2  # 256 MiB
+
+
+def encode_record(url: str, article: Dict[str, str], compression_level: int = 6) -> bytes:
+    url_bytes = url.encode('utf-8')
+    data = zlib.compress(json.dumps(article, ensure_ascii=False).encode('utf-8'), compression_level)
+    return RECORD_HEADER.pack(len(url_bytes), len(data), zlib.crc32(data)) + url_bytes + data
+
+
+def decode_record(record: bytes) -> Tuple[str, Dict[str, str]]:
+    url_len, data_len, crc = RECORD_HEADER.unpack_from(record)
+    start = RECORD_HEADER.size
+    url = record[start:start + url_len].decode('utf-8')
+    data = record[start + url_len:start + url_len + data_len]
+    if len(data) != data_len or zlib.crc32(data) != crc:
+        raise ValueError(f'Corrupt record for {url}')
+    return url, json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def iter_segment_records(path: str) -> Iterator[Tuple[int, str, Dict[str, str]]]:
+    """Sequentially read all (offset, url, article) records of a segment file.
+
+    Stops at an incomplete record at the end of the file, which can be left
+    behind if the writing process was killed."""
+    with open(path, 'rb') as f:
+        while True:
+            offset = f.tell()
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            url_len, data_len, _ = RECORD_HEADER.unpack(header)
+            body = f.read(url_len + data_len)
+            if len(body) < url_len + data_len:
+                return
+            yield (offset, *decode_record(header + body))
+
+
+def iter_segment(path: str) -> Iterator[Tuple[str, Dict[str, str]]]:
+    """Sequentially read all (url, article) records of a segment file"""
+    for _, url, article in iter_segment_records(path):
+        yield url, article
+
+
+def read_record_at(path: str, offset: int) -> Tuple[str, Dict[str, str]]:
+    """Read the (url, article) record starting at offset of a segment file"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        header = f.read(RECORD_HEADER.size)
+        url_len, data_len, _ = RECORD_HEADER.unpack(header)
+        return decode_record(header + f.read(url_len + data_len))
+
+
+def record_ref(path: str, offset: int) -> str:
+    """String reference to a single record of a segment file: <segment path>@<offset>"""
+    return f'{path}@{offset}'
+
+
+def is_record_ref(ref: str) -> bool:
+    path, sep, offset = ref.rpartition('@')
+    return bool(sep) and is_segment(path) and offset.isdigit()
+
+
+def read_record_ref(ref: str) -> Tuple[str, Dict[str, str]]:
+    path, _, offset = ref.rpartition('@')
+    return read_record_at(path, int(offset))
+
+
+def truncate_incomplete_line(path: str) -> None:
+    """Cut off a trailing line without newline, which is left behind by an interrupted write"""
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        # search backwards for the end of the last complete line
+        while pos > 0:
+            step = min(pos, 1 << 16)
+            pos -= step
+            f.seek(pos)
+            newline = f.read(step).rfind(b'\n')
+            if newline != -1:
+                pos += newline + 1
+                break
+        if pos < end:
+            f.truncate(pos)
+
+
+def is_segment(path: str) -> bool:
+    return path.endswith('.seg')
+
+
+def segment_paths(archive_path: str) -> List[str]:
+    """Paths of all segment files of an archive in write order (without opening the archive)"""
+    archive_path = os.path.expanduser(archive_path)
+    if not os.path.isdir(archive_path):
+        return []
+    names = sorted(name for name in os.listdir(archive_path)
+                   if name.startswith('segment-') and is_segment(name))
+    return [os.path.join(archive_path, name) for name in names]
+
+
+class SegmentArchive:
+    """Append-only article store made of compressed segment files and a URL index.
+
+    Writing is thread-safe, but only one process may write to an archive at a time.
+
+        with SegmentArchive('data/ta_scrape100k_2015') as archive:
+            archive.put(url, article)
+            article = archive.get(url)
+            for url, article in archive:
+                ...
+    """
+
+    def __init__(self, path: str, max_segment_size: int = DEFAULT_MAX_SEGMENT_SIZE,
+                 compression_level: int = 6):
+        self.path = os.path.expanduser(path)
+        self.max_segment_size = max_segment_size
+        self.compression_level = compression_level
+        os.makedirs(self.path, exist_ok=True)
+        self.index_path = os.path.join(self.path, INDEX_NAME)
+        # url -> (segment number, offset, record length)
+        self.index: Dict[str, Tuple[int, int, int]] = {}
+        self._lock = threading.Lock()
+        self._readers: Dict[int, object] = {}
+        self._writer = None
+        self._index_file = None
+        self._load_index()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, SEGMENT_PATTERN.format(segment))
+
+    def _load_index(self) -> None:
+        if os.path.exists(self.index_path):
+            # Only newline terminated lines are complete. An incomplete last line is
+            # removed, otherwise the next entry would be appended to it and get lost.
+            truncate_incomplete_line(self.index_path)
+            segment_sizes = {}
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 4 or not all(field.isdigit() for field in fields[1:]):
+                        continue
+                    url, segment, offset, length = fields[0], *map(int, fields[1:])
+                    if segment not in segment_sizes:
+                        segment_path = self._segment_path(segment)
+                        segment_sizes[segment] = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+                    if offset + length > segment_sizes[segment]:
+                        continue  # the record is not (completely) in its segment
+                    self.index[url] = (segment, offset, length)
+        segments = self.segment_paths()
+        # number of the segment that new records are appended to
+        self._segment = int(os.path.basename(segments[-1])[8:-4]) if segments else 0
+        # Records are written before their index entry. Drop a record that
+        # did not make it into the index, so that both stay consistent.
+        indexed_end = max(
+            (offset + length for segment, offset, length in self.index.values()
+             if segment == self._segment),
+            default=0
+        )
+        segment_path = self._segment_path(self._segment)
+        if os.path.exists(segment_path) and os.path.getsize(segment_path) > indexed_end:
+            with open(segment_path, 'rb+') as f:
+                f.truncate(indexed_end)
+
+    def segment_paths(self) -> List[str]:
+        """Paths of all segment files in write order"""
+        return segment_paths(self.path)
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def put(self, url: str, article: Dict[str, str]) -> bool:
+        """Append an article. Returns False if the URL is already stored."""
+        record = encode_record(url, article, self.compression_level)
+        with self._lock:
+            if url in self.index:
+                return False
+            if self._writer is None:
+                self._writer = open(self._segment_path(self._segment), 'ab')
+                self._index_file = open(self.index_path, 'a', encoding='utf-8')
+            offset = self._writer.tell()
+            if offset > 0 and offset + len(record) > self.max_segment_size:
+                # start a new segment
+                self._writer.close()
+                self._segment += 1
+                self._writer = open(self._segment_path(self._segment), 'ab')
+                offset = 0
+            self._writer.write(record)
+            self._writer.flush()
+            self._index_file.write(f'{url}\t{self._segment}\t{offset}\t{len(record)}\n')
+            self._index_file.flush()
+            self.index[url] = (self._segment, offset, len(record))
+        return True
+
+    def get(self, url: str) -> Optional[Dict[str, str]]:
+        """Look up a single article by URL. Returns None if it is not stored."""
+        try:
+            segment, offset, length = self.index[url]
+        except KeyError:
+            return None
+        with self._lock:
+            if segment not in self._readers:
+                self._readers[segment] = open(self._segment_path(segment), 'rb')
+            reader = self._readers[segment]
+            reader.seek(offset)
+            record = reader.read(length)
+        return decode_record(record)[1]
+
+    def ref(self, url: str) -> Optional[str]:
+        """Record reference of the article of a URL (see read_record_ref), None if it is not stored"""
+        try:
+            segment, offset, _ = self.index[url]
+        except KeyError:
+            return None
+        return record_ref(self._segment_path(segment), offset)
+
+    def __iter__(self) -> Iterator[Tuple[str, Dict[str, str]]]:
+        """Sequential scan over all (url, article) pairs"""
+        for segment_path in self.segment_paths():
+            yield from iter_segment(segment_path)
+
+    def close(self) -> None:
+        with self._lock:
+            for f in [self._writer, self._index_file, *self._readers.values()]:
+                if f is not None:
+                    f.close()
+            self._writer, self._index_file, self._readers = None, None, {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -9,6 +9,11 @@ directory /tmp/news-articles:
 
     $ python3 collect_articles.py urls.txt /tmp/news-articles
 
+Multiple sources files (e.g. one per year) can be given at once. They are read lazily,
+malformed lines are skipped and URLs that occur more than once are only scraped once:
+
+    $ python3 collect_articles.py urls_2015.txt urls_2016.txt /tmp/news-articles
+
 
 Scraped articles are stored in JSON files with the following structure:
 
@@ -24,12 +29,60 @@ Each article is saved to its own file in the specified directory.
 File names are automatically chosen based on the respective article URLs.
 In each JSON file you can find the contents ("text"), title, publication date,
 URL and additional site-dependent metadata.
+
+For very large source lists, use --storage archive to append the articles to
+a few compressed segment files in the output directory instead (see article_store.py):
+
+    $ python3 collect_articles.py urls.txt /tmp/news-articles --storage archive
+
+With --async, the articles are downloaded with asyncio (requires aiohttp) using a pool
+of keep-alive connections and up to --max-in-flight concurrent requests, while
+--num-workers threads (or processes with -m) parse the downloaded pages:
+
+    $ python3 collect_articles.py urls.txt /tmp/news-articles --async --max-in-flight 200
+
+In all download modes, requests are interleaved across domains. Each domain gets at most
+--max-per-domain concurrent requests and is paused with exponential backoff if it responds
+with timeouts, HTTP 429 or 5xx. Per-domain throughput is logged at the end (and every
+--report-interval seconds in the asyncio mode).
+
+With --pipeline, --download-workers threads download the pages into a bounded queue
+and --num-workers processes parse them, so neither stage is limited by the other's
+worker type. Log messages of the worker processes are forwarded to the main process:
+
+    $ python3 collect_articles.py urls.txt /tmp/news-articles --pipeline --download-workers 64 -n 8
+
+The outcome of every URL (stored, not found, failed or transient error) is appended to a
+journal (--journal-path, default: <output_path>/scrape_journal.tsv). Running the same
+command again after an interruption skips stored and permanently failing URLs. Transient
+failures (timeouts, HTTP 429, 5xx) are retried up to three times; use --retry-transient-only
+to only retry these:
+
+    $ python3 collect_articles.py urls.txt /tmp/news-articles --retry-transient-only
+
+With --html-cache, the raw HTML of every downloaded page is additionally kept in a
+compressed cache (see html_cache.py). After improving the extraction, the articles can
+then be parsed again from the cache on all cores without any network access:
+
+    $ python3 collect_articles.py urls.txt /tmp/news-articles --html-cache /tmp/html-cache
+    $ python3 collect_articles.py urls.txt /tmp/news-articles-v2 --html-cache /tmp/html-cache --re-extract
+
+While scraping, live metrics (articles per second, error classes, downloaded bytes and
+per-domain latency histograms, see metrics.py) are written to <output_path>/scrape_metrics.json
+every --metrics-interval seconds. With --metrics-port they can also be fetched over HTTP:
+
+    $ python3 collect_articles.py urls.txt /tmp/news-articles --metrics-port 8765
+    $ curl -s localhost:8765
 """
 
 import argparse
+import itertools
 import logging
+import os
 
-from scraping import change_log_file_path, read_sources, scrape_and_store_articles
+from metrics import MetricsReporter, ScrapeMetrics, serve_metrics
+from scraping import (change_log_file_path, iter_sources, reextract_articles, scrape_and_store_articles,
+                      scrape_and_store_articles_async, scrape_and_store_articles_pipelined)
 
 logger = logging.getLogger('scraping')
 
@@ -37,8 +90,9 @@ logger = logging.getLogger('scraping')
 def main():
     parser = argparse.ArgumentParser(epilog=__doc__, formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument(
-        'source_path',
-        help='Path to a file containing a list of source URLs.'
+        'source_paths',
+        help='Paths to one or more files containing a list of source URLs (e.g. one per year).',
+        nargs='+'
     )
     parser.add_argument(
         'output_path',
@@ -51,7 +105,7 @@ def main():
     )
     parser.add_argument(
         '-m', '--enable-mp',
-        help='Enable multiprocessing (faster, but logging may be broken)',
+        help='Enable multiprocessing (faster)',
         action='store_true'
     )
     parser.add_argument(
@@ -59,29 +113,166 @@ def main():
         help='Number of concurrent worker processes/threads',
         type=int
     )
+    parser.add_argument(
+        '--storage',
+        help='Store each article in its own JSON file (default) or in a segment archive',
+        choices=['files', 'archive'],
+        default='files'
+    )
+    parser.add_argument(
+        '-a', '--async',
+        help='Download with asyncio and pooled connections, parse in separate workers',
+        action='store_true',
+        dest='use_async'
+    )
+    parser.add_argument(
+        '-p', '--pipeline',
+        help='Download with threads and parse with -n processes in separate pipeline stages',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--download-workers',
+        help='Number of download threads in the pipeline mode (default: 32)',
+        type=int,
+        default=32
+    )
+    parser.add_argument(
+        '--max-in-flight',
+        help='Number of concurrent requests in the asyncio download mode (default: 100)',
+        type=int,
+        default=100
+    )
+    parser.add_argument(
+        '--max-per-domain',
+        help='Number of concurrent requests per domain (default: 4)',
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        '--report-interval',
+        help='Seconds between per-domain throughput reports in the asyncio download mode (default: 600)',
+        type=float,
+        default=600.0
+    )
+    parser.add_argument(
+        '--journal-path',
+        help='Path of the journal with the outcome of every URL (default: <output_path>/scrape_journal.tsv)',
+        default=None
+    )
+    parser.add_argument(
+        '--retry-transient-only',
+        help='Only scrape URLs that failed with a transient error in previous runs',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--html-cache',
+        help='Directory of a cache for the raw HTML of all downloaded pages',
+        default=None,
+        dest='html_cache_path'
+    )
+    parser.add_argument(
+        '--re-extract',
+        help='Parse the articles from the HTML cache instead of downloading them (requires --html-cache)',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--metrics-path',
+        help='Path of the JSON file with live scraping metrics (default: <output_path>/scrape_metrics.json)',
+        default=None
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        help='Seconds between updates of the metrics file (default: 60)',
+        type=float,
+        default=60.0
+    )
+    parser.add_argument(
+        '--metrics-port',
+        help='Serve the live metrics as JSON on this port of localhost',
+        type=int,
+        default=None
+    )
     args = parser.parse_args()
+    if args.re_extract and args.html_cache_path is None:
+        parser.error('--re-extract requires --html-cache')
 
-    source_path = args.source_path
+    source_paths = args.source_paths
     output_path = args.output_path
     log_path = args.log_path
     enable_mp = args.enable_mp
     num_workers = args.num_workers
+    storage = args.storage
 
     # Set up logging: Override log file path
     change_log_file_path(log_path)
 
     # Parse site
+    # Sources are read lazily and deduplicated across all files
     logger.info('Finding articles in file...')
-    article_sources = read_sources(source_path)
-    if len(article_sources) == 0:
+    article_sources = iter_sources(source_paths)
+    first_source = next(article_sources, None)
+    if first_source is None:
         raise RuntimeError(f'No articles found. Aborting...')
-    scrape_and_store_articles(
-        article_sources,
-        parent_dir=output_path,
-        multiprocessing=enable_mp,
-        num_workers=num_workers
-    )
+    article_sources = itertools.chain([first_source], article_sources)
+    if args.re_extract:
+        reextract_articles(
+            article_sources,
+            args.html_cache_path,
+            parent_dir=output_path,
+            num_workers=num_workers,
+            storage=storage
+        )
+        return
 
+    # Live metrics: JSON snapshot every --metrics-interval seconds, optionally served on localhost
+    metrics = ScrapeMetrics()
+    os.makedirs(os.path.expanduser(output_path), exist_ok=True)
+    metrics_path = args.metrics_path or os.path.join(os.path.expanduser(output_path), 'scrape_metrics.json')
+    metrics_server = serve_metrics(metrics, args.metrics_port) if args.metrics_port else None
+    with MetricsReporter(metrics, metrics_path, args.metrics_interval):
+        if args.pipeline:
+            scrape_and_store_articles_pipelined(
+                article_sources,
+                parent_dir=output_path,
+                download_workers=args.download_workers,
+                parse_workers=num_workers,
+                storage=storage,
+                journal_path=args.journal_path,
+                retry_transient_only=args.retry_transient_only,
+                html_cache_path=args.html_cache_path,
+                metrics=metrics,
+                max_per_domain=args.max_per_domain
+            )
+        elif args.use_async:
+            scrape_and_store_articles_async(
+                article_sources,
+                parent_dir=output_path,
+                max_in_flight=args.max_in_flight,
+                multiprocessing=enable_mp,
+                num_workers=num_workers,
+                storage=storage,
+                max_per_domain=args.max_per_domain,
+                report_interval=args.report_interval,
+                journal_path=args.journal_path,
+                retry_transient_only=args.retry_transient_only,
+                html_cache_path=args.html_cache_path,
+                metrics=metrics
+            )
+        else:
+            scrape_and_store_articles(
+                article_sources,
+                parent_dir=output_path,
+                multiprocessing=enable_mp,
+                num_workers=num_workers,
+                storage=storage,
+                journal_path=args.journal_path,
+                retry_transient_only=args.retry_transient_only,
+                html_cache_path=args.html_cache_path,
+                metrics=metrics,
+                max_per_domain=args.max_per_domain
+            )
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,116 @@
+"""Content-addressed cache of raw HTML responses.
+
+The scrapers can keep the downloaded HTML of every article, so that the extraction
+(newspaper parsing) can be rerun later without downloading the pages again.
+Pages are stored as zlib-compressed records of a segment archive (see article_store.py)
+under the SHA-256 hash of their content, so identical responses (e.g. the same error
+page for many URLs) are stored once and millions of pages take a few large files
+instead of one file each. An append-only index maps each URL to the hash of its
+latest response.
+
+Layout of a cache directory:
+
+    segment-000000.seg   records: <hash> <zlib(json({"html": html}))>
+    ...
+    index.tsv            one line per record: <hash>\t<segment number>\t<offset>\t<record length>
+    urls.tsv             one line per stored response: <url>\t<hash>
+"""
+
+import hashlib
+import os
+import threading
+from typing import Dict, Iterator, Optional, Tuple
+
+try:  # imported as part of the scraping package
+    from scraping.article_store import DEFAULT_MAX_SEGMENT_SIZE, SegmentArchive, read_record_ref, \
+        truncate_incomplete_line
+except ImportError:  # run as a script from within scraping/ (see collect_articles.py)
+    from article_store import DEFAULT_MAX_SEGMENT_SIZE, SegmentArchive, read_record_ref, truncate_incomplete_line
+
+URLS_NAME = 'urls.tsv'
+
+
+def read_html(ref: str) -> str:
+    """Read the HTML of a record reference (see HtmlCache.ref) without opening the cache,
+    e.g. in worker processes"""
+    return read_record_ref(ref)[1]['html']
+
+
+class HtmlCache:
+    """URL -> raw HTML store backed by a segment archive of the compressed pages.
+
+    Writing is thread-safe, but only one process may write to a cache at a time.
+
+        with HtmlCache('data/html_cache') as cache:
+            cache.put(url, html)
+            html = cache.get(url)
+    """
+
+    def __init__(self, path: str, compression_level: int = 6,
+                 max_segment_size: int = DEFAULT_MAX_SEGMENT_SIZE):
+        self.path = os.path.expanduser(path)
+        # content hash -> page
+        self.pages = SegmentArchive(self.path, max_segment_size, compression_level)
+        self.index_path = os.path.join(self.path, URLS_NAME)
+        # url -> content hash
+        self.index: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._index_file = None
+        if os.path.exists(self.index_path):
+            # An incomplete last line of an interrupted write is removed,
+            # otherwise the next entry would be appended to it and get lost.
+            truncate_incomplete_line(self.index_path)
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 2 or fields[1] not in self.pages:
+                        continue
+                    self.index[fields[0]] = fields[1]
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def put(self, url: str, html: str) -> str:
+        """Store the HTML of a URL and return its content hash"""
+        digest = hashlib.sha256(html.encode('utf-8')).hexdigest()
+        # the page is stored before its URL, so every indexed URL has its page
+        if digest not in self.pages:
+            self.pages.put(digest, {'html': html})
+        with self._lock:
+            if self.index.get(url) != digest:
+                if self._index_file is None:
+                    self._index_file = open(self.index_path, 'a', encoding='utf-8')
+                self._index_file.write(f'{url}\t{digest}\n')
+                self._index_file.flush()
+                self.index[url] = digest
+        return digest
+
+    def get(self, url: str) -> Optional[str]:
+        """Look up the HTML of a URL. Returns None if it is not cached."""
+        digest = self.index.get(url)
+        return None if digest is None else self.pages.get(digest)['html']
+
+    def ref(self, url: str) -> Optional[str]:
+        """Record reference of the HTML of a URL for read_html, None if it is not cached"""
+        digest = self.index.get(url)
+        return None if digest is None else self.pages.ref(digest)
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        """(url, content hash) pairs of all cached responses"""
+        return iter(list(self.index.items()))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._index_file is not None:
+                self._index_file.close()
+            self._index_file = None
+        self.pages.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,185 @@
+"""Live throughput and latency metrics of a running crawl.
+
+The scrapers record every finished URL in a ScrapeMetrics object. Its snapshot
+(articles per second, outcome and error class counts, downloaded bytes and
+per-domain latency histograms) can be written periodically to a JSON file with
+MetricsReporter and served on a local HTTP port with serve_metrics:
+
+    $ curl -s localhost:8765 | python3 -m json.tool
+"""
+
+import json
+import os
+import threading
+import time
+import urllib.parse
+from bisect import bisect_left
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+RATE_WINDOW = 60.0  # seconds
+
+
+class LatencyHistogram:
+    """Counts of download latencies in the buckets LATENCY_BUCKETS"""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+
+    def add(self, latency: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.total += latency
+
+    def to_dict(self) -> Dict[str, Any]:
+        num = sum(self.counts)
+        labels = [f'<={bound}s' for bound in LATENCY_BUCKETS] + [f'>{LATENCY_BUCKETS[-1]}s']
+        return {
+            'mean': self.total / num if num else 0.0,
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+class DomainMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.stored = 0
+        self.errors = 0
+        self.num_bytes = 0
+        self.latency = LatencyHistogram()
+
+
+class ScrapeMetrics:
+    """Thread-safe counters of a crawl, filled by the scrapers via record()"""
+
+    def __init__(self, top_domains: int = 50):
+        self.top_domains = top_domains
+        self.start_time = time.time()
+        self.outcomes: Dict[str, int] = defaultdict(int)
+        self.error_classes: Dict[str, int] = defaultdict(int)
+        self.num_bytes = 0
+        self.latency = LatencyHistogram()
+        self.domains: Dict[str, DomainMetrics] = defaultdict(DomainMetrics)
+        self._recent = deque()  # times of recently stored articles
+        self._lock = threading.Lock()
+
+    def record(self, url: str, outcome: str, error: str = '',
+               latency: Optional[float] = None, num_bytes: int = 0) -> None:
+        """Record the outcome of a URL (see ScrapeJournal) with its download latency and size"""
+        now = time.time()
+        domain = urllib.parse.urlsplit(url).netloc.lower()
+        with self._lock:
+            self.outcomes[outcome] += 1
+            self.num_bytes += num_bytes
+            stats = self.domains[domain]
+            stats.requests += 1
+            stats.num_bytes += num_bytes
+            if error:
+                self.error_classes[error] += 1
+                stats.errors += 1
+            if outcome == 'stored':
+                stats.stored += 1
+                self._recent.append(now)
+            if latency is not None:
+                self.latency.add(latency)
+                stats.latency.add(latency)
+            self._trim(now)
+
+    def _trim(self, now: float) -> None:
+        while self._recent and self._recent[0] < now - RATE_WINDOW:
+            self._recent.popleft()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """JSON-serializable state of all metrics"""
+        now = time.time()
+        with self._lock:
+            self._trim(now)
+            elapsed = now - self.start_time
+            stored = self.outcomes.get('stored', 0)
+            domains = sorted(self.domains.items(), key=lambda item: item[1].requests, reverse=True)
+            return {
+                'time': now,
+                'elapsed_seconds': elapsed,
+                'articles': stored,
+                'articles_per_second': stored / elapsed if elapsed > 0 else 0.0,
+                'articles_per_second_recent': len(self._recent) / min(RATE_WINDOW, max(elapsed, 1e-9)),
+                'requests': sum(self.outcomes.values()),
+                'outcomes': dict(self.outcomes),
+                'error_classes': dict(self.error_classes),
+                'bytes_downloaded': self.num_bytes,
+                'latency': self.latency.to_dict(),
+                'num_domains': len(self.domains),
+                'domains': {
+                    domain: {
+                        'requests': stats.requests,
+                        'stored': stats.stored,
+                        'errors': stats.errors,
+                        'bytes_downloaded': stats.num_bytes,
+                        'latency': stats.latency.to_dict(),
+                    }
+                    for domain, stats in domains[:self.top_domains]
+                },
+            }
+
+
+def write_snapshot(metrics: ScrapeMetrics, path: str) -> None:
+    """Atomically replace the JSON file at path with the current snapshot"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(metrics.snapshot(), f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class MetricsReporter:
+    """Writes a snapshot of the metrics to a JSON file every interval seconds
+    (in a background thread) and once more when stopped."""
+
+    def __init__(self, metrics: ScrapeMetrics, path: str, interval: float = 60.0):
+        self.metrics = metrics
+        self.path = os.path.expanduser(path)
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            write_snapshot(self.metrics, self.path)
+
+    def start(self) -> 'MetricsReporter':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        write_snapshot(self.metrics, self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def serve_metrics(metrics: ScrapeMetrics, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """Serve the current snapshot as JSON on http://host:port/ in a background thread.
+    Call shutdown() on the returned server to stop it."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(metrics.snapshot(), indent=2).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
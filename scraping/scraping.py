@@ -1,17 +1,42 @@
 """Library for scraping news articles from websites, based on newspaper"""
 
+import asyncio
+import contextlib
 import csv
 import functools
+import hashlib
 import json
 import logging
+import logging.handlers
+import multiprocessing as mp
 import os
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import queue
+import re
+import threading
+import time
+import urllib.parse
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from dataclasses import dataclass
-from typing import Any, Dict, Optional, Sequence
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
 
 import newspaper
 from tqdm import tqdm
 
+try:
+    import aiohttp
+except ImportError:  # only required for the asyncio download mode
+    aiohttp = None
+
+try:  # imported as part of the scraping package
+    from scraping.article_store import SegmentArchive
+    from scraping.html_cache import HtmlCache, read_html
+    from scraping.metrics import ScrapeMetrics
+except ImportError:  # run as a script from within scraping/ (see collect_articles.py)
+    from article_store import SegmentArchive
+    from html_cache import HtmlCache, read_html
+    from metrics import ScrapeMetrics
+
 NP_DEFAULT_CONFIG = {
     'language': 'de',
     'fetch_images': False,
@@ -44,6 +69,39 @@ def setup_logging(log_path: str = '/tmp/scraping.log') -> logging.Logger:
 logger = setup_logging()
 
 
+@contextlib.contextmanager
+def queue_logging() -> Iterator['mp.Queue']:
+    """Multiprocessing-safe logging: worker processes send their log records through
+    a queue to the handlers of the module logger in this process.
+
+    Use the yielded queue as initargs of _init_worker_logging when creating a process pool:
+
+        with queue_logging() as log_queue:
+            ProcessPoolExecutor(initializer=_init_worker_logging, initargs=(log_queue,))
+    """
+    log_queue = mp.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *logger.handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        yield log_queue
+    finally:
+        listener.stop()
+
+
+def _init_worker_logging(log_queue: 'mp.Queue') -> None:
+    # Replace the handlers inherited from the parent (which would write concurrently to the log file)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+
+def _worker_pool(max_workers: Optional[int], log_queue: 'mp.Queue', processes: bool = True) -> Executor:
+    """Process pool with queue logging or thread pool"""
+    if not processes:
+        return ThreadPoolExecutor(max_workers=max_workers)
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker_logging, initargs=(log_queue,))
+
+
 def change_log_file_path(new_log_path):
     """Change file path of log file"""
     for h in logger.handlers:
@@ -54,60 +112,198 @@ def change_log_file_path(new_log_path):
 
 @dataclass
 class ArticleSource:
+    # Sources files have millions of lines, slots keep the instances small
+    __slots__ = ('url', 'date')
     url: str
     date: str
 
 
-def read_sources(path: str) -> Sequence[ArticleSource]:
-    """Read a list of source entries from a tab-separated CSV file.
-    
+def url_hash(url: str) -> int:
+    """64 bit hash of a URL, used instead of the URL itself in large in-memory sets"""
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def iter_sources(
+        paths: Union[str, Sequence[str]],
+        deduplicate: bool = True
+) -> Iterator[ArticleSource]:
+    """Lazily read source entries from one or more tab-separated CSV files.
+
     Each line is expected to have the following format:
-    <INDEX>\t<ARTICLE_URL>\t<PUBLICATION_DATE>"""
-    article_sources = []
-    path = os.path.expanduser(path)
-    with open(path, 'r') as f:
-        reader = csv.reader(f, delimiter='\t')
-        for row in reader:
-            if len(row) != 3:
-                logger.error(
-                    f'{path}: Line {row} has invalid format. '
-                    f'Expected 3 tab-separated strings in each row.'
-                )
-            idx, url, date = row
-            article_sources.append(ArticleSource(url=url, date=date))
-    return article_sources
+    <INDEX>\t<ARTICLE_URL>\t<PUBLICATION_DATE>
 
+    Malformed lines are logged and skipped. With deduplicate, every URL is only
+    yielded the first time it occurs in any of the files (e.g. syndicated articles),
+    which is tracked with a set of 64 bit URL hashes instead of the URLs themselves."""
+    if isinstance(paths, str):
+        paths = [paths]
+    seen: Set[int] = set()
+    num_duplicates = 0
+    for path in paths:
+        path = os.path.expanduser(path)
+        with open(path, 'r') as f:
+            reader = csv.reader(f, delimiter='\t')
+            for row in reader:
+                if len(row) != 3:
+                    logger.error(
+                        f'{path}: Line {row} has invalid format. '
+                        f'Expected 3 tab-separated strings in each row.'
+                    )
+                    continue
+                idx, url, date = row
+                if deduplicate:
+                    key = url_hash(url)
+                    if key in seen:
+                        num_duplicates += 1
+                        continue
+                    seen.add(key)
+                yield ArticleSource(url=url, date=date)
+    if num_duplicates:
+        logger.info(f'Skipped {num_duplicates} duplicate source URLs')
 
-def load_article(
+
+def read_sources(path: str) -> Sequence[ArticleSource]:
+    """Read a list of source entries from a tab-separated CSV file (see iter_sources)."""
+    return list(iter_sources(path))
+
+
+def _article_dict(np_article: newspaper.Article, source: ArticleSource) -> Dict[str, str]:
+    # Initialize article dict with misc. metadata from newspaper (site-dependent!)
+    article = dict(np_article.meta_data)
+    # Manually ensure text, title, date and url are properly registered
+    article['text'] = np_article.text
+    article['title'] = np_article.title
+    article['date'] = source.date
+    article['url'] = source.url
+    return article
+
+
+@dataclass
+class ScrapeResult:
+    """Outcome of scraping a single article source (outcomes: see ScrapeJournal)"""
+    source: ArticleSource
+    outcome: str
+    article: Optional[Dict[str, str]] = None
+    error: str = ''
+    html: Optional[str] = None  # raw response, only kept for an HtmlCache
+    latency: Optional[float] = None  # seconds of the download
+    num_bytes: int = 0  # size of the downloaded page (characters)
+
+
+# requests' raise_for_status message, e.g. '404 Client Error: Not Found for url: ...'
+_FAILED_STATUS = re.compile(r'(\d{3}) (?:Client|Server) Error')
+
+
+def _failed_download(message: Optional[str]) -> 'DownloadResult':
+    """DownloadResult of a failed newspaper download from its error message"""
+    message = message or ''
+    match = _FAILED_STATUS.search(message)
+    if match:
+        return DownloadResult(status=int(match.group(1)))
+    return DownloadResult(error='TimeoutError' if 'timed out' in message.lower() else 'ConnectionError')
+
+
+def _classify_download_failure(message: Optional[str]) -> Tuple[str, str]:
+    """Outcome and error class of a failed newspaper download from its error message"""
+    return outcome_of_download(_failed_download(message))
+
+
+def scrape_article(
         source: ArticleSource,
-        np_config: Optional[Dict[str, Any]] = None
-) -> Dict[str, str]:
+        np_config: Optional[Dict[str, Any]] = None,
+        keep_html: bool = False
+) -> ScrapeResult:
     """Download and parse article, fill metadata,
-    store date from the given article source."""
+    store date from the given article source and classify the outcome.
+    With keep_html, the downloaded HTML is returned as well (also if parsing fails)."""
     np_config = NP_DEFAULT_CONFIG if np_config is None else np_config
     np_article = newspaper.Article(source.url, **np_config)
+    start = time.monotonic()
     try:
         np_article.download()
+        latency = time.monotonic() - start
         np_article.parse()
     except newspaper.ArticleException:
         logger.debug(f'Could not find article {np_article.url}')
-        return None
-    except Exception:
+        outcome, error = _classify_download_failure(np_article.download_exception_msg)
+        return ScrapeResult(source, outcome, error=error, latency=time.monotonic() - start)
+    except Exception as e:
         # download() may also throw other exceptions, such as:
         # UnicodeDecodeError: 'utf-8' codec can't decode byte X in position Y:
         # invalid continuation byte
         # Therefore we also catch unspecified exceptions here in order to not
         # make the program crash
         logger.debug(f'Error loading {np_article.url}:', exc_info=True)
+        html = (np_article.html or None) if keep_html else None
+        return ScrapeResult(source, ScrapeJournal.FAILED, error=type(e).__name__, html=html,
+                            latency=time.monotonic() - start, num_bytes=len(np_article.html or ''))
+    return ScrapeResult(source, ScrapeJournal.STORED, article=_article_dict(np_article, source),
+                        html=np_article.html if keep_html else None,
+                        latency=latency, num_bytes=len(np_article.html))
+
+
+def load_article(
+        source: ArticleSource,
+        np_config: Optional[Dict[str, Any]] = None
+) -> Dict[str, str]:
+    """Download and parse article, fill metadata,
+    store date from the given article source."""
+    return scrape_article(source, np_config).article
+
+
+def parse_article(
+        source: ArticleSource,
+        html: str,
+        np_config: Optional[Dict[str, Any]] = None
+) -> Dict[str, str]:
+    """Parse already downloaded article HTML (no network access), fill metadata,
+    store date from the given article source."""
+    np_config = NP_DEFAULT_CONFIG if np_config is None else np_config
+    np_article = newspaper.Article(source.url, **np_config)
+    try:
+        np_article.download(input_html=html)
+        np_article.parse()
+    except Exception:
+        logger.debug(f'Error parsing {np_article.url}:', exc_info=True)
         return None
-    # Initialize article dict with misc. metadata from newspaper (site-dependent!)
-    article = dict(np_article.meta_data)
-    # Manually ensure text, title, date and url are properly registered
-    article['text'] = np_article.text
-    article['title'] = np_article.title
-    article['date'] = source.date
-    article['url'] = source.url
-    return article
+    return _article_dict(np_article, source)
+
+
+def download_page(
+        source: ArticleSource,
+        np_config: Optional[Dict[str, Any]] = None
+) -> 'DownloadResult':
+    """Download the HTML of an article with newspaper (blocking, run in threads)."""
+    np_config = NP_DEFAULT_CONFIG if np_config is None else np_config
+    np_article = newspaper.Article(source.url, **np_config)
+    start = time.monotonic()
+    try:
+        np_article.download()
+    except Exception as e:
+        # see scrape_article
+        logger.debug(f'Error loading {np_article.url}:', exc_info=True)
+        result = DownloadResult(error=type(e).__name__)
+    else:
+        if np_article.download_state != newspaper.article.ArticleDownloadState.SUCCESS:
+            logger.debug(f'Could not find article {np_article.url}')
+            result = _failed_download(np_article.download_exception_msg)
+        else:
+            result = DownloadResult(status=200, html=np_article.html, num_bytes=len(np_article.html))
+    result.latency = time.monotonic() - start
+    return result
+
+
+def parse_cached_article(
+        source: ArticleSource,
+        ref: str,
+        np_config: Optional[Dict[str, Any]] = None
+) -> ScrapeResult:
+    """Parse an article from the HTML stored in an HtmlCache (no network access),
+    ref is the record reference of the HTML (see HtmlCache.ref)"""
+    article = parse_article(source, read_html(ref), np_config)
+    if article is None:
+        return ScrapeResult(source, ScrapeJournal.FAILED, error='ParseError')
+    return ScrapeResult(source, ScrapeJournal.STORED, article=article)
 
 
 def filename_from_url(url: str, ext: str = '.json') -> str:
@@ -117,58 +313,777 @@ def filename_from_url(url: str, ext: str = '.json') -> str:
     return filename
 
 
-def load_and_store_article(
-        source: ArticleSource,
-        parent_dir: str,
-        np_config: Optional[Dict[str, Any]] = None
-) -> None:
-    filename = filename_from_url(source.url)
-    full_path = f'{parent_dir}/{filename}'
-    if os.path.exists(full_path):
-        logger.debug(f'{full_path} already exists, skipping...')
-        return
+def _lazy_starmap(
+        executor: Executor,
+        fn: Callable,
+        args_iterable: Iterable[tuple],
+        max_pending: int
+) -> Iterator[Any]:
+    """Like executor.map, but arguments are only taken from args_iterable while
+    fewer than max_pending calls are pending, so long inputs are never fully in memory.
+    Results are yielded in input order."""
+    pending = deque()
+    for args in args_iterable:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
 
-    article = load_article(source=source, np_config=np_config)
-    if article is not None:
-        write_to_json(article, full_path)
+def _download_result(result: ScrapeResult) -> 'DownloadResult':
+    """DownloadResult of a scrape_article call, as input for DomainScheduler.done"""
+    if result.outcome == ScrapeJournal.STORED:
+        return DownloadResult(status=200, html='', num_bytes=result.num_bytes, latency=result.latency or 0.0)
+    if result.error.startswith('HTTP') and result.error[4:].isdigit():
+        return DownloadResult(status=int(result.error[4:]), latency=result.latency or 0.0)
+    return DownloadResult(error=result.error, latency=result.latency or 0.0)
 
 
-def scrape_articles(sources: Sequence[ArticleSource]) -> Sequence[Dict[str, str]]:
-    """Scrape articles from given article sources"""
-    scraped_articles = {}
-    logger.info('Downloading and parsing articles...')
-    for article_source in tqdm(sources):
-        article = load_article(article_source)
-        if article is not None:
-            scraped_articles[article_source.url] = article
-    return scraped_articles
+def _scheduled_results(
+        executor: Executor,
+        fn: Callable[[ArticleSource], ScrapeResult],
+        sources: Iterable[ArticleSource],
+        scheduler: 'DomainScheduler',
+        max_pending: int
+) -> Iterator[ScrapeResult]:
+    """Submit fn(source) to the executor in the order decided by the scheduler, with at most
+    max_pending pending calls, and yield the results in completion order.
+    Sources are taken lazily from the iterable. Throttled downloads are retried
+    by the scheduler and only their final result is yielded."""
+    sources = iter(sources)
+    sources_exhausted = False
+    lookahead = 20 * max_pending
+    pending: Dict[Future, ArticleSource] = {}
+    while True:
+        while not sources_exhausted and scheduler.num_queued < lookahead:
+            source = next(sources, None)
+            if source is None:
+                sources_exhausted = True
+            else:
+                scheduler.add(source)
+        while len(pending) < max_pending:
+            source = scheduler.pop_ready()
+            if source is None:
+                break
+            pending[executor.submit(fn, source)] = source
+        if not pending:
+            if sources_exhausted and scheduler.num_queued == 0:
+                return
+            # all domains with queued sources are paused
+            time.sleep(scheduler.seconds_until_ready() or 0.1)
+            continue
+        # wake up when a paused domain is ready again, even if no call completed
+        done, _ = wait(list(pending), timeout=scheduler.seconds_until_ready(), return_when=FIRST_COMPLETED)
+        for future in done:
+            source = pending.pop(future)
+            result = future.result()
+            download = _download_result(result)
+            if not scheduler.done(source, download, download.latency):
+                yield result
 
 
 def scrape_and_store_articles(
-        sources: Sequence[ArticleSource],
+        sources: Iterable[ArticleSource],
         parent_dir: str,
         multiprocessing: bool = True,
-        num_workers: int = 32
+        num_workers: int = 32,
+        storage: str = 'files',
+        journal_path: Optional[str] = None,
+        retry_transient_only: bool = False,
+        html_cache_path: Optional[str] = None,
+        metrics: Optional[ScrapeMetrics] = None,
+        max_per_domain: int = 4
 ) -> None:
     """Scrape articles from given article sources and immediately store them on disk.
     
-    Uses multiprocessing/multithreading."""
-    parent_dir = os.path.expanduser(parent_dir)
-    # Partially applied function to always store to the same parent dir
-    _load_and_store_article = functools.partial(
-        load_and_store_article,
-        parent_dir=parent_dir
-    )
-    os.makedirs(parent_dir, exist_ok=True)
-    logger.info(f'Downloading and parsing articles, storing in {parent_dir} ...')
-    # TODO: Make logging multi-processing-safe
-    Executor = ProcessPoolExecutor if multiprocessing else ThreadPoolExecutor
-    with Executor(max_workers=num_workers) as executor:
-        # Wrapping in list(tqdm(...)) necessary to enable progress bar
-        list(tqdm(
-            executor.map(_load_and_store_article, sources),
-            total=len(sources)
+    Uses multiprocessing/multithreading. Sources are taken lazily from the iterable,
+    so it can be a generator such as iter_sources.
+
+    The downloads are submitted to the pool by a DomainScheduler: requests are
+    interleaved across domains with at most max_per_domain concurrent requests
+    per domain and backoff for throttling domains. Per-domain throughput is
+    logged at the end.
+
+    With storage='files' every article is written to its own JSON file in parent_dir,
+    with storage='archive' parent_dir is a SegmentArchive (see article_store.py).
+    Workers only download and parse, the articles are stored by the calling process.
+
+    The outcome of every URL is recorded in a ScrapeJournal (default:
+    <parent_dir>/scrape_journal.tsv), so that a restarted crawl skips finished
+    and permanently failing URLs.
+
+    If html_cache_path is given, the raw HTML of every downloaded page is kept
+    in an HtmlCache there (see reextract_articles).
+
+    Throughput, latencies and errors are counted in metrics (see metrics.py)."""
+    html_cache = HtmlCache(html_cache_path) if html_cache_path else None
+    metrics = ScrapeMetrics() if metrics is None else metrics
+    _scrape_article = functools.partial(scrape_article, keep_html=html_cache is not None)
+    with ArticleStorage(parent_dir, storage) as article_storage, \
+            ScrapeJournal(journal_path or article_storage.journal_path,
+                          retry_transient_only=retry_transient_only) as journal:
+        logger.info(f'Downloading and parsing articles, storing in {article_storage.parent_dir} ...')
+        total = len(sources) if hasattr(sources, '__len__') else None
+        progress = tqdm(total=total)
+
+        def todo() -> Iterator[ArticleSource]:
+            for source in sources:
+                if journal.should_skip(source.url) or source.url in article_storage:
+                    progress.update()
+                    continue
+                yield source
+
+        # the queued calls of a pool are not rate-limited, so only as many are submitted as workers run
+        max_pending = num_workers or os.cpu_count() or 1
+        scheduler = DomainScheduler(max_per_domain=max_per_domain)
+        with queue_logging() as log_queue, progress, \
+                _worker_pool(num_workers, log_queue, multiprocessing) as executor:
+            for result in _scheduled_results(executor, _scrape_article, todo(), scheduler, max_pending):
+                if result.html is not None:
+                    html_cache.put(result.source.url, result.html)
+                if result.article is not None:
+                    article_storage.put(result.article)
+                journal.record(result.source.url, result.outcome, result.error)
+                metrics.record(result.source.url, result.outcome, result.error, result.latency, result.num_bytes)
+                progress.update()
+        logger.info(f'Per-domain throughput:\n{scheduler.report()}')
+        logger.info(f'Outcomes: {journal.summary()}')
+    if html_cache is not None:
+        html_cache.close()
+
+
+def reextract_articles(
+        sources: Iterable[ArticleSource],
+        html_cache_path: str,
+        parent_dir: str,
+        num_workers: Optional[int] = None,
+        storage: str = 'files',
+        np_config: Optional[Dict[str, Any]] = None
+) -> None:
+    """Parse the articles of the given sources again from the raw HTML in an HtmlCache.
+
+    Runs without network access on num_workers processes (default: all cores).
+    Sources without cached HTML are skipped. Existing article files are overwritten,
+    an archive only receives articles that it does not contain yet."""
+    _parse_cached_article = functools.partial(parse_cached_article, np_config=np_config)
+    num_parsed, num_failed = 0, 0
+    with HtmlCache(html_cache_path) as html_cache, \
+            ArticleStorage(parent_dir, storage) as article_storage, \
+            queue_logging() as log_queue, \
+            _worker_pool(num_workers, log_queue) as executor:
+        logger.info(
+            f'Re-extracting articles from {html_cache.path}, '
+            f'storing in {article_storage.parent_dir} ...'
+        )
+        todo = ((source, html_cache.ref(source.url)) for source in sources if source.url in html_cache)
+        max_pending = 16 * (num_workers or os.cpu_count() or 1)
+        for result in tqdm(_lazy_starmap(executor, _parse_cached_article, todo, max_pending)):
+            if result.article is not None:
+                article_storage.put(result.article)
+                num_parsed += 1
+            else:
+                num_failed += 1
+    logger.info(f'Re-extracted {num_parsed} articles, could not parse {num_failed} cached articles')
+
+
+class ScrapeJournal:
+    """Append-only journal of the outcome of every scraped URL.
+
+    Each line of the journal file has the format
+    <URL>\t<OUTCOME>\t<ERROR_CLASS>\t<ATTEMPTS>
+    The journal is loaded into memory (as URL hashes) at startup, so a restarted
+    crawl skips finished and permanently failing URLs without touching the filesystem.
+    Transient failures are retried until they failed max_attempts times.
+    With retry_transient_only=True, only transient failures of previous runs are scraped."""
+
+    STORED = 'stored'
+    NOT_FOUND = 'not_found'  # HTTP 404 and other 4xx responses
+    FAILED = 'failed'  # other permanent errors, e.g. unparsable pages
+    TRANSIENT = 'transient'  # timeouts, connection errors, HTTP 429 and 5xx
+
+    def __init__(self, path: str, max_attempts: int = 3, retry_transient_only: bool = False,
+                 flush_every: int = 100):
+        self.path = os.path.expanduser(path)
+        self.max_attempts = max_attempts
+        self.retry_transient_only = retry_transient_only
+        self.flush_every = flush_every
+        self.finished: Set[int] = set()  # stored or permanently failed
+        self.transient: Dict[int, int] = {}  # number of failed attempts
+        self.outcomes: Dict[str, int] = defaultdict(int)
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 4 or not fields[3].isdigit():
+                        continue  # incomplete line of an interrupted write
+                    self._register(url_hash(fields[0]), fields[1], int(fields[3]))
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._unflushed = 0
+
+    def _register(self, key: int, outcome: str, attempts: int) -> None:
+        if outcome == self.TRANSIENT:
+            self.transient[key] = attempts
+            self.finished.discard(key)
+        else:
+            self.finished.add(key)
+            self.transient.pop(key, None)
+
+    def should_skip(self, url: str) -> bool:
+        key = url_hash(url)
+        if key in self.finished:
+            return True
+        attempts = self.transient.get(key)
+        if self.retry_transient_only:
+            return attempts is None or attempts >= self.max_attempts
+        return attempts is not None and attempts >= self.max_attempts
+
+    def record(self, url: str, outcome: str, error: str = '') -> None:
+        key = url_hash(url)
+        attempts = self.transient.get(key, 0) + 1
+        self._register(key, outcome, attempts)
+        self.outcomes[outcome] += 1
+        self._file.write(f'{url}\t{outcome}\t{error}\t{attempts}\n')
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self._file.flush()
+            self._unflushed = 0
+
+    def summary(self) -> Dict[str, int]:
+        """Number of outcomes recorded in this run"""
+        return dict(self.outcomes)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ArticleStorage:
+    """Stores scraped articles in parent_dir, either as one JSON file per article
+    (storage='files') or in a segment archive (storage='archive')."""
+
+    def __init__(self, parent_dir: str, storage: str = 'files'):
+        self.parent_dir = os.path.expanduser(parent_dir)
+        self.archive = SegmentArchive(self.parent_dir) if storage == 'archive' else None
+        os.makedirs(self.parent_dir, exist_ok=True)
+        self.journal_path = f'{self.parent_dir}/scrape_journal.tsv'
+        # Names of the stored files are listed once instead of checking every path
+        self._filenames = None if self.archive is not None else {
+            entry.name for entry in os.scandir(self.parent_dir)
+        }
+
+    def path(self, url: str) -> str:
+        return f'{self.parent_dir}/{filename_from_url(url)}'
+
+    def __contains__(self, url: str) -> bool:
+        if self.archive is not None:
+            return url in self.archive
+        return filename_from_url(url) in self._filenames
+
+    def put(self, article: Dict[str, str]) -> None:
+        if self.archive is not None:
+            self.archive.put(article['url'], article)
+        else:
+            write_to_json(article, self.path(article['url']))
+            self._filenames.add(filename_from_url(article['url']))
+
+    def close(self) -> None:
+        if self.archive is not None:
+            self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+@dataclass
+class DownloadResult:
+    """Outcome of a single download attempt"""
+    status: Optional[int] = None  # HTTP status code, None if the request failed
+    html: Optional[str] = None
+    error: Optional[str] = None  # exception class name if the request failed
+    num_bytes: int = 0
+    retry_after: Optional[float] = None  # seconds, from the Retry-After header
+    latency: float = 0.0  # seconds
+
+    @property
+    def throttled(self) -> bool:
+        """True if the server is overloaded or rate-limits us (timeouts, 429, 5xx)"""
+        if self.status is None:
+            return self.error in ('TimeoutError', 'ServerTimeoutError', 'ServerDisconnectedError')
+        return self.status == 429 or self.status >= 500
+
+
+async def download_html(
+        session: 'aiohttp.ClientSession',
+        source: ArticleSource
+) -> DownloadResult:
+    """Download the HTML of an article with a pooled aiohttp session."""
+    try:
+        async with session.get(source.url) as response:
+            result = DownloadResult(status=response.status)
+            if response.status >= 400:
+                logger.debug(f'Could not find article {source.url} (HTTP {response.status})')
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    result.retry_after = float(retry_after)
+                return result
+            body = await response.read()
+            result.num_bytes = len(body)
+            result.html = body.decode(response.get_encoding(), errors='replace')
+            return result
+    except (aiohttp.ClientError, asyncio.TimeoutError, LookupError, RuntimeError) as e:
+        logger.debug(f'Error loading {source.url}:', exc_info=True)
+        return DownloadResult(error=type(e).__name__)
+
+
+def outcome_of_download(result: DownloadResult) -> Tuple[str, str]:
+    """Journal outcome and error class of a failed download"""
+    if result.throttled or result.status is None:
+        return ScrapeJournal.TRANSIENT, result.error or f'HTTP{result.status}'
+    return ScrapeJournal.NOT_FOUND, f'HTTP{result.status}'
+
+
+def domain_of(url: str) -> str:
+    return urllib.parse.urlsplit(url).hostname or ''
+
+
+@dataclass
+class DomainStats:
+    requests: int = 0
+    downloaded: int = 0
+    throttled: int = 0
+    failed: int = 0
+    num_bytes: int = 0
+    busy_seconds: float = 0.0  # summed request latency
+
+    @property
+    def mean_latency(self) -> float:
+        return self.busy_seconds / self.requests if self.requests else 0.0
+
+
+class DomainScheduler:
+    """Decides which article to download next so that the load is spread across domains.
+
+    Sources are queued per domain and handed out round-robin over the domains.
+    At most max_per_domain requests run concurrently for the same domain.
+    After timeouts, HTTP 429 or 5xx responses, a domain is paused with an
+    exponentially growing delay (or the server's Retry-After) and the source is
+    queued again (up to max_attempts times). Successful downloads shrink the delay again.
+    Per-domain statistics are collected in stats."""
+
+    def __init__(self, max_per_domain: int = 4, base_delay: float = 1.0,
+                 max_delay: float = 300.0, max_attempts: int = 3):
+        self.max_per_domain = max_per_domain
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.queues: Dict[str, Deque[ArticleSource]] = {}
+        self.ring: Deque[str] = deque()  # round-robin order of domains with queued sources
+        self.active: Dict[str, int] = defaultdict(int)
+        self.delay: Dict[str, float] = defaultdict(float)
+        self.not_before: Dict[str, float] = defaultdict(float)
+        self.attempts: Dict[str, int] = defaultdict(int)
+        self.stats: Dict[str, DomainStats] = defaultdict(DomainStats)
+        self.num_queued = 0
+        self.start_time = time.monotonic()
+
+    def add(self, source: ArticleSource) -> None:
+        domain = domain_of(source.url)
+        if domain not in self.queues:
+            self.queues[domain] = deque()
+            self.ring.append(domain)
+        self.queues[domain].append(source)
+        self.num_queued += 1
+
+    def pop_ready(self) -> Optional[ArticleSource]:
+        """Next source of a domain that has a free slot and is not paused, None if there is none"""
+        now = time.monotonic()
+        for _ in range(len(self.ring)):
+            domain = self.ring[0]
+            self.ring.rotate(-1)
+            if self.active[domain] >= self.max_per_domain or now < self.not_before[domain]:
+                continue
+            queue = self.queues[domain]
+            source = queue.popleft()
+            if not queue:
+                del self.queues[domain]
+                self.ring.pop()  # the domain was just rotated to the end
+            self.active[domain] += 1
+            self.num_queued -= 1
+            return source
+        return None
+
+    def seconds_until_ready(self) -> Optional[float]:
+        """Time until a paused domain may be used again, None if no domain is paused"""
+        now = time.monotonic()
+        waits = [self.not_before[d] - now for d in self.ring
+                 if self.active[d] < self.max_per_domain and self.not_before[d] > now]
+        return min(waits) if waits else None
+
+    def done(self, source: ArticleSource, result: DownloadResult, latency: float) -> bool:
+        """Register the result of a download. Returns True if the source was queued for a retry."""
+        domain = domain_of(source.url)
+        self.active[domain] -= 1
+        stats = self.stats[domain]
+        stats.requests += 1
+        stats.busy_seconds += latency
+        stats.num_bytes += result.num_bytes
+        if result.throttled:
+            stats.throttled += 1
+            delay = min(self.max_delay, max(self.base_delay, 2 * self.delay[domain]))
+            self.delay[domain] = delay
+            self.not_before[domain] = time.monotonic() + max(delay, result.retry_after or 0.0)
+            logger.debug(f'{domain} is throttling (status {result.status}, {result.error}), '
+                         f'pausing it for {delay:.1f} s')
+            self.attempts[source.url] += 1
+            if self.attempts[source.url] < self.max_attempts:
+                self.add(source)
+                return True
+        else:
+            self.delay[domain] /= 2
+        self.attempts.pop(source.url, None)
+        if result.html is not None:
+            stats.downloaded += 1
+        else:
+            stats.failed += 1
+        return False
+
+    def report(self, top: int = 20) -> str:
+        """Per-domain throughput summary of the busiest domains"""
+        elapsed = max(time.monotonic() - self.start_time, 1e-9)
+        lines = [f'{"domain":40} {"requests":>8} {"articles/s":>10} {"throttled":>9} '
+                 f'{"failed":>6} {"MiB":>8} {"latency":>8}']
+        busiest = sorted(self.stats.items(), key=lambda item: item[1].requests, reverse=True)
+        for domain, stats in busiest[:top]:
+            lines.append(
+                f'{domain[:40]:40} {stats.requests:8d} {stats.downloaded / elapsed:10.2f} '
+                f'{stats.throttled:9d} {stats.failed:6d} {stats.num_bytes / 2 ** 20:8.1f} '
+                f'{stats.mean_latency:7.2f}s'
+            )
+        return '\n'.join(lines)
+
+
+async def _scrape_and_store_async(
+        sources: Iterable[ArticleSource],
+        storage: ArticleStorage,
+        journal: ScrapeJournal,
+        parse_executor: Executor,
+        scheduler: DomainScheduler,
+        max_in_flight: int,
+        np_config: Dict[str, Any],
+        progress: tqdm,
+        report_interval: float,
+        metrics: ScrapeMetrics,
+        html_cache: Optional[HtmlCache] = None
+) -> None:
+    loop = asyncio.get_running_loop()
+    # Downloaded pages waiting for or being parsed, bounded to limit memory usage
+    parse_slots = asyncio.Semaphore(2 * max_in_flight)
+    parse_tasks = set()
+    # Sources are buffered in the scheduler to interleave domains
+    lookahead = 20 * max_in_flight
+    scheduler_changed = asyncio.Condition()
+    sources_exhausted = False
+    in_flight = 0
+
+    async def parse_and_store(source: ArticleSource, result: DownloadResult) -> None:
+        try:
+            article = await loop.run_in_executor(parse_executor, parse_article, source, result.html, np_config)
+            if article is not None:
+                storage.put(article)
+                outcome, error = ScrapeJournal.STORED, ''
+            else:
+                outcome, error = ScrapeJournal.FAILED, 'ParseError'
+            journal.record(source.url, outcome, error)
+            metrics.record(source.url, outcome, error, result.latency, result.num_bytes)
+        finally:
+            parse_slots.release()
+            progress.update()
+
+    async def next_source() -> Optional[ArticleSource]:
+        nonlocal in_flight
+        async with scheduler_changed:
+            while True:
+                source = scheduler.pop_ready()
+                if source is not None:
+                    in_flight += 1
+                    scheduler_changed.notify_all()  # the feeder may add more sources
+                    return source
+                if sources_exhausted and scheduler.num_queued == 0 and in_flight == 0:
+                    return None
+                try:
+                    await asyncio.wait_for(scheduler_changed.wait(), scheduler.seconds_until_ready())
+                except asyncio.TimeoutError:
+                    pass  # a paused domain is ready again
+
+    async def download_worker(session: aiohttp.ClientSession) -> None:
+        nonlocal in_flight
+        while True:
+            source = await next_source()
+            if source is None:
+                return
+            start = time.monotonic()
+            result = await download_html(session, source)
+            result.latency = time.monotonic() - start
+            async with scheduler_changed:
+                in_flight -= 1
+                retry = scheduler.done(source, result, result.latency)
+                scheduler_changed.notify_all()
+            if retry:
+                continue
+            if result.html is None:
+                outcome, error = outcome_of_download(result)
+                journal.record(source.url, outcome, error)
+                metrics.record(source.url, outcome, error, result.latency, result.num_bytes)
+                progress.update()
+                continue
+            if html_cache is not None:
+                html_cache.put(source.url, result.html)
+            # Parsing runs in the executor, the worker can continue downloading
+            await parse_slots.acquire()
+            task = asyncio.create_task(parse_and_store(source, result))
+            parse_tasks.add(task)
+            task.add_done_callback(parse_tasks.discard)
+
+    async def report_periodically() -> None:
+        while True:
+            await asyncio.sleep(report_interval)
+            logger.info(f'Per-domain throughput:\n{scheduler.report()}')
+
+    connector = aiohttp.TCPConnector(limit=max_in_flight, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=np_config.get('request_timeout', 7))
+    headers = {'User-Agent': newspaper.Config().browser_user_agent}
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+        workers = [asyncio.create_task(download_worker(session)) for _ in range(max_in_flight)]
+        reporter = asyncio.create_task(report_periodically()) if report_interval else None
+        # Sources are only taken from the iterable when the scheduler needs more
+        for source in sources:
+            if journal.should_skip(source.url) or source.url in storage:
+                progress.update()
+                continue
+            async with scheduler_changed:
+                while scheduler.num_queued >= lookahead:
+                    await scheduler_changed.wait()
+                scheduler.add(source)
+                scheduler_changed.notify_all()
+        async with scheduler_changed:
+            sources_exhausted = True
+            scheduler_changed.notify_all()
+        await asyncio.gather(*workers)
+        while parse_tasks:
+            await asyncio.gather(*list(parse_tasks))
+        if reporter is not None:
+            reporter.cancel()
+    logger.info(f'Per-domain throughput:\n{scheduler.report()}')
+
+
+def scrape_and_store_articles_async(
+        sources: Iterable[ArticleSource],
+        parent_dir: str,
+        max_in_flight: int = 100,
+        multiprocessing: bool = False,
+        num_workers: Optional[int] = None,
+        storage: str = 'files',
+        np_config: Optional[Dict[str, Any]] = None,
+        max_per_domain: int = 4,
+        report_interval: float = 600.0,
+        journal_path: Optional[str] = None,
+        retry_transient_only: bool = False,
+        html_cache_path: Optional[str] = None,
+        metrics: Optional[ScrapeMetrics] = None
+) -> None:
+    """Scrape articles from given article sources with asyncio and store them on disk.
+
+    Up to max_in_flight downloads run concurrently on one event loop, reusing
+    keep-alive connections. The downloaded pages are parsed separately by
+    num_workers threads (or processes if multiprocessing is True).
+
+    Requests are interleaved across domains with at most max_per_domain concurrent
+    requests per domain and backoff for throttling domains (see DomainScheduler).
+    Per-domain throughput is logged every report_interval seconds (0: only at the end).
+    Outcomes are recorded in a ScrapeJournal and in metrics, and the raw HTML is
+    kept in an HtmlCache at html_cache_path (optional) like in scrape_and_store_articles."""
+    if aiohttp is None:
+        raise ImportError('The asyncio download mode requires aiohttp (pip install aiohttp)')
+    np_config = NP_DEFAULT_CONFIG if np_config is None else np_config
+    total = len(sources) if hasattr(sources, '__len__') else None
+    html_cache = HtmlCache(html_cache_path) if html_cache_path else None
+    metrics = ScrapeMetrics() if metrics is None else metrics
+    with ArticleStorage(parent_dir, storage) as article_storage, \
+            ScrapeJournal(journal_path or article_storage.journal_path,
+                          retry_transient_only=retry_transient_only) as journal, \
+            queue_logging() as log_queue, \
+            _worker_pool(num_workers, log_queue, multiprocessing) as parse_executor, \
+            tqdm(total=total) as progress:
+        logger.info(
+            f'Downloading articles with {max_in_flight} concurrent requests, '
+            f'storing in {article_storage.parent_dir} ...'
+        )
+        scheduler = DomainScheduler(max_per_domain=max_per_domain)
+        asyncio.run(_scrape_and_store_async(
+            sources, article_storage, journal, parse_executor, scheduler, max_in_flight,
+            np_config, progress, report_interval, metrics, html_cache
         ))
+        logger.info(f'Outcomes: {journal.summary()}')
+    if html_cache is not None:
+        html_cache.close()
+
+
+def _download_stage(
+        sources: Iterator[ArticleSource],
+        downloaded: 'queue.Queue',
+        num_threads: int,
+        np_config: Dict[str, Any],
+        scheduler: DomainScheduler
+) -> List[threading.Thread]:
+    """Start num_threads threads that download the sources in the order decided by the
+    scheduler and put (source, DownloadResult) pairs into the bounded queue downloaded.
+    Throttled downloads are retried by the scheduler. Every thread puts None when all
+    sources are done."""
+    scheduler_changed = threading.Condition()
+    lookahead = 20 * num_threads
+    sources_exhausted = False
+    in_flight = 0
+
+    def next_source() -> Optional[ArticleSource]:
+        nonlocal sources_exhausted, in_flight
+        with scheduler_changed:
+            while True:
+                while not sources_exhausted and scheduler.num_queued < lookahead:
+                    source = next(sources, None)
+                    if source is None:
+                        sources_exhausted = True
+                    else:
+                        scheduler.add(source)
+                source = scheduler.pop_ready()
+                if source is not None:
+                    in_flight += 1
+                    return source
+                if sources_exhausted and scheduler.num_queued == 0 and in_flight == 0:
+                    return None
+                # wait for a finished download or a paused domain to become ready again
+                scheduler_changed.wait(scheduler.seconds_until_ready())
+
+    def download_worker() -> None:
+        nonlocal in_flight
+        while True:
+            source = next_source()
+            if source is None:
+                downloaded.put(None)
+                return
+            result = download_page(source, np_config)
+            with scheduler_changed:
+                in_flight -= 1
+                retry = scheduler.done(source, result, result.latency)
+                scheduler_changed.notify_all()
+            if not retry:
+                # blocks while the queue is full, so downloads never run far ahead of parsing
+                downloaded.put((source, result))
+
+    threads = [threading.Thread(target=download_worker, daemon=True) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def scrape_and_store_articles_pipelined(
+        sources: Iterable[ArticleSource],
+        parent_dir: str,
+        download_workers: int = 32,
+        parse_workers: Optional[int] = None,
+        queue_size: int = 1000,
+        storage: str = 'files',
+        np_config: Optional[Dict[str, Any]] = None,
+        journal_path: Optional[str] = None,
+        retry_transient_only: bool = False,
+        html_cache_path: Optional[str] = None,
+        metrics: Optional[ScrapeMetrics] = None,
+        max_per_domain: int = 4
+) -> None:
+    """Scrape articles in two pipelined stages and store them on disk.
+
+    download_workers threads download the pages (waiting on the network does not
+    need a process) and feed a queue of at most queue_size pages. A pool of
+    parse_workers processes (default: all cores) parses them without being
+    limited by the GIL. The articles are stored by the calling process.
+    Worker processes log through a queue (see queue_logging).
+    The download threads take their sources from a DomainScheduler (at most
+    max_per_domain concurrent requests per domain, backoff for throttling domains).
+
+    Journal, HTML cache and metrics work like in scrape_and_store_articles."""
+    np_config = NP_DEFAULT_CONFIG if np_config is None else np_config
+    total = len(sources) if hasattr(sources, '__len__') else None
+    html_cache = HtmlCache(html_cache_path) if html_cache_path else None
+    metrics = ScrapeMetrics() if metrics is None else metrics
+    with ArticleStorage(parent_dir, storage) as article_storage, \
+            ScrapeJournal(journal_path or article_storage.journal_path,
+                          retry_transient_only=retry_transient_only) as journal, \
+            queue_logging() as log_queue, \
+            _worker_pool(parse_workers, log_queue) as parse_executor, \
+            tqdm(total=total) as progress:
+        logger.info(
+            f'Downloading articles with {download_workers} threads, parsing with '
+            f'{parse_workers or os.cpu_count()} processes, storing in {article_storage.parent_dir} ...'
+        )
+
+        def todo() -> Iterator[ArticleSource]:
+            for source in sources:
+                if journal.should_skip(source.url) or source.url in article_storage:
+                    progress.update()
+                    continue
+                yield source
+
+        def store(future: Future) -> None:
+            source, result = parsing.pop(future)
+            article = future.result()
+            if article is not None:
+                article_storage.put(article)
+                outcome, error = ScrapeJournal.STORED, ''
+            else:
+                outcome, error = ScrapeJournal.FAILED, 'ParseError'
+            journal.record(source.url, outcome, error)
+            metrics.record(source.url, outcome, error, result.latency, result.num_bytes)
+            progress.update()
+
+        downloaded = queue.Queue(maxsize=queue_size)
+        scheduler = DomainScheduler(max_per_domain=max_per_domain)
+        _download_stage(todo(), downloaded, download_workers, np_config, scheduler)
+        parsing: Dict[Future, Tuple[ArticleSource, DownloadResult]] = {}
+        max_parsing = 2 * (parse_workers or os.cpu_count() or 1)
+        num_running = download_workers
+        while num_running:
+            item = downloaded.get()
+            if item is None:
+                num_running -= 1
+                continue
+            source, result = item
+            if result.html is None:
+                outcome, error = outcome_of_download(result)
+                journal.record(source.url, outcome, error)
+                metrics.record(source.url, outcome, error, result.latency, result.num_bytes)
+                progress.update()
+                continue
+            if html_cache is not None:
+                html_cache.put(source.url, result.html)
+            if len(parsing) >= max_parsing:
+                done, _ = wait(list(parsing), return_when=FIRST_COMPLETED)
+                for future in done:
+                    store(future)
+            parsing[parse_executor.submit(parse_article, source, result.html, np_config)] = (source, result)
+        for future in list(parsing):
+            store(future)
+        logger.info(f'Per-domain throughput:\n{scheduler.report()}')
+        logger.info(f'Outcomes: {journal.summary()}')
+    if html_cache is not None:
+        html_cache.close()
 
 
 def write_to_json(articles: Dict[str, str], json_path: str) -> None:
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+Equivalence check and benchmark of the SentiWS keyword prefilter.
+
+Scores the texts with SentiWS twice: with the full spacy parse of every text
+and with the keyword prefilter (sentiws_prefilter, only the sentences with
+search words and their neighbours are parsed). Prints how many polarities are
+identical, the largest difference, the agreement of the polarity labels and
+the time of both modes. Exits with status 1 if any polarity differs.
+
+Texts are the evaluation data of the config (senti_eval_input) or the articles
+of a .json/.jsonl file (e.g. the output of the article selection):
+
+    $ python3 -m sentiment_analysis.benchmark_sentiws_prefilter config.ini [articles.json]
+"""
+
+import configparser
+import csv
+import sys
+import time
+from typing import List, Sequence
+
+from sentiment_analysis import sentiment_dictionary as sd
+from sentiment_analysis.inference import polarity_label
+
+
+def read_eval_texts(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [row[0] for row in csv.reader(f, delimiter='\t') if len(row) == 2]
+
+
+def parsed_fraction(texts: Sequence[str], search_words: list) -> float:
+    """Characters parsed with the prefilter relative to the full parse of the texts with search words"""
+    instance = sd.SentimentDictionary.getInstance()
+    relevant = [text for text in texts if any(word in text.lower() for word in search_words)]
+    passages = [passage for text in relevant for passage in instance.keyword_passages(text, search_words)]
+    return sum(map(len, passages)) / max(sum(map(len, relevant)), 1)
+
+
+def main(texts: List[str], search_words: list, batch_size: int = 64) -> bool:
+    start = time.perf_counter()
+    full = list(sd.analyse_sentiment_batch(texts, search_words, batch_size))
+    full_time = time.perf_counter() - start
+    start = time.perf_counter()
+    prefiltered = list(sd.analyse_sentiment_batch(texts, search_words, batch_size, prefilter=True))
+    prefilter_time = time.perf_counter() - start
+
+    differences = [(abs(f - p), i) for i, (f, p) in enumerate(zip(full, prefiltered)) if f != p]
+    labels_agree = sum(polarity_label(f) == polarity_label(p) for f, p in zip(full, prefiltered))
+    print(f"{len(texts) - len(differences)} of {len(texts)} polarities are identical, "
+          f"labels agree for {labels_agree}")
+    if differences:
+        print(f"Largest difference: {max(differences)[0]:.4f}")
+        for _, i in sorted(differences, reverse=True)[:5]:
+            print(f"  {full[i]:.4f} != {prefiltered[i]:.4f}: {texts[i][:200]!r}")
+    print(f"Parsed characters with prefilter: {parsed_fraction(texts, search_words):.1%}")
+    print(f"Full parse: {full_time:.1f} s, prefilter: {prefilter_time:.1f} s "
+          f"(speedup {full_time / prefilter_time:.2f}x)")
+    return not differences
+
+
+if __name__ == "__main__":
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+    # same search words as in the pipeline
+    words = [word.strip() for word in config.get("Analysis", "search_words").lower().split(",")]
+    if len(sys.argv) > 2:
+        from article_selection.jsonl import read_articles
+        input_texts = [text for text in read_articles(sys.argv[2], columns=["text"])["text"] if isinstance(text, str)]
+    else:
+        input_texts = read_eval_texts(config.get("Analysis", "senti_eval_input"))
+    sys.exit(0 if main(input_texts, words, config.getint("Analysis", "sentiws_batch_size", fallback=64)) else 1)
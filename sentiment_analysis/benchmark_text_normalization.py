@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmark of sentiment_analysis.text_normalization.
+
+Compares normalize_text and brief_clean with the original implementations
+(GSBertPolarityModel.clean_text and the brief_cleaning of SentiW2v): both have
+to give identical output for every text, then the time per text is measured.
+
+Texts are the articles of a .json/.jsonl file (e.g. the output of the article
+selection) or generated article-like texts if no file is given:
+
+    $ python3 -m sentiment_analysis.benchmark_text_normalization data/relevant_articles.json
+"""
+
+import random
+import re
+import sys
+import timeit
+from typing import Callable, List
+
+from sentiment_analysis.text_normalization import brief_clean, normalize_text, normalize_texts
+
+_clean_chars = re.compile(r'[^A-Za-züöäÖÜÄß ]', re.MULTILINE)
+_clean_http_urls = re.compile(r'https*\S+', re.MULTILINE)
+_clean_at_mentions = re.compile(r'@\S+', re.MULTILINE)
+
+
+def reference_clean_text(text: str) -> str:
+    """Original cleaning of GSBertPolarityModel"""
+    text = text.replace("\n", " ")
+    text = _clean_http_urls.sub('', text)
+    text = _clean_at_mentions.sub('', text)
+    text = text.replace("0", " null").replace("1", " eins").replace("2", " zwei") \
+        .replace("3", " drei").replace("4", " vier").replace("5", " fünf") \
+        .replace("6", " sechs").replace("7", " sieben").replace("8", " acht") \
+        .replace("9", " neun")
+    text = _clean_chars.sub('', text)
+    text = ' '.join(text.split())
+    text = text.strip().lower()
+    return text
+
+
+def reference_brief_clean(text: str) -> str:
+    """Original brief_cleaning of SentiW2v"""
+    return re.sub("[^A-Za-züäöÜÄÖß']", ' ', str(text)).lower()
+
+
+# Texts with the characters that are treated specially by the cleaning
+EDGE_CASES = ["", "\n", "Flüchtlinge\nAsyl", "http", "http://example.de/a?b=1 Text", "@", "@ Text", "@bundesregierung",
+              "x@y.de", "@https://www.welt.de", "éhttp://a b", "!@foo", "ht!tpx", "1.000.000 Euro", "§ 16a GG",
+              "50%", "so'n GRÖßE Über Straße", "Café »Zitat«", "a\tb\rc\u00a0d", "K\u212a\u0130",
+              "„Zitat“ – 5 €", "\u1e9e\u00c0\u00e9 x\x1cy\x85z\u2028w"]
+
+_WORDS = ["Die", "Bundesregierung", "hat", "am", "Montag", "neue", "Regeln", "für", "Flüchtlinge", "und",
+          "Asylbewerber", "beschlossen", "Über", "Straße", "größer", "Jahr", "Prozent", "Kommunen"]
+
+
+def generated_texts(num_texts: int = 300, seed: int = 0) -> List[str]:
+    """Random article-like texts: sentences with some numbers, punctuation, URLs and mentions"""
+    rng = random.Random(seed)
+
+    def sentence():
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(5, 20))]
+        if rng.random() < 0.3:
+            words.insert(rng.randrange(len(words)), str(rng.randint(1, 3000)))
+        if rng.random() < 0.2:
+            words[rng.randrange(len(words))] += ","
+        if rng.random() < 0.05:
+            words.append("https://www.welt.de/politik/article123.html")
+        if rng.random() < 0.05:
+            words.append("@welt")
+        return " ".join(words) + rng.choice([".", "!", "?", ".\""]) + rng.choice([" ", " ", "\n"])
+
+    return ["".join(sentence() for _ in range(rng.randint(10, 80))) for _ in range(num_texts)]
+
+
+def check_equivalence(texts: List[str]) -> None:
+    for text in EDGE_CASES + texts:
+        assert normalize_text(text) == reference_clean_text(text), text
+        assert brief_clean(text) == reference_brief_clean(text), text
+    assert normalize_texts(texts) == [reference_clean_text(text) for text in texts]
+
+
+def time_per_text(fn: Callable[[List[str]], object], texts: List[str], repeat: int = 5) -> float:
+    return min(timeit.repeat(lambda: fn(texts), number=1, repeat=repeat)) / len(texts)
+
+
+def main(texts: List[str]) -> None:
+    check_equivalence(texts)
+    print(f"Output of {len(texts)} texts ({sum(map(len, texts)) / len(texts):.0f} characters on average) is identical")
+    benchmarks = [
+        ("BERT cleaning", lambda ts: [reference_clean_text(t) for t in ts], normalize_texts),
+        ("brief cleaning", lambda ts: [reference_brief_clean(t) for t in ts], lambda ts: [brief_clean(t) for t in ts]),
+    ]
+    for name, reference, fast in benchmarks:
+        reference_time = time_per_text(reference, texts)
+        fast_time = time_per_text(fast, texts)
+        print(f"{name}: {reference_time * 1e6:.1f} µs -> {fast_time * 1e6:.1f} µs per text "
+              f"(speedup {reference_time / fast_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        from article_selection.jsonl import read_articles
+        input_texts = [text for text in read_articles(sys.argv[1], columns=["text"])["text"] if isinstance(text, str)]
+    else:
+        input_texts = generated_texts()
+    main(input_texts)
@@ -3,16 +3,95 @@
 SentimentModel class based on https://huggingface.co/oliverguhr/german-sentiment-bert,
     (C) 2020 Oliver Guhr (MIT License)"""
 
+import os
 import re
-from typing import List
+from typing import Dict, Iterator, List, Optional, Sequence
 
 import torch
 import torch.nn.functional as F
+from tqdm import tqdm
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
+from sentiment_analysis.keyword_windows import keyword_windows
+from sentiment_analysis.text_normalization import normalize_text, normalize_texts
+
+try:
+    import onnxruntime
+except ImportError:  # only required for the onnx backend
+    onnxruntime = None
+
 
 # 0: pos, 1: neg, 2: neutral
 
+# torch:     fp32 PyTorch model
+# quantized: PyTorch model with dynamically quantized int8 linear layers
+# onnx:      exported ONNX graph (see export_onnx) run with ONNX Runtime
+BACKENDS = ("torch", "quantized", "onnx")
+
+
+def length_buckets(
+        lengths: Sequence[int],
+        batch_size: int = 32,
+        max_tokens: Optional[int] = None
+) -> Iterator[List[int]]:
+    """Group the indices of sequences with the given token lengths into batches of similar length.
+
+    Indices are sorted by length, so padding each batch to its longest sequence adds
+    little padding. A batch has at most batch_size sequences and, if max_tokens is
+    given, at most max_tokens tokens including padding (but always at least one sequence)."""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batch = []
+    for i in order:
+        # lengths are increasing, so the new sequence determines the padded batch size
+        if batch and (len(batch) == batch_size
+                      or (max_tokens is not None and (len(batch) + 1) * lengths[i] > max_tokens)):
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def onnx_model_path(onnx_dir: str, model_name: str) -> str:
+    """Path of the exported ONNX graph of a checkpoint"""
+    return os.path.join(onnx_dir, re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name) + ".onnx")
+
+
+def _local_version(model_name: str) -> str:
+    if not os.path.isdir(model_name):
+        return "unknown"
+    return str(max(entry.stat().st_mtime_ns for entry in os.scandir(model_name)))
+
+
+class _LogitsOnly(torch.nn.Module):
+    """Wrapper to export only the logits output of a classification model"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+
+def export_onnx(model_name: str, onnx_dir: str) -> str:
+    """Export a checkpoint to an ONNX graph with dynamic batch size and sequence length.
+    Returns the path of the graph."""
+    os.makedirs(onnx_dir, exist_ok=True)
+    path = onnx_model_path(onnx_dir, model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name)
+    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained("oliverguhr/german-sentiment-bert")
+    sample = tokenizer(["Das ist ein Beispiel.", "Noch ein etwas längerer Beispielsatz."],
+                       padding=True, return_tensors="pt")
+    dynamic_axes = {"input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "logits": {0: "batch"}}
+    torch.onnx.export(_LogitsOnly(model).eval(), (sample["input_ids"], sample["attention_mask"]), path,
+                      input_names=["input_ids", "attention_mask"], output_names=["logits"],
+                      dynamic_axes=dynamic_axes, opset_version=14)
+    return path
+
 
 class GSBertPolarityModel:
     """Code based on
@@ -21,30 +100,43 @@ class GSBertPolarityModel:
     Prediction output form changed from argmax output to polarity score to make it
     more comparable to SentiWS."""
 
-    def __init__(self, model_name: str = "oliverguhr/german-sentiment-bert"):
-        self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
-        # Always use original tokenizer
-        self.tokenizer = AutoTokenizer.from_pretrained("oliverguhr/german-sentiment-bert")
-
-        self.clean_chars = re.compile(r'[^A-Za-züöäÖÜÄß ]', re.MULTILINE)
-        self.clean_http_urls = re.compile(r'https*\S+', re.MULTILINE)
-        self.clean_at_mentions = re.compile(r'@\S+', re.MULTILINE)
-
-    def replace_numbers(self, text: str) -> str:
-        return text.replace("0", " null").replace("1", " eins").replace("2", " zwei") \
-            .replace("3", " drei").replace("4", " vier").replace("5", " fünf") \
-            .replace("6", " sechs").replace("7", " sieben").replace("8", " acht") \
-            .replace("9", " neun")
+    def __init__(
+            self,
+            model_name: str = "oliverguhr/german-sentiment-bert",
+            tokenizer=None,
+            backend: str = "torch",
+            onnx_dir: Optional[str] = None
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}, use one of {BACKENDS}")
+        self.backend = backend
+        self.model, self.session = None, None
+        if backend == "onnx":
+            if onnxruntime is None:
+                raise ImportError("The onnx backend requires onnxruntime (pip install onnxruntime)")
+            path = onnx_model_path(onnx_dir, model_name)
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"{path} not found, export it with: "
+                                        f"python3 -m sentiment_analysis.export_onnx config.ini")
+            self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+            stat = os.stat(path)
+            version = f"{stat.st_mtime_ns}-{stat.st_size}"
+        else:
+            self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
+            if backend == "quantized":
+                # int8 weights of the linear layers, activations are quantized on the fly
+                self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            # hub checkpoints have a commit hash, local ones are identified by their modification time
+            version = getattr(self.model.config, "_commit_hash", None) or _local_version(model_name)
+        # identifies the predictions of this model, e.g. in the PredictionCache
+        self.revision = f"{model_name}@{version}/{backend}"
+        # Always use original tokenizer (can be shared by several models)
+        if tokenizer is None:
+            tokenizer = AutoTokenizer.from_pretrained("oliverguhr/german-sentiment-bert")
+        self.tokenizer = tokenizer
 
     def clean_text(self, text: str) -> str:
-        text = text.replace("\n", " ")
-        text = self.clean_http_urls.sub('', text)
-        text = self.clean_at_mentions.sub('', text)
-        text = self.replace_numbers(text)
-        text = self.clean_chars.sub('', text)  # use only text chars
-        text = ' '.join(text.split())  # substitute multiple whitespace with single whitespace
-        text = text.strip().lower()
-        return text
+        return normalize_text(text)
 
     @staticmethod
     def probs2polarities(pnn: torch.Tensor) -> torch.Tensor:
@@ -59,29 +151,283 @@ class GSBertPolarityModel:
         polarities = pos - neg
         return polarities
 
-    def predict_sentiment_batch(self, texts: List[str]) -> torch.Tensor:
-        texts = [self.clean_text(text) for text in texts]
+    def encode(self, texts: Sequence[str], cleaned: bool = False) -> List[List[int]]:
+        """Clean (unless already cleaned with clean_text) and tokenize texts without padding"""
+        if not cleaned:
+            texts = normalize_texts(texts)
         # Add special tokens takes care of adding [CLS], [SEP], <s>... tokens in the right way for each model.
-        input_ids = self.tokenizer.batch_encode_plus(
+        encodings = self.tokenizer(
             texts,
-            padding=True,
             add_special_tokens=True,
             truncation=True  # Ensure that the text does not exceed the token limit
         )
-        input_ids = torch.tensor(input_ids["input_ids"])
+        return encodings["input_ids"]
 
-        with torch.no_grad():
-            logits = self.model(input_ids)
-            probs = F.softmax(logits[0], dim=1)
+    def pad(self, encodings: Sequence[List[int]]) -> Dict[str, torch.Tensor]:
+        """Input tensors of a batch of token id sequences (see encode)"""
+        return self.tokenizer.pad({"input_ids": list(encodings)}, padding=True, return_tensors="pt")
+
+    def predict_padded(self, padded: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Polarities of a batch of input tensors (see pad)"""
+        # The attention mask keeps padding from changing the predictions
+        if self.session is not None:
+            logits = self.session.run(["logits"], {"input_ids": padded["input_ids"].numpy(),
+                                                   "attention_mask": padded["attention_mask"].numpy()})[0]
+            logits = torch.from_numpy(logits)
+        else:
+            with torch.no_grad():
+                logits = self.model(input_ids=padded["input_ids"], attention_mask=padded["attention_mask"])[0]
+        probs = F.softmax(logits, dim=1)
 
         polarities = self.probs2polarities(probs)
         return polarities
 
+    def predict_encoded(self, encodings: Sequence[List[int]]) -> torch.Tensor:
+        """Polarities of a batch of token id sequences (see encode)"""
+        return self.predict_padded(self.pad(encodings))
+
+    def predict_sentiment_batch(self, texts: List[str]) -> torch.Tensor:
+        return self.predict_encoded(self.encode(texts))
+
+    def predict_sentiment_bucketed(
+            self,
+            texts: Sequence[str],
+            batch_size: int = 32,
+            max_tokens: Optional[int] = None,
+            show_progress: bool = False
+    ) -> List[float]:
+        """Polarities of any number of texts, in the order of the texts.
+
+        Texts of similar token length are scored together in batches (see length_buckets),
+        which is much faster than scoring them one by one and wastes little
+        computation on padding."""
+        return self.predict_encoded_bucketed(self.encode(texts), batch_size, max_tokens, show_progress)
+
+    def predict_encoded_bucketed(
+            self,
+            encodings: Sequence[List[int]],
+            batch_size: int = 32,
+            max_tokens: Optional[int] = None,
+            show_progress: bool = False
+    ) -> List[float]:
+        """Polarities of any number of token id sequences in length-sorted batches"""
+        return _predict_bucketed([self], encodings, batch_size, max_tokens, show_progress)[0]
+
+    def encode_windows(self, texts: Sequence[str], overlap: int = 0, cleaned: bool = False) -> List[List[List[int]]]:
+        """Clean (unless already cleaned with clean_text) and tokenize texts and split
+        each of them into windows of at most the model's token limit (instead of
+        truncating). Consecutive windows share overlap tokens."""
+        if not cleaned:
+            texts = normalize_texts(texts)
+        # The (fast) tokenizer returns the truncated rest of a text as additional windows
+        encodings = self.tokenizer(
+            texts,
+            add_special_tokens=True,
+            truncation=True,
+            return_overflowing_tokens=True,
+            stride=overlap
+        )
+        windows = [[] for _ in texts]
+        for text_index, ids in zip(encodings["overflow_to_sample_mapping"], encodings["input_ids"]):
+            windows[text_index].append(ids)
+        return windows
+
+    def predict_sentiment_chunked(
+            self,
+            texts: Sequence[str],
+            batch_size: int = 32,
+            max_tokens: Optional[int] = None,
+            aggregation: str = "mean",
+            keywords: Optional[Sequence[str]] = None,
+            overlap: int = 0,
+            show_progress: bool = False
+    ) -> List[float]:
+        """Polarities of long texts that are scored completely instead of being truncated.
+
+        Every text is split into token windows (see encode_windows). The windows of all
+        texts are scored together in length-sorted batches, so long texts only cost
+        more windows, not emptier batches. The window polarities of each text are
+        aggregated with
+            "mean":     the mean over all windows
+            "keywords": the mean weighted by the number of keyword occurrences in each
+                        window (texts without any keyword fall back to the mean)"""
+        windows = self.encode_windows(texts, overlap)
+        return _predict_chunked([self], windows, batch_size, max_tokens, aggregation, keywords, show_progress)[0]
+
+    def encode_keyword_windows(
+            self,
+            texts: Sequence[str],
+            keywords: Sequence[str],
+            context: int = 1
+    ) -> List[List[List[int]]]:
+        """Tokenize only the sentences around the keywords of every text (see keyword_windows),
+        each window truncated to the token limit. Texts without a keyword are
+        tokenized completely (truncated) as one window."""
+        text_windows = [keyword_windows(text, keywords, context) or [text] for text in texts]
+        flat = [window for windows in text_windows for window in windows]
+        encodings = self.encode(flat)
+        windows, start = [], 0
+        for text_window in text_windows:
+            windows.append(encodings[start:start + len(text_window)])
+            start += len(text_window)
+        return windows
+
+    def predict_sentiment_keywords(
+            self,
+            texts: Sequence[str],
+            keywords: Sequence[str],
+            context: int = 1,
+            batch_size: int = 32,
+            max_tokens: Optional[int] = None,
+            show_progress: bool = False
+    ) -> List[float]:
+        """Polarities of the parts of the texts about the keywords: the mean polarity of the
+        keyword windows of every text (see encode_keyword_windows), which are scored in
+        length-sorted batches like the windows of predict_sentiment_chunked.
+        Windows that occur more than once are only scored once."""
+        windows = self.encode_keyword_windows(texts, keywords, context)
+        return _predict_chunked([self], windows, batch_size, max_tokens, "mean", None, show_progress)[0]
+
     def analyse_sentiment(self, text: str) -> float:
         polarity = self.predict_sentiment_batch([text]).item()
         return polarity
 
 
+def _predict_bucketed(
+        models: Sequence[GSBertPolarityModel],
+        encodings: Sequence[List[int]],
+        batch_size: int,
+        max_tokens: Optional[int],
+        show_progress: bool
+) -> List[List[float]]:
+    """Polarities of every model for token id sequences in length-sorted batches.
+    The input tensors of each batch are built once and passed to all models."""
+    polarities = [[0.0] * len(encodings) for _ in models]
+    buckets = list(length_buckets([len(e) for e in encodings], batch_size, max_tokens))
+    for bucket in tqdm(buckets, disable=not show_progress, dynamic_ncols=True):
+        padded = models[0].pad([encodings[i] for i in bucket])
+        for model, model_polarities in zip(models, polarities):
+            for i, polarity in zip(bucket, model.predict_padded(padded).tolist()):
+                model_polarities[i] = polarity
+    return polarities
+
+
+def _predict_chunked(
+        models: Sequence[GSBertPolarityModel],
+        windows: List[List[List[int]]],
+        batch_size: int,
+        max_tokens: Optional[int],
+        aggregation: str,
+        keywords: Optional[Sequence[str]],
+        show_progress: bool
+) -> List[List[float]]:
+    """Polarities of every model for texts split into token windows (see predict_sentiment_chunked)"""
+    if aggregation not in ("mean", "keywords"):
+        raise ValueError(f"Unknown aggregation {aggregation}, use 'mean' or 'keywords'")
+    # identical windows (e.g. boilerplate sentences around the keywords) are scored once
+    unique, positions = {}, []
+    for text_windows in windows:
+        for window in text_windows:
+            positions.append(unique.setdefault(tuple(window), len(unique)))
+    unique_polarities = _predict_bucketed(models, [list(window) for window in unique], batch_size, max_tokens,
+                                          show_progress)
+    window_polarities = [[model_polarities[i] for i in positions] for model_polarities in unique_polarities]
+
+    # window weights are the same for all models
+    weights = []
+    for text_windows in windows:
+        text_weights = [1] * len(text_windows)
+        if aggregation == "keywords" and keywords:
+            window_texts = models[0].tokenizer.batch_decode(text_windows, skip_special_tokens=True)
+            keyword_counts = [sum(text.count(keyword.lower()) for keyword in keywords)
+                              for text in window_texts]
+            if sum(keyword_counts) > 0:
+                text_weights = keyword_counts
+        weights.append(text_weights)
+
+    polarities = []
+    for model_window_polarities in window_polarities:
+        model_polarities = []
+        start = 0
+        for text_weights in weights:
+            scores = model_window_polarities[start:start + len(text_weights)]
+            model_polarities.append(sum(w * p for w, p in zip(text_weights, scores)) / sum(text_weights))
+            start += len(text_weights)
+        polarities.append(model_polarities)
+    return polarities
+
+
+class MultiModelPolarityScorer:
+    """Scores texts with several sentiment BERT checkpoints at once.
+
+    All checkpoints use the original german-sentiment-bert tokenizer, so every
+    text is cleaned and tokenized only once and the input tensors of every batch
+    are shared by all models.
+
+        scorer = MultiModelPolarityScorer({"generic_sentibert": "oliverguhr/german-sentiment-bert",
+                                           "finetuned_sentibert": "mdraw/german-news-sentiment-bert"})
+        polarities = scorer.predict_sentiment_bucketed(texts)  # {name: [polarity of each text]}
+    """
+
+    def __init__(self, model_names: Dict[str, str], backend: str = "torch", onnx_dir: Optional[str] = None):
+        tokenizer = AutoTokenizer.from_pretrained("oliverguhr/german-sentiment-bert")
+        self.models = {name: GSBertPolarityModel(model_name, tokenizer=tokenizer, backend=backend, onnx_dir=onnx_dir)
+                       for name, model_name in model_names.items()}
+        self.names = list(self.models)
+        self.tokenizer = tokenizer
+        self.revisions = {name: model.revision for name, model in self.models.items()}
+
+    def _first(self) -> GSBertPolarityModel:
+        return self.models[self.names[0]]
+
+    def predict_sentiment_bucketed(
+            self,
+            texts: Sequence[str],
+            batch_size: int = 32,
+            max_tokens: Optional[int] = None,
+            show_progress: bool = False,
+            cleaned: bool = False
+    ) -> Dict[str, List[float]]:
+        """Polarities of every model (see GSBertPolarityModel.predict_sentiment_bucketed).
+        Pass cleaned=True if the texts are already cleaned with clean_text."""
+        encodings = self._first().encode(texts, cleaned)
+        polarities = _predict_bucketed(list(self.models.values()), encodings, batch_size, max_tokens, show_progress)
+        return dict(zip(self.names, polarities))
+
+    def predict_sentiment_chunked(
+            self,
+            texts: Sequence[str],
+            batch_size: int = 32,
+            max_tokens: Optional[int] = None,
+            aggregation: str = "mean",
+            keywords: Optional[Sequence[str]] = None,
+            overlap: int = 0,
+            show_progress: bool = False,
+            cleaned: bool = False
+    ) -> Dict[str, List[float]]:
+        """Polarities of every model (see GSBertPolarityModel.predict_sentiment_chunked).
+        Pass cleaned=True if the texts are already cleaned with clean_text."""
+        windows = self._first().encode_windows(texts, overlap, cleaned)
+        polarities = _predict_chunked(list(self.models.values()), windows, batch_size, max_tokens,
+                                      aggregation, keywords, show_progress)
+        return dict(zip(self.names, polarities))
+
+    def predict_sentiment_keywords(
+            self,
+            texts: Sequence[str],
+            keywords: Sequence[str],
+            context: int = 1,
+            batch_size: int = 32,
+            max_tokens: Optional[int] = None,
+            show_progress: bool = False
+    ) -> Dict[str, List[float]]:
+        """Polarities of every model (see GSBertPolarityModel.predict_sentiment_keywords)"""
+        windows = self._first().encode_keyword_windows(texts, keywords, context)
+        polarities = _predict_chunked(list(self.models.values()), windows, batch_size, max_tokens,
+                                      "mean", None, show_progress)
+        return dict(zip(self.names, polarities))
+
+
 def test():
     model = GSBertPolarityModel()
     s = model.predict_sentiment_batch(['Du hirnloser Vollidiot!', 'Ich mag dich sehr.'])
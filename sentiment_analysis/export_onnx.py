@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+"""
+Export the sentiment BERT checkpoints of a config file to ONNX graphs
+for the onnx backend (bert_backend = onnx).
+
+Exports the generic model and the finetuned_sentibert_path checkpoint
+to the bert_onnx_dir of the [Analysis] section:
+
+    $ python3 -m sentiment_analysis.export_onnx config.ini
+"""
+
+import configparser
+import sys
+
+from sentiment_analysis.bert import export_onnx
+
+if __name__ == "__main__":
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+    onnx_dir = config.get("Analysis", "bert_onnx_dir", fallback="data/onnx")
+    for model_name in ["oliverguhr/german-sentiment-bert", config.get("Analysis", "finetuned_sentibert_path")]:
+        print(f"Exporting {model_name} to {export_onnx(model_name, onnx_dir)}")
@@ -1,14 +1,299 @@
+from __future__ import annotations
+
 import csv
 import json
+import multiprocessing as mp
+import os
 import traceback
-from typing import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from sentiment_analysis import sentiment_dictionary as sd
-from sentiment_analysis.bert import GSBertPolarityModel
+from article_selection.jsonl import JsonlArticleWriter, is_jsonl, read_articles
+from sentiment_analysis.prediction_cache import PredictionCache, cache_key
+from sentiment_analysis.text_normalization import normalize_texts
+
+# torch/transformers (bert) and spacy (sentiment_dictionary) take long to import,
+# they are only imported when a method needs them
+if TYPE_CHECKING:
+    from sentiment_analysis.bert import MultiModelPolarityScorer
+    from sentiment_analysis.server import SentimentClient
+
+# Part of the cache keys of SentiWS predictions. Change it after changing the
+# SentiWS scoring (sentiment_dictionary, negation_handling, data/sentiws), so that
+# cached predictions of the old version are not reused.
+SENTIWS_REVISION = "sentiws-1"
+
+
+def sentiws_revision(prefilter: bool = False) -> str:
+    # the keyword prefilter parses the sentences of an article in a shorter context,
+    # which can change the parse and the polarity, so it gets its own cache keys
+    return f"{SENTIWS_REVISION}/prefilter" if prefilter else SENTIWS_REVISION
+
+
+def init_bert_scorer(
+        methods: Sequence[str],
+        finetuned_sentibert_path: str,
+        backend: str = "torch",
+        onnx_dir: Optional[str] = None
+) -> Optional[MultiModelPolarityScorer]:
+    """One scorer for all BERT methods, so texts are only tokenized once"""
+    from sentiment_analysis.bert import MultiModelPolarityScorer
+
+    model_names = {}
+    if 'generic_sentibert' in methods:
+        model_names['generic_sentibert'] = "oliverguhr/german-sentiment-bert"
+    if 'finetuned_sentibert' in methods:
+        model_names['finetuned_sentibert'] = finetuned_sentibert_path
+    return MultiModelPolarityScorer(model_names, backend, onnx_dir) if model_names else None
+
+
+def sentiws_polarity(text: str, search_words: list) -> float:
+    from sentiment_analysis import sentiment_dictionary as sd
+
+    polarity = sd.analyse_sentiment(text, search_words)
+    return float('nan') if polarity == '' else float(polarity)
+
+
+def sentiws_polarity_batch(
+        texts: Sequence[str],
+        search_words: list,
+        batch_size: int = 64,
+        n_process: int = 1,
+        show_progress: bool = False,
+        prefilter: bool = False
+) -> List[float]:
+    """sentiws_polarity of every text, spacy parses batch_size texts at once in n_process processes.
+    With prefilter only the sentences with search words (and their neighbours) are parsed."""
+    from sentiment_analysis import sentiment_dictionary as sd
+
+    polarities = sd.analyse_sentiment_batch(texts, search_words, batch_size, n_process, prefilter)
+    return [float('nan') if polarity == '' else float(polarity)
+            for polarity in tqdm(polarities, total=len(texts), dynamic_ncols=True, disable=not show_progress,
+                                 desc='sentiws')]
+
+
+def cached_polarities(
+        texts: Sequence[str],
+        keys: Dict[str, List[str]],
+        predict: Callable[[List[str]], Dict[str, List[float]]],
+        cache: Optional[PredictionCache] = None
+) -> Dict[str, List[float]]:
+    """Polarities of the texts for every method of keys ({method: cache key of every text}).
+    predict(texts) -> {method: polarities} is only called with the texts whose
+    predictions are not cached yet, texts with identical keys are predicted once."""
+    known = {} if cache is None else cache.get_many(key for method_keys in keys.values() for key in method_keys)
+    # keys of all methods -> first text with these keys
+    missing = {}
+    for i, text_keys in enumerate(zip(*keys.values())):
+        if not all(key in known for key in text_keys):
+            missing.setdefault(text_keys, i)
+    if missing:
+        predictions = predict([texts[i] for i in missing.values()])
+        new = {}
+        for j, text_keys in enumerate(missing):
+            for method, key in zip(keys, text_keys):
+                new[key] = predictions[method][j]
+        if cache is not None:
+            cache.put_many(new)
+        known.update(new)
+    return {method: [known[key] for key in method_keys] for method, method_keys in keys.items()}
+
+
+def sentiws_polarities(
+        texts: Sequence[str],
+        search_words: list,
+        cache: Optional[PredictionCache] = None,
+        show_progress: bool = False,
+        client: Optional[SentimentClient] = None,
+        batch_size: int = 64,
+        n_process: int = 1,
+        prefilter: bool = False
+) -> List[float]:
+    """SentiWS polarities of the texts, scored by the sentiment server of the client if given"""
+    revision = sentiws_revision(prefilter)
+    keys = {'sentiws': [cache_key('sentiws', revision, search_words, text) for text in texts]}
+
+    def predict(missing_texts):
+        if client is not None:
+            return {'sentiws': client.predict_sentiws(missing_texts, search_words, show_progress, prefilter)}
+        return {'sentiws': sentiws_polarity_batch(missing_texts, search_words, batch_size, n_process,
+                                                  show_progress, prefilter)}
+
+    return cached_polarities(texts, keys, predict, cache)['sentiws']
+
+
+def bert_polarities(
+        bert_scorer: MultiModelPolarityScorer | SentimentClient,
+        texts: Sequence[str],
+        search_words: list,
+        cache: Optional[PredictionCache] = None,
+        batch_size: int = 32,
+        max_tokens: Optional[int] = None,
+        long_articles: str = "truncate",
+        chunk_aggregation: str = "mean",
+        keyword_context: int = 1,
+        show_progress: bool = False
+) -> Dict[str, List[float]]:
+    """Polarities of all models of the scorer (see score_articles for the options)"""
+    # the search words only influence the keyword windows and the keyword weighted aggregation,
+    # their order does not matter
+    if long_articles == "keywords":
+        mode, mode_words = f"keywords-context{keyword_context}", sorted(search_words)
+    elif long_articles == "chunk":
+        mode = f"chunk-{chunk_aggregation}"
+        mode_words = sorted(search_words) if chunk_aggregation == "keywords" else []
+    else:
+        mode, mode_words = "truncate", []
+    if long_articles == "keywords":
+        # the sentences are split at the punctuation, which is removed by the cleaning
+        key_texts = list(texts)
+    else:
+        key_texts = normalize_texts(texts)
+    keys = {method: [cache_key(f"{method}/{mode}", revision, mode_words, text) for text in key_texts]
+            for method, revision in bert_scorer.revisions.items()}
+
+    # every text is cleaned only once, for the cache keys and the models
+    def predict(missing_texts):
+        if long_articles == "keywords":
+            return bert_scorer.predict_sentiment_keywords(missing_texts, search_words, keyword_context,
+                                                          batch_size, max_tokens, show_progress=show_progress)
+        if long_articles == "chunk":
+            return bert_scorer.predict_sentiment_chunked(missing_texts, batch_size, max_tokens,
+                                                         aggregation=chunk_aggregation,
+                                                         keywords=search_words,
+                                                         show_progress=show_progress,
+                                                         cleaned=True)
+        return bert_scorer.predict_sentiment_bucketed(missing_texts, batch_size, max_tokens,
+                                                      show_progress=show_progress, cleaned=True)
+
+    return cached_polarities(key_texts, keys, predict, cache)
+
+
+def score_articles(
+        articles: List[Tuple[str, dict]],
+        search_words: list,
+        methods: Sequence[str],
+        bert_scorer: Optional[MultiModelPolarityScorer | SentimentClient],
+        batch_size: int = 32,
+        max_tokens: Optional[int] = None,
+        long_articles: str = "truncate",
+        chunk_aggregation: str = "mean",
+        keyword_context: int = 1,
+        sentiws_batch_size: int = 64,
+        sentiws_processes: int = 1,
+        sentiws_prefilter: bool = False,
+        cache: Optional[PredictionCache] = None,
+        show_progress: bool = False,
+        client: Optional[SentimentClient] = None
+) -> List[Tuple[str, dict]]:
+    """Adds a sentiment_<method> entry to every (url, article) pair and returns them in input order.
+    Predictions in the cache are reused, identical texts are only scored once.
+    With a client, SentiWS is scored by the sentiment server (pass the client as bert_scorer for BERT)."""
+    texts = [article['text'] for _, article in articles]
+
+    # 1. use the sentiment dictionary "sentiws"
+    # spacy parses sentiws_batch_size articles at once in sentiws_processes processes
+    # sentiws_prefilter: only the sentences with search_words and their neighbours are parsed
+    if 'sentiws' in methods:
+        polarities = sentiws_polarities(texts, search_words, cache, show_progress, client,
+                                        sentiws_batch_size, sentiws_processes, sentiws_prefilter)
+        for (_, article), polarity in zip(articles, polarities):
+            article['sentiment_sentiws'] = polarity
+
+    # 2. use the generic bert model
+    # 3. use the self trained bert model
+    # Both score all articles at once in length-sorted batches
+    # (batch_size texts, at most max_tokens tokens per batch).
+    # long_articles = "truncate": only the beginning of long articles is scored
+    # long_articles = "chunk": articles are scored in token windows, which are
+    # aggregated with chunk_aggregation ("mean" or "keywords" weighted by search_words)
+    # long_articles = "keywords": only the sentences with search_words and keyword_context
+    # sentences before and after them are scored (like SentiWS, which also only scores
+    # sentences with search words), the polarity is the mean over these windows
+    # Both models share the tokenization and the input tensors of every batch.
+    if bert_scorer is not None:
+        polarities = bert_polarities(bert_scorer, texts, search_words, cache, batch_size, max_tokens,
+                                     long_articles, chunk_aggregation, keyword_context, show_progress)
+        for method, method_polarities in polarities.items():
+            for (_, article), polarity in zip(articles, method_polarities):
+                article[f'sentiment_{method}'] = polarity
+    return articles
+
+
+# Models and prediction cache of a sentiment worker process, loaded once by _init_sentiment_worker
+_worker_scorer: Optional[MultiModelPolarityScorer] = None
+_worker_cache: Optional[PredictionCache] = None
+
+
+def _init_sentiment_worker(
+        methods: Sequence[str],
+        finetuned_sentibert_path: str,
+        backend: str,
+        onnx_dir: Optional[str],
+        threads_per_worker: int,
+        cache_path: Optional[str],
+        cache_max_entries: int
+):
+    global _worker_scorer, _worker_cache
+    if threads_per_worker > 0:
+        import torch
+        # without a limit every worker would start one thread per core
+        torch.set_num_threads(threads_per_worker)
+    _worker_scorer = init_bert_scorer(methods, finetuned_sentibert_path, backend, onnx_dir)
+    if cache_path:
+        _worker_cache = PredictionCache(cache_path, cache_max_entries)
+
+
+def _score_shard(articles: List[Tuple[str, dict]], search_words: list, methods: Sequence[str],
+                 scoring_options: dict) -> List[Tuple[str, dict]]:
+    return score_articles(articles, search_words, methods, _worker_scorer, cache=_worker_cache, **scoring_options)
+
+
+def worker_threads(num_workers: int, threads_per_worker: int = 0) -> int:
+    """Torch threads of every worker process. 0 divides the cores among the workers,
+    torch's default of one thread per core in every worker would oversubscribe the machine."""
+    if threads_per_worker > 0:
+        return threads_per_worker
+    return max(1, (os.cpu_count() or 1) // num_workers)
+
+
+def score_articles_sharded(
+        articles: List[Tuple[str, dict]],
+        search_words: list,
+        methods: Sequence[str],
+        finetuned_sentibert_path: str,
+        num_workers: int,
+        threads_per_worker: int = 0,
+        shard_size: int = 256,
+        backend: str = "torch",
+        onnx_dir: Optional[str] = None,
+        cache_path: Optional[str] = None,
+        cache_max_entries: int = 1_000_000,
+        **scoring_options
+) -> Iterator[Tuple[str, dict]]:
+    """Scores the articles in num_workers processes, each with its own models and
+    threads_per_worker torch threads (0: the cores divided among the workers).
+    The articles are split into shards of shard_size articles, whose results
+    are yielded in input order as soon as they are done.
+    All workers share the prediction cache at cache_path (if given)."""
+    shards = [articles[i:i + shard_size] for i in range(0, len(articles), shard_size)]
+    threads_per_worker = worker_threads(num_workers, threads_per_worker)
+    # spawn: forking a process that already ran torch operations can deadlock
+    with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_sentiment_worker,
+            initargs=(methods, finetuned_sentibert_path, backend, onnx_dir, threads_per_worker,
+                      cache_path, cache_max_entries)
+    ) as executor:
+        results = executor.map(_score_shard, shards, repeat(search_words), repeat(methods), repeat(scoring_options))
+        for shard in tqdm(results, total=len(shards), dynamic_ncols=True, unit='shard'):
+            yield from shard
 
 
 def calulate_sentiment(
@@ -16,18 +301,26 @@ def calulate_sentiment(
         output_path: str,
         search_words: list,
         methods: Sequence[str],
-        finetuned_sentibert_path: str
+        finetuned_sentibert_path: str,
+        batch_size: int = 32,
+        max_tokens: Optional[int] = None,
+        long_articles: str = "truncate",
+        chunk_aggregation: str = "mean",
+        keyword_context: int = 1,
+        sentiws_batch_size: int = 64,
+        sentiws_processes: int = 1,
+        sentiws_prefilter: bool = False,
+        backend: str = "torch",
+        onnx_dir: Optional[str] = None,
+        num_workers: int = 1,
+        threads_per_worker: int = 0,
+        shard_size: int = 256,
+        cache_path: Optional[str] = None,
+        cache_max_entries: int = 1_000_000,
+        server_url: Optional[str] = None
 ):
-    # Initialize BERT models
-    generic_sentibert, finetuned_sentibert = None, None
-    if 'generic_sentibert' in methods:
-        generic_sentibert = GSBertPolarityModel("oliverguhr/german-sentiment-bert")
-    if 'finetuned_sentibert' in methods:
-        finetuned_sentibert = GSBertPolarityModel(finetuned_sentibert_path)
-
     # get the data from the given file path
-    content = pd.read_json(input_path, orient="index")
-    content = content[["date", "text", "url", "title"]]
+    content = read_articles(input_path, columns=["date", "text", "url", "title"])
 
     content = content.sample(20)  # For a quick test run: use only a few samples.
 
@@ -37,7 +330,7 @@ def calulate_sentiment(
     list_len = len(content["text"])
     print("Start calculating sentiment")
     print(f"Total number of articles is: {list_len}")
-    for p, row in tqdm(content.iterrows(), total=list_len, dynamic_ncols=True):
+    for p, row in content.iterrows():
 
         # use only articles that have all needed information
         try:
@@ -57,31 +350,54 @@ def calulate_sentiment(
             'title': title,
             'text': text
         }
-        # add a key : value pair for all sentiment methods specified in the config
-
-        # 1. use the sentiment dictionary "sentiws"
-        if 'sentiws' in methods:
-            sentiment_sentiws = sd.analyse_sentiment(text, search_words)
-            if sentiment_sentiws == '':
-                sentiment_sentiws = float('nan')
-            else:
-                sentiment_sentiws = float(sentiment_sentiws)
-            data[url]['sentiment_sentiws'] = sentiment_sentiws
-
-        # 2. use the generic bert model
-        if 'generic_sentibert' in methods:
-            sentiment_generic_sentibert = generic_sentibert.analyse_sentiment(text)
-            data[url]['sentiment_generic_sentibert'] = sentiment_generic_sentibert
-
-        # 3. use the self trained bert model
-        if 'finetuned_sentibert' in methods:
-            sentiment_finetuned_sentibert = finetuned_sentibert.analyse_sentiment(text)
-            data[url]['sentiment_finetuned_sentibert'] = sentiment_finetuned_sentibert
+
+    # add a key : value pair for all sentiment methods specified in the config
+    scoring_options = dict(batch_size=batch_size, max_tokens=max_tokens,
+                           long_articles=long_articles, chunk_aggregation=chunk_aggregation,
+                           keyword_context=keyword_context, sentiws_batch_size=sentiws_batch_size,
+                           sentiws_processes=sentiws_processes, sentiws_prefilter=sentiws_prefilter)
+    print(f"Calculating sentiment with {', '.join(methods)}")
+    if server_url:
+        # the models are loaded once by the sentiment server, which batches the requests of all its clients
+        from sentiment_analysis.server import SentimentClient
+
+        print(f"Using the sentiment server at {server_url}")
+        client = SentimentClient(server_url, methods)
+        cache = PredictionCache(cache_path, cache_max_entries) if cache_path else None
+        score_articles(list(data.items()), search_words, methods, client if client.names else None,
+                       cache=cache, show_progress=True, client=client, **scoring_options)
+        if cache is not None:
+            print(f"Prediction cache: {cache.hits} hits, {cache.misses} misses")
+            cache.close()
+    elif num_workers > 1:
+        # every worker process loads its own models and scores a part of the articles
+        print(f"Using {num_workers} worker processes with "
+              f"{worker_threads(num_workers, threads_per_worker)} threads each")
+        scored = score_articles_sharded(list(data.items()), search_words, methods, finetuned_sentibert_path,
+                                        num_workers, threads_per_worker, shard_size, backend, onnx_dir,
+                                        cache_path, cache_max_entries, **scoring_options)
+        data = dict(scored)
+    else:
+        if threads_per_worker > 0:
+            import torch
+            torch.set_num_threads(threads_per_worker)
+        # Initialize BERT models
+        bert_scorer = init_bert_scorer(methods, finetuned_sentibert_path, backend, onnx_dir)
+        cache = PredictionCache(cache_path, cache_max_entries) if cache_path else None
+        score_articles(list(data.items()), search_words, methods, bert_scorer,
+                       cache=cache, show_progress=True, **scoring_options)
+        if cache is not None:
+            print(f"Prediction cache: {cache.hits} hits, {cache.misses} misses")
+            cache.close()
 
     # write data to file
-    with open(output_path, "w", encoding='utf-8') as f:
-        print(f"Write data to {output_path}")
-        json.dump(data, f, default=str, ensure_ascii=False)
+    print(f"Write data to {output_path}")
+    if is_jsonl(output_path):
+        with JsonlArticleWriter(output_path, new=True) as writer:
+            writer.update(data)
+    else:
+        with open(output_path, "w", encoding='utf-8') as f:
+            json.dump(data, f, default=str, ensure_ascii=False)
 
 
 def absolute_error(
@@ -119,20 +435,54 @@ def categorical_error(pred_polarity: float, target_label: float) -> float:
         return abs(pred_polarity) >= (1 / 3)
 
 
+def polarity_label(polarity: float) -> int:
+    """Discrete label of a polarity (intervals as in categorical_error)"""
+    if polarity >= 1 / 3:
+        return 0  # positive
+    if polarity <= -1 / 3:
+        return 1  # negative
+    return 2  # neutral
+
+
+def polarity_drift(polarities: Sequence[float], reference_polarities: Sequence[float]) -> dict:
+    """Differences between the polarities of a model backend and the fp32 reference model"""
+    differences = np.abs(np.array(polarities) - np.array(reference_polarities))
+    labels_agree = [polarity_label(p) == polarity_label(r) for p, r in zip(polarities, reference_polarities)]
+    return {
+        'mean_polarity_drift': float(np.mean(differences)),
+        'max_polarity_drift': float(np.max(differences)),
+        'label_agreement': float(np.mean(labels_agree)),
+    }
+
+
 def eval_sentiment(
         senti_eval_input: str,
         senti_eval_output: str,
         search_words: Sequence[str],
         methods: Sequence[str],
-        finetuned_sentibert_path: str
+        finetuned_sentibert_path: str,
+        batch_size: int = 32,
+        max_tokens: Optional[int] = None,
+        sentiws_batch_size: int = 64,
+        sentiws_processes: int = 1,
+        sentiws_prefilter: bool = False,
+        backend: str = "torch",
+        onnx_dir: Optional[str] = None,
+        cache_path: Optional[str] = None,
+        cache_max_entries: int = 1_000_000,
+        server_url: Optional[str] = None
 ):
     print(f'Evaluating sentiment analysis methods on {senti_eval_input}')
-    # Initialize BERT models
-    generic_sentibert, finetuned_sentibert = None, None
-    if 'generic_sentibert' in methods:
-        generic_sentibert = GSBertPolarityModel("oliverguhr/german-sentiment-bert")
-    if 'finetuned_sentibert' in methods:
-        finetuned_sentibert = GSBertPolarityModel(finetuned_sentibert_path)
+    client = None
+    if server_url:
+        from sentiment_analysis.server import SentimentClient
+
+        print(f"Using the sentiment server at {server_url}")
+        client = SentimentClient(server_url, methods)
+        bert_scorer = client if client.names else None
+    else:
+        # Initialize BERT models
+        bert_scorer = init_bert_scorer(methods, finetuned_sentibert_path, backend, onnx_dir)
 
     label_remap = {3: 1}  # Analogous to training setup: remap "hostile" to "negative"
     texts = []
@@ -157,27 +507,44 @@ def eval_sentiment(
     # Values lower than 1 make conversion from categorical labels to polarities more smooth
     label_smoothing = 1.0
 
+    # Predictions of all methods, reused from the cache if the texts were scored before
+    cache = PredictionCache(cache_path, cache_max_entries) if cache_path else None
+    predictions = {}
+    if 'sentiws' in methods:
+        predictions['sentiws'] = sentiws_polarities(texts, search_words, cache, client=client,
+                                                    batch_size=sentiws_batch_size, n_process=sentiws_processes,
+                                                    prefilter=sentiws_prefilter)
+    # BERT models score the whole dataset in length-sorted batches
+    if bert_scorer is not None:
+        predictions.update(bert_polarities(bert_scorer, texts, search_words, cache, batch_size, max_tokens))
+
+    # Drift of a quantized/onnx backend compared to the fp32 models
+    # (the backend of a sentiment server is set in its own config)
+    drift_results = {}
+    if bert_scorer is not None and client is None and backend != "torch":
+        reference_scorer = init_bert_scorer(methods, finetuned_sentibert_path)
+        reference_polarities = bert_polarities(reference_scorer, texts, search_words, cache, batch_size, max_tokens)
+        for method, polarities in reference_polarities.items():
+            drift_results[method] = polarity_drift(predictions[method], polarities)
+    if cache is not None:
+        print(f"Prediction cache: {cache.hits} hits, {cache.misses} misses")
+        cache.close()
+
     for method in methods:
         full_results[method] = {'categorical_errors': [], 'absolute_errors': []}
         aggregated_results[method] = {}
 
         # Calculate metrics on each entry in the validation dataset
-        for text, target_label in tqdm(
-                zip(texts, labels),
+        for i, (text, target_label) in tqdm(
+                enumerate(zip(texts, labels)),
                 total=len(texts),
                 dynamic_ncols=True,
                 desc=method
         ):
 
-            if method == 'sentiws':
-                pred_polarity = sd.analyse_sentiment(text, search_words)
-                if pred_polarity == '':
-                    pred_polarity = 0.0  # 'nan'
-                pred_polarity = float(pred_polarity)
-            elif method == 'generic_sentibert':
-                pred_polarity = generic_sentibert.analyse_sentiment(text)
-            elif method == 'finetuned_sentibert':
-                pred_polarity = finetuned_sentibert.analyse_sentiment(text)
+            pred_polarity = predictions[method][i]
+            if np.isnan(pred_polarity):
+                pred_polarity = 0.0  # 'nan'
 
             # Calculate error metrics: absolute error (using polarities)
             abserr = absolute_error(
@@ -196,6 +563,7 @@ def eval_sentiment(
         for metric_name in ['absolute_errors', 'categorical_errors']:
             aggregated_results[method][f'mean_{metric_name[:-1]}'] = np.mean(full_results[method][metric_name])
             aggregated_results[method][f'std_{metric_name[:-1]}'] = np.std(full_results[method][metric_name])
+        aggregated_results[method].update(drift_results.get(method, {}))
 
     agr_pd = pd.DataFrame.from_dict(aggregated_results)
     print(f'Aggregated results:\n{agr_pd}\n')
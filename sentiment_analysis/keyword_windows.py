@@ -0,0 +1,89 @@
+"""Sentence splitting and extraction of the sentences around keywords.
+
+SentiWS only scores the sentences of an article that contain a search word
+(see SentimentDictionary.predict_sentiment). keyword_windows extracts the same
+sentences, together with context sentences before and after them, so that the
+BERT models can score only the parts of an article about the topic:
+
+    >>> keyword_windows("Das Wetter war gut. Die Stadt nimmt 300 Flüchtlinge auf. "
+    ...                 "Der Bürgermeister ist zufrieden. Am Abend regnete es.", ["flüchtling"], context=0)
+    ['Die Stadt nimmt 300 Flüchtlinge auf.']
+
+Neighbouring and overlapping windows are merged into one window.
+The sentence splitter is rule based (no spacy model), so it is fast enough to
+run on every article before the models.
+"""
+
+import re
+from typing import List, Sequence, Tuple
+
+# Candidate sentence ends: punctuation (with closing quotes or brackets) followed by whitespace, or line breaks
+_SENTENCE_END = re.compile(r'[.!?]+[“”"\'»«)\]]*\s+|\s*\n\s*')
+# Words that are followed by a period without ending the sentence (lowercase, without the last period)
+ABBREVIATIONS = {
+    "abs", "abb", "art", "bzw", "ca", "d.h", "dr", "etc", "evtl", "ggf", "hr", "fr", "inkl", "jh", "mio", "mrd",
+    "nr", "prof", "s", "st", "str", "u.a", "usw", "vgl", "z.b", "z.t", "zb", "jan", "feb", "febr", "aug", "sept",
+    "okt", "nov", "dez", "bzgl", "ggü", "i.d.r", "o.ä", "u.ä", "sog", "tel", "v.a", "ehem", "gen", "max", "min",
+}
+
+
+def _is_sentence_end(text: str, match: re.Match) -> bool:
+    if '\n' in match.group():
+        return True
+    end = match.end()
+    # sentences start with an uppercase letter, a digit or a quote
+    if end < len(text) and text[end].islower():
+        return False
+    if match.group()[0] != '.':
+        return True
+    word_start = match.start()
+    while word_start > 0 and not text[word_start - 1].isspace():
+        word_start -= 1
+    word = text[word_start:match.start()].lstrip('(„"\'»«').lower()
+    # abbreviations, ordinal numbers ("3. Oktober") and initials ("A. Merkel")
+    return not (word in ABBREVIATIONS or word.isdigit() or len(word) == 1)
+
+
+def sentence_spans(text: str) -> List[Tuple[int, int]]:
+    """(start, end) of every sentence of the text, without the whitespace between the sentences"""
+    spans = []
+    start = 0
+    for match in _SENTENCE_END.finditer(text):
+        if not _is_sentence_end(text, match):
+            continue
+        # the punctuation and closing quotes belong to the sentence, the whitespace does not
+        end = match.start() + len(match.group().rstrip())
+        if end > start:
+            spans.append((start, end))
+        start = match.end()
+    if text[start:].strip():
+        spans.append((start, len(text.rstrip())))
+    return spans
+
+
+def split_sentences(text: str) -> List[str]:
+    return [text[start:end] for start, end in sentence_spans(text)]
+
+
+def keyword_sentence_indices(sentences: Sequence[str], keywords: Sequence[str]) -> List[int]:
+    """Indices of the sentences that contain a keyword (lowercase substring match as in SentiWS)"""
+    return [i for i, sentence in enumerate(sentences)
+            if any(keyword in sentence.lower() for keyword in keywords)]
+
+
+def keyword_windows(text: str, keywords: Sequence[str], context: int = 1) -> List[str]:
+    """Sentences with a keyword and context sentences before and after them.
+    Consecutive sentences form one window. Returns [] if the text contains no keyword."""
+    lowered = text.lower()
+    if not any(keyword in lowered for keyword in keywords):
+        return []
+    spans = sentence_spans(text)
+    sentences = [text[start:end] for start, end in spans]
+    runs = []  # [first, last] sentence index of every window
+    for i in keyword_sentence_indices(sentences, keywords):
+        first, last = max(i - context, 0), min(i + context, len(spans) - 1)
+        if runs and first <= runs[-1][1] + 1:
+            runs[-1][1] = max(runs[-1][1], last)
+        else:
+            runs.append([first, last])
+    return [text[spans[first][0]:spans[last][1]] for first, last in runs]
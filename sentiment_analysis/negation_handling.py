@@ -1,8 +1,7 @@
-import spacy
 from nltk.stem.snowball import SnowballStemmer
 
+# the sentences are parsed by the caller (see SentimentDictionary), no spacy model is loaded here
 stemmer = SnowballStemmer(language='german')
-nlp = spacy.load('de')
 neg_words = ['nicht', 'kein', 'nirgends', 'nirgendwo', 'niemand', 'niemals', 'nirgendwohin', 'nie']
 
 #More information: https://spacy.io/usage/linguistic-features
@@ -46,6 +45,8 @@ def check_for_negation(sentence, word):
 
 # example
 if __name__ == "__main__":
+    import spacy
+    nlp = spacy.load('de')
     doc1 = nlp('Flüchtlinge sind böse')
     doc2 = nlp('Flüchtlinge sind nicht böse')
 
@@ -0,0 +1,107 @@
+"""On-disk cache of sentiment predictions.
+
+Scoring all articles again after a config change or for another evaluation run
+is expensive, although most texts did not change. PredictionCache stores the
+polarity of every scored text in a SQLite database, keyed by a hash of
+
+    (method, model revision, search words, cleaned text)
+
+so a prediction is only reused if neither the text nor anything that influences
+its score changed. The cache holds at most max_entries predictions, the least
+recently used ones are evicted first.
+
+    with PredictionCache('data/sentiment_cache.sqlite') as cache:
+        key = cache_key('sentiws', 'v1', search_words, text)
+        cache.put_many({key: polarity})
+        cache.get_many([key])  # {key: polarity}
+"""
+
+import hashlib
+import math
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, Sequence
+
+# SQLite limits the number of parameters of a statement
+_CHUNK_SIZE = 500
+
+
+def cache_key(method: str, revision: str, search_words: Sequence[str], cleaned_text: str) -> str:
+    h = hashlib.sha256()
+    for part in (method, revision, '\x1f'.join(search_words), cleaned_text):
+        h.update(part.encode('utf-8'))
+        h.update(b'\x1e')
+    return h.hexdigest()
+
+
+def _chunks(items: list) -> Iterable[list]:
+    for i in range(0, len(items), _CHUNK_SIZE):
+        yield items[i:i + _CHUNK_SIZE]
+
+
+class PredictionCache:
+    """Polarities by cache_key in a SQLite database with LRU eviction.
+
+    Several processes can use the same database (e.g. the workers of
+    score_articles_sharded), writes wait for the lock of the database.
+    """
+
+    def __init__(self, path: str, max_entries: int = 1_000_000):
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS predictions '
+                        '(key TEXT PRIMARY KEY, polarity REAL, last_used INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, float]:
+        """Cached polarities of the keys, missing keys are left out"""
+        keys = list(set(keys))
+        found = {}
+        for chunk in _chunks(keys):
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.db.execute(f'SELECT key, polarity FROM predictions WHERE key IN ({placeholders})', chunk)
+            for key, polarity in rows:
+                # SQLite stores NaN as NULL
+                found[key] = float('nan') if polarity is None else polarity
+        if found:
+            now = time.time_ns()
+            with self.db:
+                for chunk in _chunks(list(found)):
+                    placeholders = ','.join('?' * len(chunk))
+                    self.db.execute(f'UPDATE predictions SET last_used = ? WHERE key IN ({placeholders})',
+                                    [now] + chunk)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, polarities: Dict[str, float]) -> None:
+        if not polarities:
+            return
+        now = time.time_ns()
+        rows = [(key, None if math.isnan(polarity) else polarity, now) for key, polarity in polarities.items()]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO predictions (key, polarity, last_used) VALUES (?, ?, ?)', rows)
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                self.db.execute('DELETE FROM predictions WHERE key IN '
+                                '(SELECT key FROM predictions ORDER BY last_used LIMIT ?)', (excess,))
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,5 +1,8 @@
+from typing import Iterable, Iterator
+
 import spacy
 from spacy_sentiws import spaCySentiWS
+from sentiment_analysis.keyword_windows import keyword_windows
 from sentiment_analysis.negation_handling import *
 
 # class that ranks sentiment based on a dictionary approach
@@ -38,22 +41,62 @@ class SentimentDictionary():
     sentimentTextIsAdditive = False
     saveSentencesWithSentiment = False
 
+    # keyword prefilter (prefilter=True): a rule based sentence splitter finds the
+    # sentences with a search term first, only these passages (with prefilterContext
+    # sentences before and after them, so the parser sees the same context) are read
+    # into spacy. The pipes in prefilterDisabledPipes are not needed for the sentiment
+    # (sentiws uses the tags, check_for_negation the dependency parse).
+    prefilterContext = 1
+    prefilterDisabledPipes = ['ner']
+
     # main function
     # takes the text and a list of search Terms
-    def predict_sentiment(self, text: str, searchTermList: list) -> float:
-       
+    def predict_sentiment(self, text: str, searchTermList: list, prefilter: bool = False) -> float:
+        if prefilter:
+            docs = [self.nlp(passage, disable=self.prefilter_disabled_pipes())
+                    for passage in self.keyword_passages(text, searchTermList)]
+            return self.sentiment_of_docs(docs, searchTermList)
+        # read the text into spacy
+        return self.sentiment_of_docs([self.nlp(text)], searchTermList)
+
+    # batch version of predict_sentiment
+    # the texts are parsed with nlp.pipe in batches of batch_size texts (passages with prefilter),
+    # by n_process processes (-1: one per CPU), the polarities are yielded in input order
+    def predict_sentiment_batch(self, texts: Iterable[str], searchTermList: list,
+                                batch_size: int = 64, n_process: int = 1,
+                                prefilter: bool = False) -> Iterator[float]:
+        if not prefilter:
+            docs = self.nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+            for doc in docs:
+                yield self.sentiment_of_docs([doc], searchTermList)
+            return
+        passages = [self.keyword_passages(text, searchTermList) for text in texts]
+        docs = self.nlp.pipe((passage for textPassages in passages for passage in textPassages),
+                             batch_size=batch_size, n_process=n_process,
+                             disable=self.prefilter_disabled_pipes())
+        for textPassages in passages:
+            yield self.sentiment_of_docs([next(docs) for _ in textPassages], searchTermList)
+
+    def keyword_passages(self, text: str, searchTermList: list) -> list:
+        # the parts of the text that are parsed with the keyword prefilter
+        return keyword_windows(text, searchTermList, context=self.prefilterContext)
+
+    def prefilter_disabled_pipes(self) -> list:
+        return [name for name in self.prefilterDisabledPipes if name in self.nlp.pipe_names]
+
+    # sentiment of a text that has already been read into spacy
+    # (as one doc or as the docs of its keyword passages)
+    def sentiment_of_docs(self, docs: list, searchTermList: list) -> float:
+
         if not self.sentimentTextIsAdditive:
             # new sentiment is calculated for every function call
             self.sentimentText = 0.0
 
-        # read the text into spacy
-        doc = self.nlp(text)
-
         # the counter is used for normalization 
         counter = 0
 
-        # iterate through all sentences in the document
-        for sentence in doc.sents:
+        # iterate through all sentences of the documents
+        for sentence in (sentence for doc in docs for sentence in doc.sents):
             sentenceText = sentence.text
 
             # to get a sentiment related to the search terms only sentences
@@ -90,7 +133,7 @@ class SentimentDictionary():
             dictionary[key] = value
 
 
-def analyse_sentiment(text: str, search_terms: list) -> float:
+def analyse_sentiment(text: str, search_terms: list, prefilter: bool = False) -> float:
     if not isinstance(text, str):
         raise TypeError(f"analyse sentiment takes a string")
     if not search_terms or not isinstance(search_terms, list) or not all(isinstance(entry, str) for entry in search_terms):
@@ -99,10 +142,29 @@ def analyse_sentiment(text: str, search_terms: list) -> float:
     if not any([searchTerm in text.lower() for searchTerm in search_terms]):
         return 0.0
     sd = SentimentDictionary.getInstance()
-    sd.predict_sentiment(text, search_terms)
+    sd.predict_sentiment(text, search_terms, prefilter)
     return sd.sentimentText
 
 
+def analyse_sentiment_batch(texts: Iterable[str], search_terms: list,
+                            batch_size: int = 64, n_process: int = 1, prefilter: bool = False) -> Iterator[float]:
+    # same as analyse_sentiment for every text, but spacy parses the texts in batches
+    # (and in n_process processes), polarities are yielded in input order
+    texts = list(texts)
+    if not all(isinstance(text, str) for text in texts):
+        raise TypeError(f"analyse sentiment takes strings")
+    if not search_terms or not isinstance(search_terms, list) or not all(isinstance(entry, str) for entry in search_terms):
+        raise TypeError(f"analyse sentiment takes a list of str")
+
+    # texts without a search term are not parsed
+    relevant = [any(searchTerm in text.lower() for searchTerm in search_terms) for text in texts]
+    sd = SentimentDictionary.getInstance()
+    polarities = sd.predict_sentiment_batch((text for text, r in zip(texts, relevant) if r), search_terms,
+                                            batch_size=batch_size, n_process=n_process, prefilter=prefilter)
+    for r in relevant:
+        yield next(polarities) if r else 0.0
+
+
 def test():
     texts = ["Flüchtlinge nehmen uns die Arbeitsplätze weg.",
              "Wir müssen uns gemeinsam anstregenen Flüchtlinge gut zu intigrieren.",
@@ -114,5 +176,10 @@ def test():
     for t in texts:
         print(t, analyse_sentiment(t, ["flüchtlinge"]))
 
+    # the batch version gives the same polarities
+    print(list(analyse_sentiment_batch(texts, ["flüchtlinge"], batch_size=2)))
+    # only the sentences with search terms are parsed
+    print(list(analyse_sentiment_batch(texts, ["flüchtlinge"], prefilter=True)))
+
 if __name__ == "__main__":
     test()
\ No newline at end of file
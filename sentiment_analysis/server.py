@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+"""
+Local inference server for the sentiment models.
+
+Loads the BERT models (and SentiWS) of a config file once and serves them to
+all jobs on the same machine, e.g. the pipeline, evaluation runs and notebooks,
+instead of every job loading its own copies of the models.
+Concurrent requests are merged into batches by a DynamicBatcher: the first
+request waits at most senti_server_max_latency_ms for further requests, then
+all texts are scored together.
+
+Start the server (it only listens on localhost):
+
+    $ python3 -m sentiment_analysis.server config.ini
+
+and set senti_server_url = http://127.0.0.1:8766 in the config of the jobs that
+should use it, or use the client directly:
+
+    client = SentimentClient("http://127.0.0.1:8766")
+    client.predict_sentiment_bucketed(["Ich mag dich sehr."])  # {method: [polarity]}
+"""
+
+import configparser
+import json
+import queue
+import sys
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence
+
+from tqdm import tqdm
+
+from sentiment_analysis.inference import init_bert_scorer, sentiws_polarity_batch
+
+DEFAULT_PORT = 8766
+
+
+class _Request:
+    __slots__ = ("texts", "options", "done", "result", "error")
+
+    def __init__(self, texts: List[str], options: tuple):
+        self.texts = texts
+        self.options = options
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DynamicBatcher:
+    """Merges concurrent requests into batches.
+
+    predict(texts, options) -> {method: polarities} is called from one thread with the
+    texts of all waiting requests with the same options. A batch is started when
+    max_batch_texts texts are waiting or max_latency seconds after its first request.
+    If a merged batch fails, its requests are retried one by one, so an error only
+    reaches the request that caused it. With start=False, the batches are only
+    scored after start() is called.
+    """
+
+    def __init__(
+            self,
+            predict: Callable[[List[str], tuple], Dict[str, List[float]]],
+            max_batch_texts: int = 64,
+            max_latency: float = 0.01,
+            start: bool = True
+    ):
+        self.predict = predict
+        self.max_batch_texts = max_batch_texts
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.num_batches = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        if start:
+            self.start()
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, texts: List[str], options: tuple) -> Dict[str, List[float]]:
+        """Polarities of the texts, blocks until their batch is done"""
+        request = _Request(texts, options)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self, first: _Request) -> List[_Request]:
+        batch = [first]
+        num_texts = len(first.texts)
+        deadline = time.monotonic() + self.max_latency
+        while num_texts < self.max_batch_texts:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self.queue.put(None)  # stop after this batch
+                break
+            batch.append(request)
+            num_texts += len(request.texts)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            groups = defaultdict(list)
+            for request in self._collect(first):
+                groups[request.options].append(request)
+            for options, requests in groups.items():
+                self._predict_group(options, requests)
+
+    def _predict_group(self, options: tuple, requests: List[_Request]):
+        try:
+            polarities = self.predict([text for request in requests for text in request.texts], options)
+            self.num_batches += 1
+            start = 0
+            for request in requests:
+                end = start + len(request.texts)
+                request.result = {method: values[start:end] for method, values in polarities.items()}
+                start = end
+        except Exception as e:
+            if len(requests) > 1:
+                for request in requests:
+                    self._predict_group(options, [request])
+                return
+            requests[0].error = e
+        for request in requests:
+            request.done.set()
+
+    def stop(self):
+        self.queue.put(None)
+        self._thread.join()
+
+
+class SentimentServer:
+    """The models of the configured methods behind a DynamicBatcher.
+
+    Request options (see SentimentClient):
+        ("sentiws", search_words, prefilter)
+        ("truncate", cleaned)
+        ("chunk", aggregation, keywords, cleaned, overlap)
+        ("keywords", keywords, context)
+    """
+
+    def __init__(
+            self,
+            methods: Sequence[str],
+            finetuned_sentibert_path: str,
+            backend: str = "torch",
+            onnx_dir: Optional[str] = None,
+            batch_size: int = 32,
+            max_tokens: Optional[int] = None,
+            max_batch_texts: int = 64,
+            max_latency: float = 0.01,
+            sentiws_batch_size: int = 64,
+            sentiws_processes: int = 1
+    ):
+        self.methods = list(methods)
+        self.bert_scorer = init_bert_scorer(methods, finetuned_sentibert_path, backend, onnx_dir)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.sentiws_batch_size = sentiws_batch_size
+        self.sentiws_processes = sentiws_processes
+        # SentimentDictionary keeps the state of the current text, so it scores one batch at a time
+        self._sentiws_lock = threading.Lock()
+        self.batcher = DynamicBatcher(self.predict, max_batch_texts, max_latency)
+
+    def info(self) -> dict:
+        return {
+            "methods": self.methods,
+            "revisions": {} if self.bert_scorer is None else self.bert_scorer.revisions,
+        }
+
+    def predict(self, texts: List[str], options: tuple) -> Dict[str, List[float]]:
+        kind = options[0]
+        if kind == "sentiws":
+            if "sentiws" not in self.methods:
+                raise ValueError("sentiws is not served")
+            with self._sentiws_lock:
+                return {"sentiws": sentiws_polarity_batch(texts, list(options[1]), self.sentiws_batch_size,
+                                                          self.sentiws_processes, prefilter=options[2])}
+        if self.bert_scorer is None:
+            raise ValueError("No BERT method is served")
+        if kind == "truncate":
+            return self.bert_scorer.predict_sentiment_bucketed(texts, self.batch_size, self.max_tokens,
+                                                               cleaned=options[1])
+        if kind == "chunk":
+            return self.bert_scorer.predict_sentiment_chunked(texts, self.batch_size, self.max_tokens,
+                                                              aggregation=options[1], keywords=list(options[2]),
+                                                              overlap=options[4], cleaned=options[3])
+        if kind == "keywords":
+            return self.bert_scorer.predict_sentiment_keywords(texts, list(options[1]), options[2],
+                                                               self.batch_size, self.max_tokens)
+        raise ValueError(f"Unknown request kind {kind}")
+
+    def serve(self, port: int = DEFAULT_PORT, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serve the models on http://host:port/ in a background thread.
+        Call shutdown() on the returned server to stop it."""
+        server = ThreadingHTTPServer((host, port), _handler(self))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def _parse_request(request) -> tuple:
+    """Texts and options of a /predict request, raises ValueError if they are malformed"""
+    if not isinstance(request, dict):
+        raise ValueError("The request must be a JSON object")
+    texts = request.get("texts")
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        raise ValueError("texts must be a list of strings")
+    options = request.get("options")
+    if not isinstance(options, list) or not options or not isinstance(options[0], str):
+        raise ValueError("options must be a list starting with the request kind")
+    return texts, tuple(tuple(option) if isinstance(option, list) else option for option in options)
+
+
+def _handler(sentiment_server: SentimentServer):
+
+    class SentimentHandler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: dict):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/info":
+                self._reply(200, sentiment_server.info())
+            else:
+                self._reply(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._reply(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                texts, options = _parse_request(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+            except (KeyError, TypeError, ValueError) as e:
+                self._reply(400, {"error": str(e)})
+                return
+            try:
+                polarities = sentiment_server.batcher.submit(texts, options)
+            except (KeyError, TypeError, ValueError) as e:
+                self._reply(400, {"error": str(e)})
+                return
+            except Exception as e:
+                self._reply(500, {"error": repr(e)})
+                return
+            self._reply(200, {"polarities": polarities})
+
+        def log_message(self, *args):
+            pass
+
+    return SentimentHandler
+
+
+class SentimentClient:
+    """Scores texts with the models of a running SentimentServer.
+
+    Has the prediction methods of MultiModelPolarityScorer (restricted to the
+    requested methods), so it can be used in its place, e.g. in bert_polarities.
+    The batch sizes are set by the server, batch_size and max_tokens are ignored.
+    """
+
+    def __init__(self, url: str, methods: Optional[Sequence[str]] = None, request_size: int = 256,
+                 timeout: float = 600.0):
+        self.url = url.rstrip("/")
+        self.request_size = request_size
+        self.timeout = timeout
+        with urllib.request.urlopen(f"{self.url}/info", timeout=timeout) as response:
+            info = json.loads(response.read())
+        if methods is None:
+            methods = info["methods"]
+        missing = [method for method in methods if method not in info["methods"]]
+        if missing:
+            raise ValueError(f"The server at {url} does not serve {', '.join(missing)}")
+        self.methods = list(methods)
+        self.revisions = {name: revision for name, revision in info["revisions"].items() if name in methods}
+        self.names = list(self.revisions)
+
+    def _predict(self, texts: Sequence[str], options: tuple, show_progress: bool = False) -> Dict[str, List[float]]:
+        polarities = defaultdict(list)
+        for start in tqdm(range(0, len(texts), self.request_size), disable=not show_progress, dynamic_ncols=True):
+            body = json.dumps({"texts": list(texts[start:start + self.request_size]),
+                               "options": list(options)}).encode("utf-8")
+            request = urllib.request.Request(f"{self.url}/predict", data=body,
+                                             headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                for method, values in json.loads(response.read())["polarities"].items():
+                    polarities[method].extend(values)
+        if not texts:
+            return {name: [] for name in self.names}
+        return {method: values for method, values in polarities.items() if method in self.methods}
+
+    def predict_sentiws(self, texts: Sequence[str], search_words: Sequence[str],
+                        show_progress: bool = False, prefilter: bool = False) -> List[float]:
+        return self._predict(texts, ("sentiws", list(search_words), prefilter), show_progress)["sentiws"]
+
+    def predict_sentiment_bucketed(self, texts: Sequence[str], batch_size: int = 32,
+                                   max_tokens: Optional[int] = None, show_progress: bool = False,
+                                   cleaned: bool = False) -> Dict[str, List[float]]:
+        return self._predict(texts, ("truncate", cleaned), show_progress)
+
+    def predict_sentiment_chunked(self, texts: Sequence[str], batch_size: int = 32,
+                                  max_tokens: Optional[int] = None, aggregation: str = "mean",
+                                  keywords: Optional[Sequence[str]] = None, overlap: int = 0,
+                                  show_progress: bool = False, cleaned: bool = False) -> Dict[str, List[float]]:
+        return self._predict(texts, ("chunk", aggregation, list(keywords or []), cleaned, overlap), show_progress)
+
+    def predict_sentiment_keywords(self, texts: Sequence[str], keywords: Sequence[str], context: int = 1,
+                                   batch_size: int = 32, max_tokens: Optional[int] = None,
+                                   show_progress: bool = False) -> Dict[str, List[float]]:
+        return self._predict(texts, ("keywords", list(keywords), context), show_progress)
+
+
+if __name__ == "__main__":
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+    server = SentimentServer(
+        config.get("Analysis", "senti_methods").lower().split(", "),
+        config.get("Analysis", "finetuned_sentibert_path"),
+        backend=config.get("Analysis", "bert_backend", fallback="torch"),
+        onnx_dir=config.get("Analysis", "bert_onnx_dir", fallback="data/onnx"),
+        batch_size=config.getint("Analysis", "bert_batch_size", fallback=32),
+        max_tokens=config.getint("Analysis", "bert_max_tokens", fallback=0) or None,
+        max_batch_texts=config.getint("Analysis", "senti_server_max_batch", fallback=64),
+        max_latency=config.getfloat("Analysis", "senti_server_max_latency_ms", fallback=10) / 1000,
+        sentiws_batch_size=config.getint("Analysis", "sentiws_batch_size", fallback=64),
+        sentiws_processes=config.getint("Analysis", "sentiws_processes", fallback=1)
+    )
+    port = config.getint("Analysis", "senti_server_port", fallback=DEFAULT_PORT)
+    http_server = server.serve(port)
+    print(f"Serving {', '.join(server.methods)} on http://127.0.0.1:{port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        http_server.shutdown()
+        server.batcher.stop()
@@ -1,12 +1,13 @@
 import pandas as pd
 import json
-import spacy
-import regex as re
 from gensim.models.phrases import Phrases, Phraser
 import multiprocessing
 from gensim.models import Word2Vec
 from time import time
 
+from article_selection.jsonl import read_articles
+from sentiment_analysis.text_normalization import brief_clean
+
 # Setting up the loggings to monitor gensim
 import logging  
 logging.basicConfig(format="%(levelname)s - %(asctime)s: %(message)s", datefmt= '%H:%M:%S', level=logging.WARN)
@@ -27,6 +28,7 @@ class SentiW2v:
                             min_alpha=0.0007,
                             negative=20,
                             workers=multiprocessing.cpu_count()-1)
+        import spacy
         self.nlp = spacy.load("de", disable=["tagger", "parser","ner"])
 
     def cleaning(self,doc):
@@ -38,7 +40,7 @@ class SentiW2v:
             return ' '.join(txt)
 
     def set_text_from_file(self,path):
-        df = pd.read_json(path, orient='index')        
+        df = read_articles(path, columns=["text"])
         self.text=df["text"]
 
     def set_text_from_pandas(self, data):
@@ -46,7 +48,7 @@ class SentiW2v:
         self.text=df["text"]
 
     def clean_and_train(self):
-        brief_cleaning = (re.sub("[^A-Za-züäöÜÄÖß']",' ', str(row)).lower() for row in self.text)
+        brief_cleaning = (brief_clean(str(row)) for row in self.text)
         print(f"Text length: {len(self.text)}")
         if len(self.text) == 0:
             return
@@ -91,17 +93,17 @@ class SentiW2v:
 def similarity_by_year(input_path :  str,output_path : str, search_words : list,
                        start_year=2007, end_year=2015, number_most_sim=10):
     # lemmatize the search words
+    import spacy
     nlp = spacy.load("de")
     search_doc = nlp(" ".join(search_words))
     search_words = [token.lemma_ for token in search_doc]
     
 
     try:
-        content = pd.read_json(input_path, orient="index", precise_float=True) # , numpy=True)
+        content = read_articles(input_path, columns=["date","text","url"])
     except ValueError:
         return
-        
-    content = content[["date","text","url"]]
+
     most_sim = {}
 
     content["date"]=content['date'].astype('str')
@@ -120,8 +122,7 @@ def similarity_by_year(input_path :  str,output_path : str, search_words : list,
 def similarity_by_publisher(input_path: str,output_path: str, search_words: list, 
                             start_year=2007, end_year=2015, number_most_sim=10):
    
-    content = pd.read_json(input_path, orient="index")
-    content = content[["date","text","url"]]
+    content = read_articles(input_path, columns=["date","text","url"])
     most_sim = {}
     list_publishers = []
     for i , row in content.iterrows():
@@ -149,8 +150,7 @@ def similarity_by_publisher(input_path: str,output_path: str, search_words: list
 def similarity_by_year_and_publisher(input_path : str, output_path : str,search_words : list,
                                      start_year=2007, end_year=2015, number_most_sim=10):
 
-    content = pd.read_json(input_path, orient="index")
-    content=content[["date","text","url"]]
+    content = read_articles(input_path, columns=["date","text","url"])
     most_sim={}
     list_publishers = []
     for i , row in content.iterrows():
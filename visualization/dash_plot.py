@@ -5,11 +5,13 @@ import plotly.graph_objects as go
 import plotly.express as px
 import pandas as pd
 from dash.dependencies import Input, Output
+
+from article_selection.jsonl import read_articles
 #https://www.statworx.com/en/blog/how-to-build-a-dashboard-in-python-plotly-dash-step-by-step-tutorial/
 
 def dash_plot(filepath):
-	# Load data
-	df = pd.read_json(filepath, convert_dates=True ).transpose()
+	# Load data (.json or streamed from .jsonl)
+	df = read_articles(filepath)
 	df.index = pd.to_datetime(df['date'])
 
 	# Initialize the app